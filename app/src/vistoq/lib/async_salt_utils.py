@@ -0,0 +1,407 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import asyncio
+import json
+import random
+import threading
+
+from django.utils import timezone
+from pan_cnc.lib import cnc_utils
+from requests.exceptions import RequestException
+
+from vistoq.lib import metrics
+from vistoq.lib import operator_utils
+from vistoq.lib import salt_utils
+from vistoq.lib.cache_utils import get_int_config_value
+from vistoq.lib.import_utils import lazy_import
+from vistoq.lib.import_utils import resolve
+
+aiohttp = lazy_import('aiohttp')
+
+# aiohttp sessions and concurrency limits, one per event loop and salt-api base url
+_pool_lock = threading.Lock()
+_pools = dict()
+
+
+def is_available():
+    """
+    :return: True when aiohttp is installed and the async client is enabled with SALT_ASYNC_ENABLED
+    """
+    if str(cnc_utils.get_config_value('SALT_ASYNC_ENABLED', 'true')).lower() != 'true':
+        return False
+
+    try:
+        resolve(aiohttp)
+        return True
+    except ImportError:
+        return False
+
+
+def get_pool(base_url, pool_size, concurrency):
+    """
+    Return the aiohttp session and concurrency limit of the running event loop for a salt-api base url. The session
+    keeps its connections to the provisioner alive, so concurrent calls share one connection pool
+    :param base_url: salt-api url such as http://provisioner:9000
+    :param pool_size: max number of pooled connections to keep open to the provisioner
+    :param concurrency: max number of salt calls in flight at once
+    :return: tuple of (aiohttp.ClientSession, asyncio.Semaphore)
+    """
+    loop = asyncio.get_event_loop()
+    with _pool_lock:
+        key = (loop, base_url)
+        if key not in _pools or _pools[key][0].closed:
+            connector = aiohttp.TCPConnector(limit=pool_size)
+            session = aiohttp.ClientSession(connector=connector, headers={'Accept': 'application/json'})
+            _pools[key] = (session, asyncio.Semaphore(concurrency))
+
+        return _pools[key]
+
+
+class AsyncSaltUtil():
+    """
+    asyncio counterpart of SaltUtil. Settings, timeouts, the circuit breaker and the auth token are shared with the
+    blocking client, but any number of calls can run concurrently over one pooled connection, at most
+    SALT_ASYNC_CONCURRENCY at a time. Calls are recorded in the deployment history like those of SaltUtil
+    """
+
+    def __init__(self, operator=None):
+        self.sync = salt_utils.SaltUtil()
+        self.base_url = self.sync.base_url
+        self.concurrency = get_int_config_value('SALT_ASYNC_CONCURRENCY', 16)
+        # captured here as the calls run on the event loop thread, which does not know the request
+        self.operator = operator_utils.get_operator() if operator is None else operator
+        self.auth_token = ''
+
+    @staticmethod
+    async def _run_blocking(fn, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, fn, *args)
+
+    async def _get_salt_auth_token(self):
+        if self.auth_token:
+            return True
+
+        # a cached token is returned right away, a login blocks so it runs on the executor
+        token = await self._run_blocking(salt_utils.token_cache.get_token, self.sync)
+        if token is None:
+            print('No auth token found!')
+            return False
+
+        self.auth_token = token
+        return True
+
+    async def _backoff(self, attempt, path, reason):
+        delay = random.uniform(0, self.sync.retry_backoff * (2 ** (attempt - 1)))
+        print('Retrying request to %s in %.2f seconds: %s' % (path, delay, reason))
+        metrics.registry.inc('vistoq_salt_api_retries_total', {'endpoint': '/' + path.strip('/').split('/')[0]},
+                             help_text='Retried requests to salt-api')
+        await asyncio.sleep(delay)
+
+    async def _send(self, method, path, payload, headers):
+        """
+        Send a request through the circuit breaker with the timeouts of its salt function, retrying like
+        SaltUtil._send. Requests wait for a free slot of the concurrency limit before they are sent
+        :return: tuple of (http status, response text)
+        :raises CircuitOpenError: when the provisioner is considered unhealthy
+        :raises aiohttp.ClientError: when the request failed after all attempts
+        """
+        request_labels = self.sync.get_request_labels(path, payload)
+        connect_timeout, read_timeout = self.sync.get_timeout(request_labels, payload)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        idempotent = self.sync.is_idempotent(method, request_labels)
+        session, semaphore = get_pool(self.base_url, self.sync.pool_size, self.concurrency)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            async with semaphore:
+                if not self.sync.breaker.allow_request():
+                    metrics.registry.inc('vistoq_salt_api_circuit_open_total',
+                                         {'endpoint': request_labels['endpoint']},
+                                         help_text='Requests rejected while the salt-api circuit breaker was open')
+                    raise salt_utils.CircuitOpenError('Provisioner is unavailable, not sending request to %s' % path)
+
+                labels = dict(request_labels)
+                labels['status'] = ''
+                try:
+                    with metrics.registry.timer('vistoq_salt_api_request_seconds', labels,
+                                                'Latency of requests to salt-api') as labels:
+                        async with session.request(method, self.base_url + path, json=payload, headers=headers,
+                                                   timeout=timeout) as res:
+                            status = res.status
+                            text = await res.text()
+
+                        labels['status'] = str(status)
+
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    self.sync.breaker.record_failure()
+                    # a connection that could not be established never reached salt
+                    retryable = idempotent or isinstance(e, aiohttp.ClientConnectorError)
+                    if not retryable or attempt >= self.sync.retry_attempts:
+                        raise
+
+                    error = e
+                except BaseException:
+                    # anything else, cancellation included, still has to end a half open trial
+                    self.sync.breaker.record_failure()
+                    raise
+                else:
+                    error = None
+
+            if error is not None:
+                await self._backoff(attempt, path, error)
+                continue
+
+            if status >= 500:
+                self.sync.breaker.record_failure()
+                if idempotent and attempt < self.sync.retry_attempts:
+                    await self._backoff(attempt, path, status)
+                    continue
+            else:
+                self.sync.breaker.record_success()
+
+            return status, text
+
+    async def _request(self, method, path, payload=None):
+        headers = {'X-Auth-Token': self.auth_token}
+        status, text = await self._send(method, path, payload, headers)
+        if status == 401:
+            print('Auth token rejected by salt-api, logging in again')
+            self.auth_token = ''
+            await self._run_blocking(salt_utils.token_cache.invalidate, self.sync)
+            if not await self._get_salt_auth_token():
+                return status, text
+
+            headers = {'X-Auth-Token': self.auth_token}
+            status, text = await self._send(method, path, payload, headers)
+
+        return status, text
+
+    def _record(self, payload_json, response, started):
+        with operator_utils.acting_as(self.operator):
+            self.sync._record(payload_json, response, started)
+
+    async def get_minion_list(self):
+        minion_list = list()
+        if not await self._get_salt_auth_token():
+            print('Could not connect to provisioner')
+            return minion_list
+
+        try:
+            status, text = await self._request('GET', '/minions')
+        except (aiohttp.ClientError, asyncio.TimeoutError, RequestException) as e:
+            print(e)
+            return minion_list
+
+        if status != 200:
+            print('Invalid return code')
+            return minion_list
+
+        try:
+            return list(json.loads(text)['return'][0].keys())
+        except (ValueError, KeyError, IndexError, AttributeError):
+            print('Invalid return data')
+            return minion_list
+
+    async def deploy_template(self, template):
+        payload_json = json.loads(template)
+        return await self.deploy_payload(payload_json)
+
+    async def deploy_payload(self, payload_json):
+        """
+        Send a salt payload to the provisioner. The call and its result are recorded in the deployment history
+        :param payload_json: list of salt lowstate dicts, such as returned by SnippetRegistry.render_payload
+        :return: response text from the provisioner
+        """
+        started = timezone.now()
+        if not await self._get_salt_auth_token():
+            print('Could not connect to provisioner')
+            res_text = 'Could not login to provisioner!'
+        else:
+            try:
+                status, res_text = await self._request('POST', '/', payload_json)
+                print(status)
+            except (aiohttp.ClientError, asyncio.TimeoutError, RequestException) as e:
+                print(e)
+                res_text = 'Error during deploy'
+
+        await self._run_blocking(self._record, payload_json, res_text, started)
+        return res_text
+
+    async def deploy_payloads(self, payloads):
+        """
+        Send many salt payloads at once, such as one per compute node
+        :param payloads: list of payloads, each a list of salt lowstate dicts
+        :return: list of response texts in the order of the payloads
+        """
+        # log in once up front instead of once per call
+        await self._get_salt_auth_token()
+        return await asyncio.gather(*[self.deploy_payload(payload) for payload in payloads])
+
+    async def deploy_templates(self, templates):
+        return await self.deploy_payloads([json.loads(template) for template in templates])
+
+    async def run_on_minions(self, minions, fun, arg=None, kwarg=None):
+        """
+        Run the same salt function on every minion with one call per minion, so each minion answers as soon as it
+        can and a slow one does not hold up the others
+        :param minions: list of minion ids
+        :param fun: salt function such as 'virt.freemem' or 'grains.items'
+        :param arg: optional list of positional arguments
+        :param kwarg: optional dict of keyword arguments
+        :return: dict of minion -> return of the minion, None for minions that did not return
+        """
+        payloads = list()
+        for minion in minions:
+            lowstate = {'client': 'local', 'tgt': minion, 'fun': fun}
+            if arg:
+                lowstate['arg'] = list(arg)
+
+            if kwarg:
+                lowstate['kwarg'] = dict(kwarg)
+
+            payloads.append([lowstate])
+
+        results = dict()
+        for minion, res in zip(minions, await self.deploy_payloads(payloads)):
+            try:
+                results[minion] = json.loads(res)['return'][0].get(minion, None)
+            except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+                results[minion] = None
+
+        return results
+
+    async def get_job(self, jid):
+        """
+        Look up a job from the salt job cache, see SaltUtil.get_job
+        :param jid: salt job id
+        :return: dict containing the targeted 'minions' and the 'return' dict of each minion, or None on error
+        """
+        if not await self._get_salt_auth_token():
+            print('Could not connect to provisioner')
+            return None
+
+        try:
+            status, text = await self._request('GET', '/jobs/%s' % jid)
+        except (aiohttp.ClientError, asyncio.TimeoutError, RequestException) as e:
+            print(e)
+            return None
+
+        if status != 200:
+            print('Invalid return code looking up job %s: %s' % (jid, status))
+            return None
+
+        try:
+            job_json = json.loads(text)
+            job = dict()
+            job['minions'] = list()
+            if 'info' in job_json and len(job_json['info']) > 0:
+                job['minions'] = job_json['info'][0].get('Minions', list())
+
+            job['return'] = dict()
+            if 'return' in job_json and len(job_json['return']) > 0:
+                job['return'] = job_json['return'][0]
+
+            return job
+        except (ValueError, AttributeError) as e:
+            print('Could not parse job %s from provisioner' % jid)
+            print(e)
+            return None
+
+    async def get_jobs(self, jids):
+        """
+        :param jids: list of salt job ids
+        :return: dict of jid -> job dict or None, looked up concurrently
+        """
+        await self._get_salt_auth_token()
+        jobs = await asyncio.gather(*[self.get_job(jid) for jid in jids])
+        return dict(zip(jids, jobs))
+
+
+class EventLoopThread():
+    """
+    One asyncio event loop per process running on a daemon thread, so blocking django views can hand it
+    coroutines. The aiohttp session and its pooled connections live on this loop and are reused by every request
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def get_loop(self):
+        with self._lock:
+            if self._loop is None or not self._thread.is_alive():
+                loop = asyncio.new_event_loop()
+                started = threading.Event()
+
+                def run():
+                    asyncio.set_event_loop(loop)
+                    loop.call_soon(started.set)
+                    loop.run_forever()
+
+                self._thread = threading.Thread(target=run, name='salt-async-loop', daemon=True)
+                self._thread.start()
+                started.wait()
+                self._loop = loop
+
+            return self._loop
+
+    def run(self, coroutine, timeout=None):
+        """
+        Run a coroutine on the loop and wait for its result
+        :param coroutine: coroutine object
+        :param timeout: seconds to wait, each salt call already has its own timeouts
+        :return: result of the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.get_loop()).result(timeout)
+
+
+event_loop = EventLoopThread()
+
+
+class SyncSaltUtil():
+    """
+    Blocking adapter with the SaltUtil surface plus the batch variants, for use from the CNCView and
+    CNCBaseFormView subclasses. Every call runs on the shared event loop, so a batch returns once its slowest call
+    has and not after the sum of all of them
+    """
+
+    def __init__(self):
+        self.client = AsyncSaltUtil()
+
+    def get_minion_list(self):
+        return event_loop.run(self.client.get_minion_list())
+
+    def deploy_template(self, template):
+        return event_loop.run(self.client.deploy_template(template))
+
+    def deploy_payload(self, payload_json):
+        return event_loop.run(self.client.deploy_payload(payload_json))
+
+    def deploy_payloads(self, payloads):
+        return event_loop.run(self.client.deploy_payloads(payloads))
+
+    def deploy_templates(self, templates):
+        return event_loop.run(self.client.deploy_templates(templates))
+
+    def run_on_minions(self, minions, fun, arg=None, kwarg=None):
+        return event_loop.run(self.client.run_on_minions(minions, fun, arg, kwarg))
+
+    def get_job(self, jid):
+        return event_loop.run(self.client.get_job(jid))
+
+    def get_jobs(self, jids):
+        return event_loop.run(self.client.get_jobs(jids))
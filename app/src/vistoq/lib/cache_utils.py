@@ -0,0 +1,218 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import threading
+import time
+
+from django.core.cache import cache
+from pan_cnc.lib import cnc_utils
+
+from vistoq.lib import metrics
+
+
+def get_int_config_value(config_name, default):
+    """
+    Load an integer configuration value, falling back to the default when the value is missing or not a number
+    :param config_name: name of the configuration value i.e. MINION_CACHE_TTL
+    :param default: default integer value
+    :return: int
+    """
+    value = cnc_utils.get_config_value(config_name, default)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        print('Invalid value for %s, using default of %s' % (config_name, default))
+        return default
+
+
+class SingleFlight():
+    """
+    Collapse concurrent calls for the same key into a single call. The first caller runs the function and all
+    callers that arrive while it is running wait for and share its result
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key, None)
+            if call is None:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+
+            return call['result']
+
+        try:
+            call['result'] = fn(*args, **kwargs)
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+            call['event'].set()
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+
+class BackgroundRefreshCache():
+    """
+    Cache a single value produced by a loader function. The value is fresh for 'ttl' seconds, after that it is still
+    served for up to 'max_stale' seconds while a single background thread loads a new copy. Only a cold cache, or a
+    value older than ttl + max_stale, makes the caller wait on the loader. Values are also kept in the django cache
+    so other workers can pick up a value loaded elsewhere
+    """
+
+    def __init__(self, name, loader, ttl=60, max_stale=600):
+        """
+        :param name: unique name of this cache, used as the django cache key
+        :param loader: function taking no arguments that returns the value to cache, returning None means the load
+        failed and the previous value should be kept
+        :param ttl: number of seconds a value is considered fresh
+        :param max_stale: number of seconds past the ttl a value may be served while being refreshed
+        """
+        self.name = name
+        self.cache_key = 'vistoq.%s' % name
+        self.loader = loader
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._entry = None
+        self._flight = SingleFlight()
+
+    def get(self):
+        """
+        Return the cached value, refreshing in the background or loading synchronously as required
+        :return: cached value or None if nothing could be loaded
+        """
+        entry = self._get_entry()
+        now = time.time()
+
+        if entry is not None:
+            age = now - entry['updated']
+            if age < self.ttl:
+                metrics.registry.cache_hit(self.name, 'hit')
+                return entry['value']
+
+            if age < self.ttl + self.max_stale:
+                metrics.registry.cache_hit(self.name, 'stale')
+                self.refresh(wait=False)
+                return entry['value']
+
+        metrics.registry.cache_hit(self.name, 'miss')
+        entry = self.refresh(wait=True)
+        if entry is None:
+            return None
+
+        return entry['value']
+
+    def refresh(self, wait=True):
+        """
+        Reload the value. Concurrent refreshes are collapsed into a single call to the loader
+        :param wait: block until the refresh has completed when True, otherwise refresh in a background thread
+        :return: the refreshed cache entry when wait is True, otherwise None
+        """
+        if wait:
+            return self._flight.do(self.cache_key, self._load)
+
+        if self._flight.in_flight(self.cache_key):
+            return None
+
+        t = threading.Thread(target=self._background_load, name='refresh-%s' % self.name, daemon=True)
+        t.start()
+        return None
+
+    def invalidate(self):
+        self._entry = None
+        cache.delete(self.cache_key)
+
+    def update(self, value):
+        """
+        Replace the cached value without changing its age, used to apply a known change to the cached copy instead
+        of reloading it
+        :param value: new value
+        :return: None
+        """
+        entry = self._get_entry()
+        if entry is None:
+            return
+
+        entry = {'value': value, 'updated': entry['updated']}
+        self._entry = entry
+        timeout = int(self.ttl + self.max_stale - (time.time() - entry['updated']))
+        if timeout > 0:
+            cache.set(self.cache_key, entry, timeout)
+
+    def peek(self):
+        """
+        Return the cached value without loading or refreshing it
+        :return: cached value or None when nothing is cached
+        """
+        entry = self._get_entry()
+        if entry is None:
+            return None
+
+        return entry['value']
+
+    def age(self):
+        """
+        :return: number of seconds since the cached value was loaded or None when nothing is cached
+        """
+        entry = self._get_entry()
+        if entry is None:
+            return None
+
+        return time.time() - entry['updated']
+
+    def _get_entry(self):
+        entry = self._entry
+        if entry is None or time.time() - entry['updated'] > self.ttl:
+            # another worker may have loaded a newer copy
+            shared_entry = cache.get(self.cache_key)
+            if shared_entry is not None and (entry is None or shared_entry['updated'] > entry['updated']):
+                self._entry = shared_entry
+                entry = shared_entry
+
+        return entry
+
+    def _load(self):
+        value = self.loader()
+        if value is None:
+            print('Could not refresh %s, keeping previous value' % self.name)
+            return self._entry
+
+        entry = {'value': value, 'updated': time.time()}
+        self._entry = entry
+        cache.set(self.cache_key, entry, self.ttl + self.max_stale)
+        return entry
+
+    def _background_load(self):
+        try:
+            self._flight.do(self.cache_key, self._load)
+        except Exception as e:
+            print('Error refreshing %s in the background' % self.name)
+            print(e)
@@ -0,0 +1,206 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from vistoq.lib import inventory_utils
+from vistoq.lib import async_salt_utils
+from vistoq.lib import job_utils
+from vistoq.lib import salt_utils
+from vistoq.lib.cache_utils import get_int_config_value
+from vistoq.lib.snippet_registry import snippet_registry
+
+
+def parse_selected_vms(values):
+    """
+    Group the VMs selected on the deployed VMs pages by minion
+    :param values: list of 'minion/hostname' strings
+    :return: OrderedDict of minion -> list of hostnames
+    """
+    selected = OrderedDict()
+    for value in values:
+        if '/' not in value:
+            continue
+
+        minion, hostname = value.split('/', 1)
+        if minion == '' or hostname == '':
+            continue
+
+        hostnames = selected.setdefault(minion, list())
+        if hostname not in hostnames:
+            hostnames.append(hostname)
+
+    return selected
+
+
+def render_delete_payload(minion, hostnames=None):
+    """
+    :param minion: minion id
+    :param hostnames: list of hostnames to delete through the delete_selected_vms snippet, or None to delete every
+    VM on the minion through the delete_all_vms snippet
+    :return: salt payload deleting the VMs in one salt-api call
+    """
+    if hostnames is None:
+        return snippet_registry.render_payload('delete_all_vms', {'minion': minion})
+
+    return snippet_registry.render_payload('delete_selected_vms', {'minion': minion, 'hostnames': hostnames})
+
+
+def parse_delete_results(minion, res):
+    """
+    :param minion: minion id
+    :param res: response text of the delete call, with one return per deleted VM for selected VMs
+    :return: tuple of (success, message)
+    """
+    try:
+        state_returns = [r[minion] for r in json.loads(res)['return']]
+    except (ValueError, TypeError, KeyError, IndexError) as e:
+        print('Could not load delete results from provisioner for %s' % minion)
+        print(e)
+        return False, 'Error deleting VMs! %s' % res
+
+    if not state_returns:
+        return False, 'Error deleting VMs! No result returned from %s' % minion
+
+    messages = list()
+    for state_return in state_returns:
+        success, message = job_utils.check_state_return(state_return)
+        if not success:
+            messages.append(message)
+
+    return not messages, '; '.join(messages)
+
+
+def delete_minion_vms(minion, hostnames=None):
+    """
+    Delete VMs on a single minion in one salt-api call
+    :param minion: minion id
+    :param hostnames: list of hostnames to delete, or None to delete every VM on the minion
+    :return: tuple of (success, message)
+    """
+    salt_util = salt_utils.SaltUtil()
+    res = salt_util.deploy_payload(render_delete_payload(minion, hostnames))
+    return parse_delete_results(minion, res)
+
+
+def delete_async(targets):
+    """
+    Send the delete call of every minion at once over the pooled connection of the async salt client
+    :param targets: OrderedDict of minion -> list of hostnames or None
+    :return: dict of minion -> tuple of (success, message)
+    """
+    minions = list(targets.keys())
+    try:
+        payloads = [render_delete_payload(m, targets[m]) for m in minions]
+        responses = async_salt_utils.SyncSaltUtil().deploy_payloads(payloads)
+    except Exception as e:
+        print('Error deleting VMs')
+        print(e)
+        return {m: (False, 'Error deleting VMs! %s' % e) for m in minions}
+
+    return {m: parse_delete_results(m, res) for m, res in zip(minions, responses)}
+
+
+def delete_vms(selected, delete_all_minions=None):
+    """
+    Delete many VMs at once. Each minion receives a single salt call and the per minion calls run concurrently on
+    the async salt client, or on a bounded thread pool without it. The VM state of every affected minion is read
+    back in one call afterwards to report on each VM
+    :param selected: dict of minion -> list of hostnames to delete
+    :param delete_all_minions: list of minions to remove every VM from
+    :return: list of dicts with 'minion', 'vm_name', 'status' and 'message' keys, one per VM
+    """
+    delete_all_minions = list(delete_all_minions or list())
+    minions = list(selected.keys()) + [m for m in delete_all_minions if m not in selected]
+    if not minions:
+        return list()
+
+    # list what is running on the nodes being cleared so the results can name each VM
+    before = dict()
+    if delete_all_minions:
+        index = inventory_utils.fleet_inventory.load_index(','.join(delete_all_minions), 'list')
+        if index is not None:
+            for vm in index['vms']:
+                before.setdefault(vm['minion'], list()).append(vm['hostname'])
+
+    targets = OrderedDict()
+    for minion in minions:
+        if minion in delete_all_minions:
+            targets[minion] = None
+        else:
+            targets[minion] = selected[minion]
+
+    if async_salt_utils.is_available():
+        outcomes = delete_async(targets)
+    else:
+        max_workers = get_int_config_value('BATCH_DEPLOY_WORKERS', 8)
+        outcomes = dict()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = dict()
+            for minion, hostnames in targets.items():
+                futures[minion] = executor.submit(delete_minion_vms, minion, hostnames)
+
+            for minion, future in futures.items():
+                try:
+                    outcomes[minion] = future.result()
+                except Exception as e:
+                    print('Error deleting VMs on %s' % minion)
+                    print(e)
+                    outcomes[minion] = (False, 'Error deleting VMs! %s' % e)
+
+    after = inventory_utils.fleet_inventory.load_index(','.join(minions), 'list')
+    remaining = None
+    responded = list()
+    if after is not None:
+        remaining = set((vm['minion'], vm['hostname']) for vm in after['vms'])
+        responded = after['minions']
+
+    results = list()
+    deleted_vms = list()
+    for minion, hostnames in targets.items():
+        success, message = outcomes[minion]
+        if hostnames is None:
+            hostnames = before.get(minion, list())
+            if not hostnames:
+                results.append({'minion': minion, 'vm_name': '*', 'status': 'success' if success else 'failed',
+                                'message': message or 'Deleted all VMs on %s' % minion})
+                continue
+
+        for hostname in hostnames:
+            result = dict()
+            result['minion'] = minion
+            result['vm_name'] = hostname
+            if remaining is not None and minion in responded:
+                # trust what is actually left on the node over the state result
+                deleted = (minion, hostname) not in remaining
+            else:
+                deleted = success
+
+            if deleted:
+                result['status'] = 'success'
+                result['message'] = 'VM %s deleted from %s' % (hostname, minion)
+                deleted_vms.append((minion, hostname))
+            else:
+                result['status'] = 'failed'
+                result['message'] = message or 'VM %s is still present on %s' % (hostname, minion)
+
+            results.append(result)
+
+    inventory_utils.fleet_inventory.forget_vms(deleted_vms)
+    for line, result in enumerate(results, start=1):
+        result['line'] = line
+
+    return results
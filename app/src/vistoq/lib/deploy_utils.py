@@ -0,0 +1,311 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from vistoq.lib import async_salt_utils
+from vistoq.lib import idempotency_utils
+from vistoq.lib import job_utils
+from vistoq.lib import placement_utils
+from vistoq.lib import salt_utils
+from vistoq.lib import scheduler_utils
+from vistoq.lib.cache_utils import get_int_config_value
+from vistoq.lib.snippet_registry import snippet_registry
+
+# columns of each row in a batch deployment, bridges are optional and default to the snippet defaults
+row_fields = ('minion', 'vm_name', 'left_bridge', 'right_bridge')
+
+
+def parse_deployment_rows(rows_text):
+    """
+    Parse the rows of a batch deployment. Each non empty line holds comma separated values in the order
+    minion, vm_name, left_bridge, right_bridge. A minion of 'auto' leaves the choice of compute node to vistoq
+    :param rows_text: text from the batch deployment form
+    :return: list of row dicts, rows that could not be parsed contain an 'error' key
+    """
+    rows = list()
+    for line_number, line in enumerate(rows_text.splitlines(), start=1):
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+
+        values = [v.strip() for v in line.split(',')]
+        row = dict()
+        row['line'] = line_number
+        for field, value in zip(row_fields, values):
+            if value != '':
+                row[field] = value
+
+        if len(values) > len(row_fields):
+            row['error'] = 'Too many values, expected: %s' % ', '.join(row_fields)
+        elif 'minion' not in row or 'vm_name' not in row:
+            row['error'] = 'Both minion and vm_name are required'
+
+        rows.append(row)
+
+    return rows
+
+
+def check_duplicate_rows(rows):
+    """
+    Fail every row repeating the vm_name of an earlier row on the same compute node, as both would fight over the
+    same VM. Run after auto placement so rows placed on the same node are caught too
+    :param rows: list of row dicts
+    :return: None, duplicate rows are updated in place with an 'error'
+    """
+    seen = set()
+    for row in rows:
+        if 'error' in row:
+            continue
+
+        key = (row['minion'], row['vm_name'])
+        if key in seen:
+            row['error'] = 'Duplicate vm_name %s on %s' % (row['vm_name'], row['minion'])
+
+        seen.add(key)
+
+
+def render_row_payload(service, common_context, row):
+    """
+    Render the provision_firewall payload for a single row
+    :param service: loaded provision_firewall snippet metadata
+    :param common_context: values shared by all rows such as admin_username and panorama_ip
+    :param row: row dict
+    :return: list of salt lowstate dicts
+    """
+    jinja_context = dict()
+    for v in service['variables']:
+        jinja_context[v['name']] = v.get('default', '')
+
+    jinja_context.update(common_context)
+    for field in row_fields:
+        if field in row:
+            jinja_context[field] = row[field]
+
+    return snippet_registry.render_payload(service['name'], jinja_context)
+
+
+def build_minion_payload(rows, payloads):
+    """
+    Join the payloads of every row targeting a single minion into one salt-api call. Salt runs the chunks one
+    after another on the minion, so there is no contention between builds of the same batch on a node
+    :param rows: list of row dicts
+    :param payloads: list of lowstate lists, one per row
+    :return: tuple of (list of chunks, list of the row of each chunk)
+    """
+    chunks = list()
+    chunk_rows = list()
+    for row, payload in zip(rows, payloads):
+        for chunk in payload:
+            chunks.append(chunk)
+            chunk_rows.append(row)
+
+    return chunks, chunk_rows
+
+
+def deploy_minion_rows(minion, rows, payloads):
+    """
+    Deploy every row targeting a single minion in one salt-api call
+    :param minion: minion targeted by all rows
+    :param rows: list of row dicts
+    :param payloads: list of lowstate lists, one per row
+    :return: list of rows updated with 'status' and 'message'
+    """
+    chunks, chunk_rows = build_minion_payload(rows, payloads)
+    salt_util = salt_utils.SaltUtil()
+    res = salt_util.deploy_payload(chunks)
+    return apply_minion_results(minion, rows, chunk_rows, res)
+
+
+def apply_minion_results(minion, rows, chunk_rows, res):
+    """
+    :param minion: minion targeted by all rows
+    :param rows: list of row dicts
+    :param chunk_rows: list of the row of each chunk, as returned by build_minion_payload
+    :param res: response text of the salt-api call
+    :return: list of rows updated with 'status' and 'message'
+    """
+    try:
+        results_json = json.loads(res)
+        returns = results_json['return']
+    except (ValueError, TypeError, KeyError) as e:
+        print('Could not load batch results from provisioner for %s' % minion)
+        print(e)
+        for row in rows:
+            row['status'] = 'failed'
+            row['message'] = 'Error deploying VM! %s' % res
+
+        return rows
+
+    for row in rows:
+        row['status'] = 'success'
+        row['message'] = 'VM Deployed Successfully on CPE: %s' % minion
+
+    for index, row in enumerate(chunk_rows):
+        if row['status'] != 'success':
+            # only report the first failed step of each row
+            continue
+
+        if index >= len(returns) or not isinstance(returns[index], dict) or minion not in returns[index]:
+            row['status'] = 'failed'
+            row['message'] = 'Error deploying VM! No result returned from %s' % minion
+            continue
+
+        success, message = job_utils.get_deploy_results_message({'return': [returns[index]]}, minion)
+        if not success:
+            row['status'] = 'failed'
+            row['message'] = message
+
+    return rows
+
+
+def place_auto_rows(rows):
+    """
+    Choose a compute node for every row with a minion of 'auto', spreading them over the nodes with the most free
+    capacity
+    :param rows: list of row dicts
+    :return: None, rows are updated in place with the chosen 'minion' and their 'placement'
+    """
+    auto_rows = [r for r in rows if 'error' not in r and r['minion'] == placement_utils.auto_minion]
+    if not auto_rows:
+        return
+
+    pending = None
+    if scheduler_utils.deploy_scheduler.enabled:
+        pending = scheduler_utils.deploy_scheduler.get_pending_counts()
+
+    try:
+        placements = placement_utils.node_placer.place(len(auto_rows), pending)
+    except placement_utils.PlacementError as pe:
+        for row in auto_rows:
+            row['error'] = str(pe)
+
+        return
+
+    for row, placement in zip(auto_rows, placements):
+        row['minion'] = placement['minion']
+        row['placement'] = placement
+
+
+def deploy_async(rows_by_minion, payloads_by_minion):
+    """
+    Send the call of every minion at once over the pooled connection of the async salt client, the batch takes as
+    long as its slowest compute node
+    :param rows_by_minion: OrderedDict of minion -> list of row dicts
+    :param payloads_by_minion: dict of minion -> list of lowstate lists, one per row
+    :return: None, rows are updated in place with 'status' and 'message'
+    """
+    minions = list(rows_by_minion.keys())
+    joined = [build_minion_payload(rows_by_minion[m], payloads_by_minion[m]) for m in minions]
+    try:
+        responses = async_salt_utils.SyncSaltUtil().deploy_payloads([chunks for chunks, chunk_rows in joined])
+    except Exception as e:
+        print('Error deploying batch')
+        print(e)
+        responses = ['Error deploying VM! %s' % e] * len(minions)
+
+    for minion, (chunks, chunk_rows), res in zip(minions, joined, responses):
+        apply_minion_results(minion, rows_by_minion[minion], chunk_rows, res)
+
+
+def queue_rows(rows_by_minion, payloads_by_minion):
+    """
+    Queue every row with the deploy scheduler, so batches are subject to the same DEPLOY_MAX_PER_MINION and
+    DEPLOY_MAX_CONCURRENT caps as single deployments. A row whose payload is already queued or building is not
+    queued again
+    :param rows_by_minion: OrderedDict of minion -> list of row dicts
+    :param payloads_by_minion: dict of minion -> list of lowstate lists, one per row
+    :return: None, rows are updated in place with 'status', 'message' and the 'request_id' of their deployment
+    """
+    for minion, rows in rows_by_minion.items():
+        for row, payload in zip(rows, payloads_by_minion[minion]):
+            # the same key as a single deployment of this payload
+            request_key = idempotency_utils.request_key('deploy', payload)
+            request = scheduler_utils.deploy_scheduler.find_active(request_key)
+            if request is None:
+                request = scheduler_utils.deploy_scheduler.enqueue(payload, minion, row['vm_name'], request_key)
+
+            if request is None:
+                row['status'] = 'failed'
+                row['message'] = 'Error deploying VM! Could not queue the deployment'
+                continue
+
+            row['status'] = 'queued'
+            row['message'] = 'Queued as deployment request %s' % request.id
+            row['request_id'] = request.id
+
+
+def deploy_batch(rows, common_context):
+    """
+    Deploy many firewalls at once. With the deploy scheduler enabled every row is queued with it. Otherwise rows
+    are grouped by minion so each compute node receives a single salt call, and the per minion calls run
+    concurrently on the async salt client, or on a bounded thread pool without it
+    :param rows: list of row dicts as returned by parse_deployment_rows
+    :param common_context: values shared by all rows
+    :return: list of all rows, in their original order, updated with 'status' and 'message'
+    """
+    service = snippet_registry.load_snippet('provision_firewall')
+    place_auto_rows(rows)
+    check_duplicate_rows(rows)
+
+    rows_by_minion = OrderedDict()
+    payloads_by_minion = dict()
+    for row in rows:
+        if 'error' in row:
+            row['status'] = 'failed'
+            row['message'] = row['error']
+            continue
+
+        try:
+            payload = render_row_payload(service, common_context, row)
+        except ValueError as ve:
+            print('Could not render payload for %s' % row['vm_name'])
+            print(ve)
+            row['status'] = 'failed'
+            row['message'] = 'Could not render deployment payload'
+            continue
+
+        rows_by_minion.setdefault(row['minion'], list()).append(row)
+        payloads_by_minion.setdefault(row['minion'], list()).append(payload)
+
+    if rows_by_minion and scheduler_utils.deploy_scheduler.enabled:
+        queue_rows(rows_by_minion, payloads_by_minion)
+    elif rows_by_minion and async_salt_utils.is_available():
+        deploy_async(rows_by_minion, payloads_by_minion)
+    elif rows_by_minion:
+        max_workers = get_int_config_value('BATCH_DEPLOY_WORKERS', 8)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = dict()
+            for minion in rows_by_minion:
+                futures[minion] = executor.submit(deploy_minion_rows, minion, rows_by_minion[minion],
+                                                  payloads_by_minion[minion])
+
+            for minion, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    print('Error deploying batch to %s' % minion)
+                    print(e)
+                    for row in rows_by_minion[minion]:
+                        row['status'] = 'failed'
+                        row['message'] = 'Error deploying VM! %s' % e
+
+    for row in rows:
+        if 'placement' in row:
+            row['message'] += '\nPlaced automatically: %s, room for %s more firewalls' % (
+                row['placement']['summary'], row['placement']['headroom'])
+
+    return rows
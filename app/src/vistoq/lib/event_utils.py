@@ -0,0 +1,387 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import json
+import threading
+import time
+import uuid
+from collections import deque
+
+from pan_cnc.lib import cnc_utils
+from requests.exceptions import RequestException
+
+from vistoq.lib import inventory_utils
+from vistoq.lib import job_utils
+from vistoq.lib import metrics
+from vistoq.lib import salt_utils
+from vistoq.lib.cache_utils import get_int_config_value
+
+# libvirt lifecycle events and the virt.vm_state value they leave the domain in, None means the domain is gone
+libvirt_states = {
+    'defined': 'shutdown',
+    'started': 'running',
+    'resumed': 'running',
+    'suspended': 'paused',
+    'stopped': 'shutdown',
+    'shutdown': 'shutdown',
+    'crashed': 'crashed',
+    'pmsuspended': 'paused',
+    'undefined': None,
+}
+
+
+def parse_event_stream(lines):
+    """
+    Parse the server sent events stream of salt-api /events
+    :param lines: iterable of lines as returned by requests.Response.iter_lines
+    :return: generator of event dicts with 'tag' and 'data' keys
+    """
+    tag = ''
+    data_lines = list()
+    for line in lines:
+        if line is None:
+            continue
+
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+
+        if line == '':
+            if data_lines:
+                try:
+                    event = json.loads('\n'.join(data_lines))
+                except ValueError:
+                    event = None
+
+                if isinstance(event, dict):
+                    event.setdefault('tag', tag)
+                    event.setdefault('data', dict())
+                    yield event
+
+            tag = ''
+            data_lines = list()
+            continue
+
+        if line.startswith(':'):
+            # comment, used as keepalive
+            continue
+
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+
+        if field == 'tag':
+            tag = value
+        elif field == 'data':
+            data_lines.append(value)
+
+
+class VmStateTable():
+    """
+    In memory table of the state of every VM on every compute node, kept current from the salt event bus. Every
+    change gets an increasing id so polling clients can catch up on changes. Ids are only meaningful in this
+    process, cursors handed out to clients carry the epoch of the table so they are not used on another worker
+    """
+    max_changes = 1000
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.version = 0
+        self._vms = dict()
+        self._seeded = dict()
+        self._changes = deque(maxlen=self.max_changes)
+        self._condition = threading.Condition()
+
+    def _add_change(self, change):
+        # called with self._condition held
+        self.version += 1
+        change['id'] = self.version
+        self._changes.append(change)
+        self._condition.notify_all()
+
+    def _set(self, minion, hostname, status):
+        # called with self._condition held
+        minion_vms = self._vms.setdefault(minion, dict())
+        if status is None:
+            if hostname in minion_vms:
+                del minion_vms[hostname]
+                self._add_change({'type': 'vm', 'minion': minion, 'hostname': hostname, 'status': 'removed'})
+        elif minion_vms.get(hostname, None) != status:
+            minion_vms[hostname] = status
+            self._add_change({'type': 'vm', 'minion': minion, 'hostname': hostname, 'status': status})
+
+    def set_minion_vms(self, minion, vms):
+        """
+        Replace the VMs of a minion with a full snapshot, such as the return of virt.vm_state
+        :param minion: minion id
+        :param vms: dict of hostname -> state
+        :return: None
+        """
+        with self._condition:
+            for hostname in list(self._vms.get(minion, dict()).keys()):
+                if hostname not in vms:
+                    self._set(minion, hostname, None)
+
+            for hostname, status in vms.items():
+                self._set(minion, hostname, str(status))
+
+            self._seeded[minion] = time.time()
+
+    def set_vm(self, minion, hostname, status):
+        """
+        :param minion: minion id
+        :param hostname: VM hostname
+        :param status: new state of the VM or None when it was removed
+        :return: None
+        """
+        with self._condition:
+            self._set(minion, hostname, status)
+
+    def clear_minion(self, minion):
+        self.set_minion_vms(minion, dict())
+
+    def job_returned(self, jid, minion, status):
+        with self._condition:
+            self._add_change({'type': 'job', 'jid': jid, 'minion': minion, 'status': status})
+
+    def get_vms(self, minion):
+        """
+        :param minion: minion id
+        :return: list of dicts with 'hostname' and 'status' keys or None if the minion has not been seen yet
+        """
+        with self._condition:
+            if minion not in self._seeded:
+                return None
+
+            minion_vms = self._vms.get(minion, dict())
+            return [{'hostname': h, 'status': minion_vms[h]} for h in sorted(minion_vms)]
+
+    def changes_since(self, version):
+        """
+        :param version: id of the last change a client has seen
+        :return: list of change dicts after that version or None if some of them are no longer kept
+        """
+        with self._condition:
+            if version > self.version:
+                return None
+
+            if version < self.version and (not self._changes or self._changes[0]['id'] > version + 1):
+                return None
+
+            return [c for c in self._changes if c['id'] > version]
+
+    def get_changes(self, cursor):
+        """
+        :param cursor: cursor returned by an earlier call, or '' for a first call
+        :return: tuple of (cursor to pass next time, list of change dicts after the cursor or None when the client
+        has to start over from a snapshot)
+        """
+        epoch, _, version = str(cursor).partition('-')
+        with self._condition:
+            current = '%s-%s' % (self.epoch, self.version)
+            if epoch != self.epoch or not version.isdigit():
+                return current, None
+
+            return current, self.changes_since(int(version))
+
+
+vm_state_table = VmStateTable()
+
+
+class SaltEventConsumer():
+    """
+    Background consumer of the salt-api /events stream. Job returns, beacons and libvirt events are applied to
+    the VM state table so pages no longer have to poll the hypervisors, and deployment jobs are completed as soon
+    as their return is published. The table is seeded with one virt.vm_state call when the stream connects
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.enabled = str(cnc_utils.get_config_value('SALT_EVENTS_ENABLED', 'true')).lower() == 'true'
+        self.read_timeout = get_int_config_value('SALT_EVENTS_READ_TIMEOUT', 300)
+        # reseed from the hypervisors at least this often in case events were lost
+        self.reseed_interval = get_int_config_value('SALT_EVENTS_RESEED', 3600)
+        self.connected = False
+        self._last_seed = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """
+        Start the consumer thread of this process if it is enabled and not running yet
+        :return: None
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            self._thread = threading.Thread(target=self._run, name='salt-event-consumer', daemon=True)
+            self._thread.start()
+
+    def is_current(self, minion):
+        """
+        :return: True when the table holds live data for this minion
+        """
+        return self.connected and self.table.get_vms(minion) is not None
+
+    def _run(self):
+        backoff = 1
+        disconnected = None
+        while True:
+            salt_util = salt_utils.SaltUtil()
+            res = salt_util.open_event_stream(self.read_timeout)
+            if res is None:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+
+            print('Connected to the salt event stream')
+            backoff = 1
+            self.connected = True
+            try:
+                # an idle stream times out and reconnects right away without losing anything worth a reseed
+                if disconnected is None or time.time() - disconnected > 5 or \
+                        time.time() - self._last_seed > self.reseed_interval:
+                    self._seed()
+
+                for event in parse_event_stream(res.iter_lines(decode_unicode=True)):
+                    try:
+                        self.handle_event(event)
+                    except Exception as e:
+                        print('Could not handle salt event %s' % event.get('tag', ''))
+                        print(e)
+
+            except RequestException as re:
+                print('Salt event stream disconnected: %s' % re)
+            finally:
+                self.connected = False
+                disconnected = time.time()
+                res.close()
+                metrics.registry.inc('vistoq_salt_event_reconnects_total',
+                                     help_text='Reconnects to the salt-api event stream')
+
+    def _seed(self):
+        index = inventory_utils.fleet_inventory.load_index('*', 'glob')
+        if index is None:
+            print('Could not seed the VM state table')
+            return
+
+        fleet = {minion: dict() for minion in index['minions']}
+        for vm in index['vms']:
+            fleet[vm['minion']][vm['hostname']] = vm['status']
+
+        for minion, vms in fleet.items():
+            self.table.set_minion_vms(minion, vms)
+
+        self._last_seed = time.time()
+
+    def handle_event(self, event):
+        """
+        Apply a single salt event to the VM state table
+        :param event: dict with 'tag' and 'data' keys
+        :return: None
+        """
+        tag = event.get('tag', '')
+        data = event.get('data', dict())
+        if not isinstance(data, dict):
+            return
+
+        if tag.startswith('salt/job/') and '/ret/' in tag:
+            event_type = 'job_return'
+            self._handle_return(data)
+        elif tag.startswith('salt/beacon/'):
+            event_type = 'beacon'
+            self._handle_beacon(tag, data)
+        elif 'libvirt_events' in tag:
+            event_type = 'libvirt'
+            self._handle_libvirt(data)
+        else:
+            event_type = 'other'
+
+        metrics.registry.inc('vistoq_salt_events_total', {'type': event_type},
+                             help_text='Events received from the salt-api event stream')
+
+    @staticmethod
+    def _get_pillar(fun_args):
+        for arg in fun_args:
+            if isinstance(arg, dict) and isinstance(arg.get('pillar', None), dict):
+                return arg['pillar']
+
+        return dict()
+
+    def _handle_return(self, data):
+        minion = data.get('id', '')
+        fun = data.get('fun', '')
+        ret = data.get('return', None)
+        fun_args = data.get('fun_args', None) or list()
+        if minion == '':
+            return
+
+        if fun == 'virt.vm_state' and isinstance(ret, dict):
+            if any(isinstance(a, str) for a in fun_args):
+                # state of named VMs only
+                for hostname, status in ret.items():
+                    self.table.set_vm(minion, hostname, str(status))
+            else:
+                self.table.set_minion_vms(minion, ret)
+
+            return
+
+        if fun != 'state.apply' or not fun_args or not isinstance(fun_args[0], str):
+            return
+
+        success, comment = job_utils.check_state_return(ret)
+        state = fun_args[0]
+        pillar = self._get_pillar(fun_args)
+        if success:
+            if state == 'create_ngfw' and pillar.get('vm_name', ''):
+                self.table.set_vm(minion, pillar['vm_name'], 'running')
+            elif state == 'delete_all_ngfw':
+                hostnames = pillar.get('hostnames', None) or [pillar.get('hostname', '')]
+                for hostname in hostnames:
+                    if hostname:
+                        self.table.set_vm(minion, hostname, None)
+            elif state == 'delete_all_vms':
+                self.table.clear_minion(minion)
+
+        jid = data.get('jid', '')
+        if jid:
+            job_utils.job_tracker.record_return(jid, minion, ret)
+            self.table.job_returned(jid, minion, 'success' if success else 'failed')
+
+    def _handle_beacon(self, tag, data):
+        # salt/beacon/<minion>/virt/...
+        parts = tag.split('/')
+        if len(parts) < 4 or parts[3] != 'virt':
+            return
+
+        minion = data.get('id', parts[2])
+        if isinstance(data.get('vms', None), dict):
+            self.table.set_minion_vms(minion, data['vms'])
+        elif data.get('vm', '') and data.get('status', ''):
+            self.table.set_vm(minion, data['vm'], data['status'])
+
+    def _handle_libvirt(self, data):
+        minion = data.get('id', '')
+        domain = data.get('domain', None)
+        event = str(data.get('event', '')).lower()
+        if minion == '' or not isinstance(domain, dict) or 'name' not in domain or event not in libvirt_states:
+            return
+
+        self.table.set_vm(minion, domain['name'], libvirt_states[event])
+
+
+event_consumer = SaltEventConsumer(vm_state_table)
@@ -0,0 +1,458 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import json
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.db import transaction
+from django.db.models.functions import Substr
+from django.utils import timezone
+
+from vistoq.lib import job_utils
+from vistoq.lib import metrics
+from vistoq.lib import operator_utils
+from vistoq.lib import salt_utils
+from vistoq.lib.cache_utils import get_int_config_value
+from vistoq.models import Deployment
+from vistoq.models import DeploymentStep
+
+deploy_function = 'state.apply create_ngfw'
+
+# fields the history can be searched on by exact value, each has an index on (field, created)
+search_fields = ('operator', 'minion', 'function', 'outcome', 'jid')
+
+
+def get_target_names(lowstate):
+    """
+    :param lowstate: salt lowstate dict
+    :return: list of the VM names a call acts on according to its pillar, [''] for calls on the whole node
+    """
+    pillar = (lowstate.get('kwarg', None) or dict()).get('pillar', None) or dict()
+    if isinstance(pillar.get('hostnames', None), list) and pillar['hostnames']:
+        return [str(h) for h in pillar['hostnames']]
+
+    for key in ('vm_name', 'hostname'):
+        if pillar.get(key, ''):
+            return [str(pillar[key])]
+
+    return ['']
+
+
+def get_elapsed(started, finished):
+    if started is None:
+        return None
+
+    return (finished - started).total_seconds() * 1000
+
+
+def record_deployment(minion, vm_name, state_return, jid='', message='', function=deploy_function, operator=None,
+                      started=None):
+    """
+    Persist the full per step result of a state.apply call. A record of the same job saved when it was submitted
+    is completed instead of adding a new one
+    :param minion: minion the state ran on
+    :param vm_name: name of the VM the state acted on
+    :param state_return: state.apply return for this minion
+    :param jid: salt job id, if known
+    :param message: results message shown to the operator
+    :param function: salt function label, such as 'state.apply create_ngfw'
+    :param operator: user who ran the call, defaults to the operator of the current thread
+    :param started: time the call was sent
+    :return: Deployment or None if it could not be saved
+    """
+    steps = job_utils.get_state_steps(state_return)
+    success, comment = job_utils.check_state_return(state_return)
+    durations = [s['duration'] for s in steps if s.get('duration', None) is not None]
+    finished = timezone.now()
+
+    try:
+        with transaction.atomic():
+            deployment = None
+            if jid:
+                deployment = Deployment.objects.filter(jid=jid, minion=minion, outcome=Deployment.RUNNING).first()
+
+            if deployment is None:
+                deployment = Deployment(minion=minion, vm_name=vm_name[:255], jid=jid or '', function=function[:255],
+                                        started=started)
+                deployment.operator = operator_utils.get_operator() if operator is None else operator
+
+            deployment.success = success
+            deployment.outcome = Deployment.SUCCESS if success else Deployment.FAILED
+            deployment.message = message or comment
+            deployment.duration = sum(durations) if durations else None
+            deployment.finished = finished
+            deployment.elapsed = get_elapsed(deployment.started, finished)
+            deployment.save()
+
+            step_models = list()
+            for step in steps:
+                step_models.append(DeploymentStep(
+                    deployment=deployment,
+                    minion=minion,
+                    state=step['step'][:255],
+                    name=step.get('name', step['step'])[:255],
+                    run_num=step.get('run_num', 0),
+                    result=step['result'] if isinstance(step['result'], bool) else None,
+                    comment=str(step['comment']),
+                    duration=step.get('duration', None),
+                    start_time=str(step.get('start_time', None) or '')
+                ))
+
+            DeploymentStep.objects.bulk_create(step_models)
+
+        return deployment
+
+    except DatabaseError as de:
+        print('Could not record deployment of %s on %s' % (vm_name, minion))
+        print(de)
+        return None
+
+
+def get_call_message(function, minion, ret):
+    """
+    :param function: salt function label
+    :param minion: minion that returned
+    :param ret: return of the minion
+    :return: tuple of (success, message) summarizing the return
+    """
+    if function == deploy_function:
+        return job_utils.get_deploy_results_message({'return': [{minion: ret}]}, minion)
+
+    if function.startswith('state.apply'):
+        success, comment = job_utils.check_state_return(ret)
+        if success:
+            return True, '%s completed on %s' % (function, minion)
+
+        return False, comment
+
+    if ret is None or ret is False:
+        return False, 'No result from %s' % minion
+
+    if isinstance(ret, dict):
+        # i.e. virt.vm_state returns the state of every VM
+        return True, json.dumps(ret, sort_keys=True, default=str)
+
+    return True, str(ret)
+
+
+def record_salt_call(payload, response, started, operator=None):
+    """
+    Record the result of a salt call made through SaltUtil.deploy_payload, one record per minion and VM
+    :param payload: list of salt lowstate dicts
+    :param response: response text from the provisioner
+    :param started: time the call was sent
+    :param operator: user who ran the call, defaults to the operator of the current thread
+    :return: list of saved Deployment records
+    """
+    if operator is None:
+        operator = operator_utils.get_operator()
+
+    returns = None
+    try:
+        returns = json.loads(response)['return']
+    except (ValueError, TypeError, KeyError):
+        pass
+
+    finished = timezone.now()
+    records = list()
+    for index, lowstate in enumerate(payload):
+        function = salt_utils.SaltUtil.get_request_labels('/', [lowstate])['function']
+        names = get_target_names(lowstate)
+        ret = None
+        if isinstance(returns, list) and index < len(returns) and isinstance(returns[index], dict):
+            ret = returns[index]
+
+        if ret is None:
+            tgt = lowstate.get('tgt', '')
+            for minion in (tgt if isinstance(tgt, list) else [str(tgt)]):
+                for name in names:
+                    records.append(Deployment(minion=minion, vm_name=name[:255], function=function[:255],
+                                              operator=operator, outcome=Deployment.ERROR, started=started,
+                                              finished=finished, elapsed=get_elapsed(started, finished),
+                                              message='No result from the provisioner: %s' % str(response)[:1000]))
+            continue
+
+        for minion, minion_ret in ret.items():
+            success, message = get_call_message(function, minion, minion_ret)
+            for name in names:
+                if lowstate.get('fun', '') == 'state.apply':
+                    deployment = record_deployment(minion, name, minion_ret, message=message, function=function,
+                                                   operator=operator, started=started)
+                    if deployment is not None:
+                        metrics.registry.inc('vistoq_history_records_total', {'outcome': deployment.outcome},
+                                             help_text='Salt calls recorded in the deployment history')
+
+                    continue
+
+                records.append(Deployment(minion=minion, vm_name=name[:255], function=function[:255],
+                                          operator=operator, success=success,
+                                          outcome=Deployment.SUCCESS if success else Deployment.FAILED,
+                                          started=started, finished=finished, elapsed=get_elapsed(started, finished),
+                                          message=message))
+
+    try:
+        Deployment.objects.bulk_create(records)
+    except DatabaseError as de:
+        print('Could not record salt call %s' % (payload[0].get('fun', '') if payload else ''))
+        print(de)
+        return list()
+
+    for record in records:
+        metrics.registry.inc('vistoq_history_records_total', {'outcome': record.outcome},
+                             help_text='Salt calls recorded in the deployment history')
+
+    maybe_compact()
+    return records
+
+
+def record_submission(payload, jid, started, operator=None):
+    """
+    Record async jobs when they are submitted, the job tracker completes the records when the jobs return
+    :param payload: list of salt lowstate dicts
+    :param jid: salt job id
+    :param started: time the job was submitted
+    :param operator: user who submitted the job, defaults to the operator of the current thread
+    :return: list of saved Deployment records
+    """
+    if operator is None:
+        operator = operator_utils.get_operator()
+
+    records = list()
+    for lowstate in payload:
+        function = salt_utils.SaltUtil.get_request_labels('/', [lowstate])['function']
+        tgt = lowstate.get('tgt', '')
+        for minion in (tgt if isinstance(tgt, list) else [str(tgt)]):
+            for name in get_target_names(lowstate):
+                records.append(Deployment(minion=minion, vm_name=name[:255], jid=jid, function=function[:255],
+                                          operator=operator, outcome=Deployment.RUNNING, started=started,
+                                          message='Job submitted to the provisioner'))
+
+    try:
+        Deployment.objects.bulk_create(records)
+    except DatabaseError as de:
+        print('Could not record salt job %s' % jid)
+        print(de)
+        return list()
+
+    maybe_compact()
+    return records
+
+
+def record_job_timeout(jid, message):
+    """
+    Close the records of a submitted job that never returned
+    :param jid: salt job id
+    :param message: reason shown in the history
+    :return: None
+    """
+    try:
+        Deployment.objects.filter(jid=jid, outcome=Deployment.RUNNING).update(outcome=Deployment.ERROR,
+                                                                             message=message,
+                                                                             finished=timezone.now())
+    except DatabaseError as de:
+        print('Could not record timeout of salt job %s' % jid)
+        print(de)
+
+
+def _delete_in_batches(queryset, batch_size=1000):
+    deleted = 0
+    while True:
+        ids = list(queryset.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+
+        with transaction.atomic():
+            DeploymentStep.objects.filter(deployment_id__in=ids).delete()
+            Deployment.objects.filter(id__in=ids).delete()
+
+        deleted += len(ids)
+
+
+def compact_history(batch_size=1000):
+    """
+    Keep the deployment history bounded. Records older than HISTORY_RETENTION_DAYS and those beyond the newest
+    HISTORY_MAX_ROWS are removed, records older than HISTORY_COMPACT_DAYS lose their steps and keep only the start
+    of their message
+    :param batch_size: number of records changed per transaction, to keep locks short
+    :return: dict with the number of 'removed' and 'compacted' records
+    """
+    retention_days = get_int_config_value('HISTORY_RETENTION_DAYS', 180)
+    compact_days = get_int_config_value('HISTORY_COMPACT_DAYS', 30)
+    max_rows = get_int_config_value('HISTORY_MAX_ROWS', 100000)
+    now = timezone.now()
+
+    removed = _delete_in_batches(Deployment.objects.filter(created__lt=now - timedelta(days=retention_days)),
+                                 batch_size)
+    if max_rows > 0:
+        cutoff = list(Deployment.objects.order_by('-id').values_list('id', flat=True)[max_rows:max_rows + 1])
+        if cutoff:
+            removed += _delete_in_batches(Deployment.objects.filter(id__lte=cutoff[0]), batch_size)
+
+    compacted = 0
+    old = Deployment.objects.filter(created__lt=now - timedelta(days=compact_days), compacted=False).exclude(
+        outcome=Deployment.RUNNING)
+    while True:
+        ids = list(old.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+
+        with transaction.atomic():
+            DeploymentStep.objects.filter(deployment_id__in=ids).delete()
+            Deployment.objects.filter(id__in=ids).update(compacted=True, message=Substr('message', 1, 500))
+
+        compacted += len(ids)
+
+    metrics.registry.inc('vistoq_history_compacted_total', {'action': 'removed'}, removed,
+                         help_text='Deployment history records removed or compacted')
+    metrics.registry.inc('vistoq_history_compacted_total', {'action': 'compacted'}, compacted,
+                         help_text='Deployment history records removed or compacted')
+    return {'removed': removed, 'compacted': compacted}
+
+
+def maybe_compact():
+    """
+    Compact the history on a background thread, at most once every HISTORY_COMPACT_INTERVAL seconds across all
+    workers
+    :return: None
+    """
+    interval = get_int_config_value('HISTORY_COMPACT_INTERVAL', 3600)
+    if interval <= 0 or not cache.add('vistoq.history.compact', 1, interval):
+        return
+
+    def compact():
+        try:
+            compact_history()
+        except DatabaseError as de:
+            print('Could not compact the deployment history')
+            print(de)
+
+    threading.Thread(target=compact, name='history-compact', daemon=True).start()
+
+
+def search_deployments(vm_name='', since=None, until=None, **filters):
+    """
+    Search the deployment history from the database alone, without asking the compute nodes
+    :param vm_name: VM name or the start of it
+    :param since: only records created at or after this datetime
+    :param until: only records created before this datetime
+    :param filters: exact values of the search_fields, empty values are ignored
+    :return: queryset of Deployment records, newest first
+    """
+    deployments = Deployment.objects.all()
+    for field in search_fields:
+        value = filters.get(field, '')
+        if value:
+            deployments = deployments.filter(**{field: value})
+
+    if vm_name:
+        deployments = deployments.filter(vm_name__startswith=vm_name)
+
+    if since is not None:
+        deployments = deployments.filter(created__gte=since)
+
+    if until is not None:
+        deployments = deployments.filter(created__lt=until)
+
+    return deployments.order_by('-created', '-id')
+
+
+def percentile(sorted_values, pct):
+    """
+    Nearest rank percentile
+    :param sorted_values: list of numbers sorted in ascending order
+    :param pct: percentile between 0 and 100
+    :return: value at the percentile or None for an empty list
+    """
+    if not sorted_values:
+        return None
+
+    rank = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+def summarize(values):
+    values = sorted(values)
+    summary = dict()
+    summary['count'] = len(values)
+    summary['p50'] = percentile(values, 50)
+    summary['p95'] = percentile(values, 95)
+    summary['max'] = values[-1] if values else None
+    return summary
+
+
+def get_deployment_stats(days=30, minion=''):
+    """
+    Calculate p50 / p95 durations per state step, per compute node and per compute node per day
+    :param days: number of days of history to include
+    :param minion: only include deployments on this minion when set
+    :return: dict with 'steps', 'minions' and 'daily' lists
+    """
+    since = timezone.now() - timedelta(days=days)
+
+    # the history also holds deletes and VM listings
+    steps_qs = DeploymentStep.objects.filter(created__gte=since, duration__isnull=False,
+                                             deployment__function=deploy_function)
+    deployments_qs = Deployment.objects.filter(created__gte=since, duration__isnull=False, function=deploy_function)
+    if minion != '':
+        steps_qs = steps_qs.filter(minion=minion)
+        deployments_qs = deployments_qs.filter(minion=minion)
+
+    step_durations = OrderedDict()
+    step_node_durations = OrderedDict()
+    for name, step_minion, duration in steps_qs.order_by('name').values_list('name', 'minion', 'duration'):
+        step_durations.setdefault(name, list()).append(duration)
+        step_node_durations.setdefault((name, step_minion), list()).append(duration)
+
+    minion_durations = OrderedDict()
+    daily_durations = OrderedDict()
+    for deploy_minion, created, duration in deployments_qs.order_by('created').values_list('minion', 'created',
+                                                                                          'duration'):
+        minion_durations.setdefault(deploy_minion, list()).append(duration)
+        day = created.date().isoformat()
+        daily_durations.setdefault((day, deploy_minion), list()).append(duration)
+
+    stats = dict()
+    stats['days'] = days
+    stats['minion'] = minion
+    stats['steps'] = list()
+    for name, durations in step_durations.items():
+        summary = summarize(durations)
+        summary['name'] = name
+        stats['steps'].append(summary)
+
+    stats['step_nodes'] = list()
+    for (name, step_minion), durations in step_node_durations.items():
+        summary = summarize(durations)
+        summary['name'] = name
+        summary['minion'] = step_minion
+        stats['step_nodes'].append(summary)
+
+    stats['minions'] = list()
+    for deploy_minion in sorted(minion_durations):
+        summary = summarize(minion_durations[deploy_minion])
+        summary['minion'] = deploy_minion
+        stats['minions'].append(summary)
+
+    stats['daily'] = list()
+    for (day, deploy_minion), durations in daily_durations.items():
+        summary = summarize(durations)
+        summary['day'] = day
+        summary['minion'] = deploy_minion
+        stats['daily'].append(summary)
+
+    return stats
@@ -0,0 +1,139 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import hashlib
+import json
+import time
+
+from django.core.cache import cache
+
+from vistoq.lib import metrics
+from vistoq.lib.cache_utils import get_int_config_value
+
+
+def request_key(action, *parts):
+    """
+    Build the idempotency key of a request
+    :param action: kind of request such as 'deploy' or 'delete'
+    :param parts: anything json serializable identifying the request, such as the rendered salt payload or an
+    idempotency token sent by the client
+    :return: key string
+    """
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return '%s.%s' % (action, digest)
+
+
+def status_link(key):
+    """
+    Link to the page showing the progress and result of a request, duplicates are sent there instead of waiting
+    :param key: idempotency key as returned by request_key
+    :return: url path
+    """
+    return '/vistoq/request_status/%s' % key
+
+
+class IdempotencyGuard():
+    """
+    Suppress duplicate submissions of the same request, such as a double click on the deploy form or a browser
+    retry. The first request claims the key in the django cache and runs, identical requests arriving while it is
+    in flight wait a few seconds for its result and are otherwise sent to its status page instead of starting new
+    salt work. A finished request only suppresses identical ones for IDEMPOTENCY_RESULT_TTL seconds, so a VM can be
+    deleted and deployed again right away, while its result stays on the status page for status_ttl seconds
+    """
+    cache_prefix = 'vistoq.idempotency.'
+    status_prefix = 'vistoq.idempotency_status.'
+    poll_interval = 1
+    # failed results are kept just long enough for waiting duplicates to pick them up
+    failure_ttl = 5
+    # seconds a duplicate holds its request worker waiting for the original before it is sent to the status page
+    duplicate_wait = 5
+    status_ttl = 3600
+
+    def __init__(self):
+        self.result_ttl = get_int_config_value('IDEMPOTENCY_RESULT_TTL', 10)
+
+    def run(self, key, fn, pending_ttl=600, wait_timeout=None, succeeded=None):
+        """
+        Run fn unless an identical request is already in flight or finished a moment ago
+        :param key: idempotency key as returned by request_key
+        :param fn: function doing the work, it returns a picklable result or None if there is nothing to report
+        :param succeeded: function telling from a result whether the request succeeded. Failed requests are not
+        remembered so they can be retried
+        :param pending_ttl: seconds a claim is held in case the worker running fn dies
+        :param wait_timeout: seconds a duplicate waits for the original result, defaults to duplicate_wait
+        :return: tuple of (result, duplicate). The result of a duplicate is None when the original is still running
+        or did not complete, the caller sends it to status_link(key) then
+        """
+        record_key = self.cache_prefix + key
+        if cache.add(record_key, {'status': 'pending', 'started': time.time()}, pending_ttl):
+            metrics.registry.inc('vistoq_idempotent_requests_total', {'outcome': 'original'},
+                                 help_text='Requests run or suppressed as duplicates by the idempotency guard')
+            # the status page must not show the result of an earlier run of the same request
+            cache.delete(self.status_prefix + key)
+            try:
+                result = fn()
+            except Exception:
+                cache.delete(record_key)
+                raise
+
+            if result is None:
+                cache.delete(record_key)
+            else:
+                record = {'status': 'done', 'result': result, 'finished': time.time()}
+                ttl = self.result_ttl if succeeded is None or succeeded(result) else self.failure_ttl
+                cache.set(record_key, record, ttl)
+                cache.set(self.status_prefix + key, record, self.status_ttl)
+
+            return result, False
+
+        metrics.registry.inc('vistoq_idempotent_requests_total', {'outcome': 'duplicate'},
+                             help_text='Requests run or suppressed as duplicates by the idempotency guard')
+        print('Attaching duplicate request %s to the original' % key)
+        deadline = time.time() + (self.duplicate_wait if wait_timeout is None else wait_timeout)
+        while True:
+            record = self.status(key)
+            if record is None:
+                return None, True
+
+            if record['status'] == 'done':
+                return record['result'], True
+
+            if time.time() > deadline:
+                return None, True
+
+            time.sleep(self.poll_interval)
+
+    def status(self, key):
+        """
+        Get the state of a request for its status page
+        :param key: idempotency key
+        :return: dict with a 'status' of 'pending' and the 'started' time, or of 'done' with the 'result'. None
+        when the request is unknown, did not complete or its result expired
+        """
+        record = cache.get(self.cache_prefix + key)
+        if record is not None and record['status'] == 'pending':
+            return record
+
+        return cache.get(self.status_prefix + key)
+
+    def forget(self, key):
+        """
+        Drop a remembered result, so the next identical request runs again
+        :param key: idempotency key
+        :return: None
+        """
+        cache.delete(self.cache_prefix + key)
+
+
+guard = IdempotencyGuard()
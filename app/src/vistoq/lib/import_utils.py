@@ -0,0 +1,65 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import importlib
+import threading
+
+
+class LazyModule():
+    """
+    Stand in for a module that is only imported the first time one of its attributes is used. Import through
+    importlib is thread safe, so concurrent first uses end up with the same module
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return '<lazy module %s (%s)>' % (self._name, state)
+
+
+def lazy_import(name):
+    """
+    Defer importing a module until it is used, so pages and management commands that never need it do not pay
+    for importing it
+    :param name: full module name such as 'pan.xapi'
+    :return: LazyModule
+    """
+    return LazyModule(name)
+
+
+def resolve(module):
+    """
+    Import a lazy module right away
+    :param module: LazyModule or module
+    :return: the imported module
+    """
+    if isinstance(module, LazyModule):
+        return module._load()
+
+    return module
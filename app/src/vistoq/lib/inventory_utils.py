@@ -0,0 +1,309 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from vistoq.lib import salt_utils
+from vistoq.lib.cache_utils import BackgroundRefreshCache
+from vistoq.lib.cache_utils import get_int_config_value
+from vistoq.lib.snippet_registry import snippet_registry
+
+
+class MinionInventory():
+    """
+    Shared inventory of the compute nodes (salt minions) known to the provisioner. The minion list is cached with a
+    configurable TTL and refreshed in the background so page renders do not wait on salt-api. The sorted
+    choices tuple used by the minion ChoiceField is computed once per refresh
+    """
+
+    def __init__(self):
+        ttl = get_int_config_value('MINION_CACHE_TTL', 60)
+        max_stale = get_int_config_value('MINION_CACHE_MAX_STALE', 600)
+        self._cache = BackgroundRefreshCache('minion_inventory', self._load, ttl=ttl, max_stale=max_stale)
+
+    @staticmethod
+    def _load():
+        salt_util = salt_utils.SaltUtil()
+        minion_list = salt_util.get_minion_list()
+        if not minion_list:
+            # get_minion_list returns an empty list on any error, do not replace a good inventory with it
+            return None
+
+        # we need to construct a new ChoiceField with the following basic format
+        # snippet_name = forms.ChoiceField(choices=(('gold', 'Gold'), ('silver', 'Silver'), ('bronze', 'Bronze')))
+        choices_list = list()
+        for minion in minion_list:
+            minion_label = minion.split('.')[0]
+            choices_list.append((minion, minion_label))
+
+        # let's sort the list by the label attribute (index 1 in the tuple)
+        choices_list = sorted(choices_list, key=lambda k: k[1])
+
+        inventory = dict()
+        inventory['minions'] = sorted(minion_list)
+        inventory['choices'] = tuple(choices_list)
+        return inventory
+
+    def get_minions(self):
+        """
+        :return: sorted list of minion ids
+        """
+        inventory = self._cache.get()
+        if inventory is None:
+            return list()
+
+        return list(inventory['minions'])
+
+    def get_choices(self):
+        """
+        :return: tuple of (minion, label) tuples sorted by label, suitable for a forms.ChoiceField
+        """
+        inventory = self._cache.get()
+        if inventory is None:
+            return tuple()
+
+        return inventory['choices']
+
+    def refresh(self, wait=True):
+        return self._cache.refresh(wait=wait)
+
+    def invalidate(self):
+        self._cache.invalidate()
+
+
+minion_inventory = MinionInventory()
+
+
+class FleetVmInventory():
+    """
+    Inventory of the VMs deployed across all compute nodes. A single virt.vm_state call targets every minion matching
+    a glob or list and the result is flattened into an indexed table of VMs. Results are cached for a short time per
+    target so repeated page loads do not query every hypervisor again. Targets come from the fleet VMs page, so only
+    the FLEET_CACHE_MAX_TARGETS most recently used ones keep a cache
+    """
+    snippet = 'show_deployed_vms_on_fleet'
+
+    def __init__(self):
+        self.ttl = get_int_config_value('FLEET_CACHE_TTL', 30)
+        self.max_stale = get_int_config_value('FLEET_CACHE_MAX_STALE', 60)
+        self.max_targets = get_int_config_value('FLEET_CACHE_MAX_TARGETS', 32)
+        # target key -> BackgroundRefreshCache, least recently used first
+        self._caches = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize_target(target, tgt_type):
+        """
+        Spell a target the same way however it was typed, so equivalent targets share a cache
+        :param target: salt target
+        :param tgt_type: 'glob' or 'list'
+        :return: target without whitespace, lists sorted and without duplicates
+        """
+        if tgt_type == 'list':
+            return ','.join(sorted(set(minion.strip() for minion in target.split(',') if minion.strip())))
+
+        return target.strip()
+
+    def _get_cache(self, target, tgt_type):
+        target = self.normalize_target(target, tgt_type) or '*'
+        key = '%s:%s' % (tgt_type, target)
+        with self._lock:
+            if key in self._caches:
+                self._caches.move_to_end(key)
+                return self._caches[key]
+
+            def loader():
+                return self._load(target, tgt_type)
+
+            self._caches[key] = BackgroundRefreshCache('fleet_vms.%s' % key, loader, ttl=self.ttl,
+                                                       max_stale=self.max_stale)
+            while len(self._caches) > max(self.max_targets, 1):
+                self._caches.popitem(last=False)
+
+            return self._caches[key]
+
+    def _load(self, target, tgt_type):
+        jinja_context = {'target': target, 'tgt_type': tgt_type}
+        payload = snippet_registry.render_payload(self.snippet, jinja_context)
+
+        salt_util = salt_utils.SaltUtil()
+        res = salt_util.deploy_payload(payload)
+        try:
+            # {"return": [{"compute-01.c.vistoq-demo.internal": {"shoaf1": "shutdown", "stuart1": "running"}}]}
+            fleet = json.loads(res)['return'][0]
+        except (ValueError, TypeError, KeyError, IndexError) as e:
+            print('Could not get deployed VM list for %s' % target)
+            print(e)
+            return None
+
+        return self.build_index(fleet)
+
+    @staticmethod
+    def build_index(fleet):
+        """
+        Flatten the minion -> vm -> state mapping returned by virt.vm_state into a sorted table of VMs
+        :param fleet: dict of minion -> dict of vm hostname -> state
+        :return: dict containing the 'vms' list, the 'states' found, the row indexes of each state and the
+        'minions' that returned a VM list
+        """
+        vms = list()
+        minions = list()
+        for minion in sorted(fleet):
+            minion_vms = fleet[minion]
+            if not isinstance(minion_vms, dict):
+                # minions that did not respond or returned an error
+                continue
+
+            minions.append(minion)
+
+            for hostname in sorted(minion_vms):
+                vm_detail = dict()
+                vm_detail['minion'] = minion
+                vm_detail['hostname'] = hostname
+                vm_detail['status'] = minion_vms[hostname]
+                vms.append(vm_detail)
+
+        by_state = dict()
+        for index, vm in enumerate(vms):
+            by_state.setdefault(vm['status'], list()).append(index)
+
+        index = dict()
+        index['vms'] = vms
+        index['by_state'] = by_state
+        index['states'] = sorted(by_state.keys())
+        index['minions'] = minions
+        return index
+
+    def load_index(self, target, tgt_type='glob'):
+        """
+        Query the VMs of all minions matching the target without going through the cache
+        :param target: salt target
+        :param tgt_type: 'glob' or 'list'
+        :return: index as returned by build_index or None if the provisioner did not return a VM list
+        """
+        return self._load(target, tgt_type)
+
+    def refresh(self, target='*', tgt_type='glob'):
+        """
+        Reload the cached VMs of all minions matching the target, waiting for the provisioner
+        :param target: salt target
+        :param tgt_type: 'glob' or 'list'
+        :return: the new index or None if the provisioner did not return a VM list, the cache then keeps its
+        previous value
+        """
+        started = time.time()
+        entry = self._get_cache(target, tgt_type).refresh(wait=True)
+        if entry is None or entry['updated'] < started:
+            return None
+
+        return entry['value']
+
+    def get_index(self, target='*', tgt_type='glob'):
+        index = self._get_cache(target, tgt_type).get()
+        if index is None:
+            return self.build_index(dict())
+
+        return index
+
+    def get_vms(self, target='*', tgt_type='glob', state='', hostname=''):
+        """
+        Get the VMs running on all minions matching the target
+        :param target: salt target, a glob or comma separated list of minions
+        :param tgt_type: 'glob' or 'list'
+        :param state: only return VMs in this state when set
+        :param hostname: only return VMs whose hostname contains this value when set
+        :return: list of dicts with 'minion', 'hostname' and 'status' keys
+        """
+        index = self.get_index(target, tgt_type)
+        if state != '':
+            vms = [index['vms'][i] for i in index['by_state'].get(state, list())]
+        else:
+            vms = index['vms']
+
+        if hostname != '':
+            hostname = hostname.lower()
+            vms = [vm for vm in vms if hostname in vm['hostname'].lower()]
+
+        return vms
+
+    def get_cached_vms(self, minion):
+        """
+        Get the last known VMs of a minion from any cached inventory without querying the provisioner. Used to keep
+        showing data while the provisioner is unavailable
+        :param minion: minion id
+        :return: tuple of (list of vm dicts, age of the data in seconds) or (None, None) if nothing is cached
+        """
+        with self._lock:
+            caches = list(self._caches.values())
+
+        # prefer the most recently refreshed inventory
+        for fleet_cache in sorted(caches, key=lambda c: c.age() if c.age() is not None else float('inf')):
+            index = fleet_cache.peek()
+            if index is None:
+                continue
+
+            vms = [vm for vm in index['vms'] if vm['minion'] == minion]
+            if vms:
+                return vms, fleet_cache.age()
+
+        return None, None
+
+    def forget_vm(self, minion, hostname):
+        """
+        Remove a deleted VM from every cached inventory
+        :param minion: minion the VM was running on
+        :param hostname: hostname of the VM
+        :return: None
+        """
+        self.forget_vms([(minion, hostname)])
+
+    def forget_vms(self, deleted_vms):
+        """
+        Remove many deleted VMs from every cached inventory
+        :param deleted_vms: list of (minion, hostname) tuples
+        :return: None
+        """
+        deleted_vms = set(deleted_vms)
+        if not deleted_vms:
+            return
+
+        with self._lock:
+            caches = list(self._caches.values())
+
+        for fleet_cache in caches:
+            index = fleet_cache.peek()
+            if index is None:
+                continue
+
+            fleet = {minion: dict() for minion in index.get('minions', list())}
+            for vm in index['vms']:
+                if (vm['minion'], vm['hostname']) in deleted_vms:
+                    continue
+
+                fleet.setdefault(vm['minion'], dict())[vm['hostname']] = vm['status']
+
+            fleet_cache.update(self.build_index(fleet))
+
+    def invalidate(self):
+        with self._lock:
+            caches = list(self._caches.values())
+
+        for fleet_cache in caches:
+            fleet_cache.invalidate()
+
+
+fleet_inventory = FleetVmInventory()
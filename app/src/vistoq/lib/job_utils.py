@@ -0,0 +1,301 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import threading
+import time
+
+from django.core.cache import cache
+
+from vistoq.lib import salt_utils
+from vistoq.lib.cache_utils import get_int_config_value
+
+
+def get_state_steps(state_return):
+    """
+    Convert the return of a state.apply call on a single minion into a list of steps
+    :param state_return: dict of state id -> state result as returned by salt for one minion. Salt returns a list
+    of error strings instead when the state could not be compiled
+    :return: list of dicts with 'step', 'name', 'result', 'comment', 'duration' and 'start_time' keys. Steps are
+    sorted by the order salt ran them in
+    """
+    steps = list()
+    if isinstance(state_return, list):
+        for error in state_return:
+            steps.append({'step': 'compile', 'name': 'compile', 'result': False, 'comment': str(error)})
+
+        return steps
+
+    if not isinstance(state_return, dict):
+        steps.append({'step': 'return', 'name': 'return', 'result': False, 'comment': str(state_return)})
+        return steps
+
+    for step in state_return:
+        step_detail = state_return[step]
+        if not isinstance(step_detail, dict):
+            steps.append({'step': step, 'name': step, 'result': False, 'comment': str(step_detail)})
+            continue
+
+        steps.append({
+            'step': step,
+            'name': get_state_name(step, step_detail),
+            'result': step_detail.get('result', False),
+            'comment': step_detail.get('comment', ''),
+            'duration': get_state_duration(step_detail),
+            'start_time': step_detail.get('start_time', None),
+            'run_num': step_detail.get('__run_num__', 0)
+        })
+
+    return sorted(steps, key=lambda s: s.get('run_num', 0))
+
+
+def get_state_name(step, step_detail):
+    """
+    Get a short name for a state step
+    :param step: state key such as 'virt_|-create_vm_|-create_vm_|-running'
+    :param step_detail: state result dict
+    :return: the state id, i.e. 'create_vm'
+    """
+    if '__id__' in step_detail:
+        return step_detail['__id__']
+
+    parts = step.split('_|-')
+    if len(parts) > 1:
+        return parts[1]
+
+    return step
+
+
+def get_state_duration(step_detail):
+    """
+    :param step_detail: state result dict
+    :return: duration of the state in milliseconds or None if salt did not report one
+    """
+    duration = step_detail.get('duration', None)
+    if duration is None:
+        return None
+
+    try:
+        # older salt versions report durations as strings such as '1201.36 ms'
+        return float(str(duration).split(' ')[0])
+    except ValueError:
+        return None
+
+
+def check_state_return(state_return):
+    """
+    Verify every step of a state.apply return completed successfully
+    :param state_return: dict of state id -> state result for one minion
+    :return: tuple of (success, comment of the first failed step)
+    """
+    for step in get_state_steps(state_return):
+        if step['result'] is not True:
+            return False, step['comment']
+
+    return True, ''
+
+
+def get_deploy_results_message(results_json, minion):
+    """
+    Build the results message shown after a firewall deployment
+    :param results_json: json response from the provisioner in the form {"return": [{minion: {...}}]}
+    :param minion: minion the firewall was deployed on
+    :return: tuple of (success, message)
+    """
+    if 'return' in results_json and minion in results_json['return'][0]:
+        success, comment = check_state_return(results_json['return'][0][minion])
+        if not success:
+            message = 'Error deploying VM! Not all steps completed successfully!\n\n'
+            message += comment
+            return False, message
+
+    return True, 'VM Deployed Successfully on CPE: %s' % minion
+
+
+class DeployJobTracker():
+    """
+    Track salt jobs submitted through local_async. Job records are kept in the django cache so any worker can
+    report on them, and a single background thread per process polls /jobs/<jid> for the jobs submitted from
+    this process until they complete or time out
+    """
+    cache_prefix = 'vistoq.deploy_job.'
+    # number of seconds to keep job records after submission
+    record_timeout = 86400
+
+    def __init__(self):
+        self.poll_interval = get_int_config_value('DEPLOY_JOB_POLL_INTERVAL', 10)
+        self.job_timeout = get_int_config_value('DEPLOY_JOB_TIMEOUT', 3600)
+        self._jobs = set()
+        self._lock = threading.Lock()
+        self._poller = None
+
+    def submit(self, payload, minion, vm_name=''):
+        """
+        Submit a rendered payload as an async salt job and start tracking it
+        :param payload: rendered payload as a list of salt lowstate dicts or a json string
+        :param minion: minion targeted by the payload
+        :param vm_name: name of the VM being built, if any
+        :return: job record dict or None if the job could not be submitted
+        """
+        salt_util = salt_utils.SaltUtil()
+        jid = salt_util.submit_job(payload)
+        if jid is None:
+            return None
+
+        return self.track(jid, minion, vm_name)
+
+    def track(self, jid, minion, vm_name='', submitted=None):
+        """
+        Start tracking a submitted job from this process. Also used to pick up jobs again after a restart, when
+        their record may have been lost with the cache
+        :param jid: salt job id
+        :param minion: minion targeted by the job
+        :param vm_name: name of the VM being built, if any
+        :param submitted: epoch time the job was submitted, defaults to now
+        :return: job record dict
+        """
+        job = cache.get(self.cache_prefix + jid)
+        if job is None:
+            job = dict()
+            job['jid'] = jid
+            job['minion'] = minion
+            job['vm_name'] = vm_name
+            job['status'] = 'running'
+            job['message'] = 'Job submitted to the provisioner'
+            job['steps'] = list()
+            job['submitted'] = submitted or time.time()
+            job['updated'] = time.time()
+            job['finished'] = None
+            self._save(job)
+
+        if job['status'] == 'running':
+            with self._lock:
+                self._jobs.add(jid)
+                self._start_poller()
+
+        return job
+
+    def get_job(self, jid):
+        """
+        Get the current job record. Jobs that are still running and are not polled by this process, for example
+        after the submitting worker restarted, are polled once here when their record is out of date
+        :param jid: salt job id
+        :return: job record dict or None if the job is unknown
+        """
+        job = cache.get(self.cache_prefix + jid)
+        if job is None:
+            return None
+
+        if job['status'] == 'running' and jid not in self._jobs:
+            if time.time() - job['updated'] > self.poll_interval:
+                job = self.update_job(job)
+
+        return job
+
+    def update_job(self, job):
+        """
+        Poll salt for the results of a job and update the job record
+        :param job: job record dict
+        :return: updated job record
+        """
+        salt_util = salt_utils.SaltUtil()
+        salt_job = salt_util.get_job(job['jid'])
+        now = time.time()
+        job['updated'] = now
+
+        if salt_job is not None and job['minion'] in salt_job['return']:
+            self._complete(job, salt_job['return'][job['minion']])
+        elif now - job['submitted'] > self.job_timeout:
+            job['status'] = 'unknown'
+            job['message'] = 'No result from %s after %s seconds' % (job['minion'], self.job_timeout)
+            job['finished'] = now
+            from vistoq.lib import history_utils
+            history_utils.record_job_timeout(job['jid'], job['message'])
+
+        self._save(job)
+        return job
+
+    def record_return(self, jid, minion, state_return):
+        """
+        Complete a job from a return published on the salt event bus, without waiting for the next poll
+        :param jid: salt job id
+        :param minion: minion that returned
+        :param state_return: state.apply return of the minion
+        :return: updated job record or None if the job is not tracked or already complete
+        """
+        job = cache.get(self.cache_prefix + jid)
+        if job is None or job['status'] != 'running' or job['minion'] != minion:
+            return None
+
+        job['updated'] = time.time()
+        self._complete(job, state_return)
+        self._save(job)
+        with self._lock:
+            self._jobs.discard(jid)
+
+        return job
+
+    def _complete(self, job, state_return):
+        job['steps'] = get_state_steps(state_return)
+        success, message = get_deploy_results_message({'return': [{job['minion']: state_return}]}, job['minion'])
+        job['status'] = 'success' if success else 'failed'
+        job['message'] = message
+        job['finished'] = time.time()
+        # the poller and the event consumer may both see the return, only record it once
+        if cache.add(self.cache_prefix + job['jid'] + '.recorded', 1, self.record_timeout):
+            # history_utils depends on the parsing functions in this module
+            from vistoq.lib import history_utils
+            history_utils.record_deployment(job['minion'], job['vm_name'], state_return, jid=job['jid'],
+                                            message=message)
+
+    def _save(self, job):
+        cache.set(self.cache_prefix + job['jid'], job, self.record_timeout)
+
+    def _start_poller(self):
+        # called with self._lock held
+        if self._poller is not None and self._poller.is_alive():
+            return
+
+        self._poller = threading.Thread(target=self._poll_loop, name='deploy-job-poller', daemon=True)
+        self._poller.start()
+
+    def _poll_loop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                jids = list(self._jobs)
+
+            if not jids:
+                with self._lock:
+                    if not self._jobs:
+                        self._poller = None
+                        return
+
+                continue
+
+            for jid in jids:
+                try:
+                    job = cache.get(self.cache_prefix + jid)
+                    if job is not None and job['status'] == 'running':
+                        job = self.update_job(job)
+
+                    if job is None or job['status'] != 'running':
+                        with self._lock:
+                            self._jobs.discard(jid)
+
+                except Exception as e:
+                    print('Error polling job %s' % jid)
+                    print(e)
+
+
+job_tracker = DeployJobTracker()
@@ -0,0 +1,187 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import threading
+import time
+from contextlib import contextmanager
+
+from vistoq.lib import operator_utils
+
+# histogram buckets in seconds, salt deployments routinely take minutes
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+class Metrics():
+    """
+    Minimal in process registry of counters and histograms exported in the Prometheus text format. Each worker
+    process keeps and exports its own values
+    """
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._histograms = dict()
+        self._help = dict()
+
+    @staticmethod
+    def _label_key(labels):
+        if not labels:
+            return tuple()
+
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, labels=None, value=1, help_text=''):
+        """
+        Increment a counter
+        :param name: metric name such as vistoq_cache_requests_total
+        :param labels: dict of label names and values
+        :param value: amount to increment by
+        :param help_text: description of the metric
+        :return: None
+        """
+        key = self._label_key(labels)
+        with self._lock:
+            counter = self._counters.setdefault(name, dict())
+            counter[key] = counter.get(key, 0) + value
+            if help_text and name not in self._help:
+                self._help[name] = help_text
+
+    def observe(self, name, value, labels=None, help_text=''):
+        """
+        Record a value in a histogram
+        :param name: metric name such as vistoq_salt_api_request_seconds
+        :param value: observed value
+        :param labels: dict of label names and values
+        :param help_text: description of the metric
+        :return: None
+        """
+        key = self._label_key(labels)
+        with self._lock:
+            histogram = self._histograms.setdefault(name, dict())
+            if key not in histogram:
+                histogram[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+
+            series = histogram[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+
+            series['sum'] += value
+            series['count'] += 1
+            if help_text and name not in self._help:
+                self._help[name] = help_text
+
+    @contextmanager
+    def timer(self, name, labels=None, help_text=''):
+        """
+        Time a block of code and record the duration in seconds in a histogram. The labels dict is yielded so the
+        block can fill in labels, such as the status, that are only known once the call completes. A 'status' label
+        that is still empty when the block raises is set to 'error'
+        :param name: metric name
+        :param labels: dict of label names and values
+        :param help_text: description of the metric
+        """
+        if labels is None:
+            labels = dict()
+
+        start = time.time()
+        try:
+            yield labels
+        except Exception:
+            if labels.get('status', None) == '':
+                labels['status'] = 'error'
+
+            raise
+        finally:
+            self.observe(name, time.time() - start, labels, help_text)
+
+    def cache_hit(self, cache_name, result='hit'):
+        """
+        Count a cache lookup
+        :param cache_name: name of the cache
+        :param result: 'hit', 'miss' or 'stale'
+        :return: None
+        """
+        self.inc('vistoq_cache_requests_total', {'cache': cache_name, 'result': result},
+                 help_text='Vistoq cache lookups by result')
+
+    @staticmethod
+    def _format_labels(key, extra=None):
+        pairs = list(key)
+        if extra is not None:
+            pairs.append(extra)
+
+        if not pairs:
+            return ''
+
+        escaped = list()
+        for k, v in pairs:
+            v = v.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+            escaped.append('%s="%s"' % (k, v))
+
+        return '{%s}' % ','.join(escaped)
+
+    def render(self):
+        """
+        :return: all metrics in the Prometheus text exposition format
+        """
+        lines = list()
+        with self._lock:
+            for name in sorted(self._counters):
+                if name in self._help:
+                    lines.append('# HELP %s %s' % (name, self._help[name]))
+
+                lines.append('# TYPE %s counter' % name)
+                for key, value in sorted(self._counters[name].items()):
+                    lines.append('%s%s %s' % (name, self._format_labels(key), value))
+
+            for name in sorted(self._histograms):
+                if name in self._help:
+                    lines.append('# HELP %s %s' % (name, self._help[name]))
+
+                lines.append('# TYPE %s histogram' % name)
+                for key, series in sorted(self._histograms[name].items()):
+                    for bound, count in zip(self.buckets, series['buckets']):
+                        lines.append('%s_bucket%s %s' % (name, self._format_labels(key, ('le', str(bound))), count))
+
+                    lines.append('%s_bucket%s %s' % (name, self._format_labels(key, ('le', '+Inf')), series['count']))
+                    lines.append('%s_sum%s %s' % (name, self._format_labels(key), series['sum']))
+                    lines.append('%s_count%s %s' % (name, self._format_labels(key), series['count']))
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Metrics()
+
+
+class TimedViewMixin():
+    """
+    Record the time taken to dispatch and render a view, labelled by view class, method and status code
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        labels = {'view': self.__class__.__name__, 'method': request.method, 'status': ''}
+        # salt calls made while handling the request are recorded in the deployment history under this user
+        operator = getattr(getattr(request, 'user', None), 'username', '') or ''
+        with registry.timer('vistoq_view_seconds', labels, 'Time taken to render vistoq views') as labels, \
+                operator_utils.acting_as(operator):
+            response = super().dispatch(request, *args, **kwargs)
+            # template responses are rendered lazily, render here so the timing includes the template
+            if hasattr(response, 'render') and not getattr(response, 'is_rendered', True):
+                response.render()
+
+            labels['status'] = str(response.status_code)
+
+        return response
@@ -0,0 +1,539 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import csv
+import json
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+import oyaml
+from pan_cnc.lib import cnc_utils
+
+from vistoq.lib import deploy_utils
+from vistoq.lib import idempotency_utils
+from vistoq.lib import metrics
+from vistoq.lib import operator_utils
+from vistoq.lib import panorama_utils
+from vistoq.lib import provision_utils
+from vistoq.lib import scheduler_utils
+from vistoq.lib import sku_utils
+from vistoq.lib.cache_utils import get_int_config_value
+from vistoq.lib.snippet_index import snippet_index
+from vistoq.lib.snippet_registry import snippet_registry
+from vistoq.models import DeployRequest
+from vistoq.models import StagedTenant
+
+# columns every tenant needs, any other column is passed to the service and provision_firewall templates
+required_fields = ('customer_name', 'snippet_name', 'service_size', 'service_term')
+
+# tenant names become device group, template stack and VM names
+tenant_name_pattern = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]{0,62}$')
+
+
+def iter_csv_rows(stream):
+    """
+    Read tenants from a csv file with a header line, one row at a time
+    :param stream: open text file
+    :return: generator of (row number, dict of column -> value)
+    """
+    reader = csv.DictReader(stream)
+    for row_number, row in enumerate(reader, start=1):
+        values = dict()
+        for key, value in row.items():
+            if key is None:
+                # more values than header columns
+                values['_extra'] = value
+                continue
+
+            values[key.strip()] = (value or '').strip()
+
+        if not any(v for k, v in values.items() if k != '_extra'):
+            continue
+
+        yield row_number, values
+
+
+def iter_yaml_rows(stream):
+    """
+    Read tenants from a yaml file one document at a time. A document may hold a single tenant, a list of tenants
+    or a dict with a 'tenants' list, use one document per tenant to keep memory flat on very large files
+    :param stream: open text file
+    :return: generator of (row number, dict of field -> value)
+    """
+    row_number = 0
+    for document in oyaml.safe_load_all(stream):
+        if document is None:
+            continue
+
+        if isinstance(document, dict) and isinstance(document.get('tenants', None), list):
+            items = document['tenants']
+        elif isinstance(document, list):
+            items = document
+        else:
+            items = [document]
+
+        for item in items:
+            row_number += 1
+            if not isinstance(item, dict):
+                yield row_number, {'_error': 'Expected a mapping of tenant fields'}
+                continue
+
+            yield row_number, {str(k): '' if v is None else str(v).strip() for k, v in item.items()}
+
+
+def iter_rows(stream, file_format):
+    """
+    :param stream: open text file
+    :param file_format: 'csv' or 'yaml'
+    :return: generator of (row number, dict of field -> value)
+    """
+    if file_format == 'csv':
+        return iter_csv_rows(stream)
+
+    if file_format in ('yaml', 'yml'):
+        return iter_yaml_rows(stream)
+
+    raise ValueError('Unknown tenant file format %s' % file_format)
+
+
+def iter_chunks(rows, size):
+    """
+    :param rows: iterable
+    :param size: number of items per chunk
+    :return: generator of lists of up to size items
+    """
+    chunk = list()
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = list()
+
+    if chunk:
+        yield chunk
+
+
+def load_results(results_file):
+    """
+    Read the results of earlier runs, the last record of each tenant wins
+    :param results_file: json lines file written by TenantOnboarding
+    :return: dict of customer_name -> result dict
+    """
+    previous = dict()
+    if not results_file or not os.path.isfile(results_file):
+        return previous
+
+    with open(results_file, 'r') as rf:
+        for line in rf:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a run killed in the middle of a write leaves a partial last line
+                continue
+
+            if isinstance(record, dict) and record.get('customer_name', ''):
+                previous[record['customer_name']] = record
+
+    return previous
+
+
+class TenantOnboarding():
+    """
+    Headless bulk onboarding of GSB tenants. Tenants are streamed from the input in chunks, each chunk is validated
+    and gets its skus in one pass, then flows through a two stage pipeline: the Panorama configuration of a chunk
+    is staged and applied as one provisioning batch, while the firewalls of the previous chunk are being deployed
+    on a bounded thread pool. Every finished row is appended to a json lines results file, a later run with the
+    same results file skips the tenants that succeeded and only redeploys those whose configuration is done
+    """
+    result_fields = ('row', 'customer_name', 'snippet_name', 'sku', 'minion', 'vm_name', 'config', 'deploy',
+                     'status', 'message', 'batch', 'request')
+
+    def __init__(self, results_file, chunk_size=None, workers=None, configure=True, deploy=True,
+                 default_minion=None, dry_run=False, report=None):
+        self.results_file = results_file
+        self.chunk_size = chunk_size or get_int_config_value('ONBOARDING_CHUNK_SIZE', 50)
+        self.workers = workers or get_int_config_value('BATCH_DEPLOY_WORKERS', 8)
+        self.deploy_timeout = get_int_config_value('ONBOARDING_DEPLOY_TIMEOUT', 3600)
+        self.configure = configure
+        self.deploy = deploy
+        self.default_minion = default_minion or cnc_utils.get_config_value('ONBOARDING_DEFAULT_MINION', 'auto')
+        self.dry_run = dry_run
+        # called with the result of every row, i.e. to print progress
+        self.report = report
+        self.counts = dict()
+        self._previous = dict()
+        self._seen = set()
+        self._known_snippets = dict()
+        self._output = None
+        self._service = None
+        self._common_context = dict()
+        self._operator = ''
+
+    def _snippet_exists(self, snippet_name):
+        if snippet_name not in self._known_snippets:
+            self._known_snippets[snippet_name] = snippet_index.load_snippet_with_name(snippet_name) is not None
+
+        return self._known_snippets[snippet_name]
+
+    def validate(self, chunk):
+        """
+        Validate a chunk of tenants and compute their skus column by column
+        :param chunk: list of (row number, values) tuples
+        :return: list of row dicts, rows that can not be onboarded carry a final 'status'
+        """
+        rows = list()
+        for row_number, values in chunk:
+            row = {'row': row_number, 'values': values}
+            for field in required_fields:
+                row[field] = values.get(field, '')
+
+            rows.append(row)
+
+        skus = sku_utils.build_skus([r['snippet_name'] for r in rows], [r['service_size'] for r in rows],
+                                    [r['service_term'] for r in rows])
+
+        for row, sku in zip(rows, skus):
+            values = row['values']
+            row['sku'] = sku or ''
+            row['vm_name'] = row['customer_name']
+            row['minion'] = values.get('minion', '') or self.default_minion
+            missing = [f for f in required_fields if row[f] == '']
+            if '_error' in values:
+                error = values['_error']
+            elif '_extra' in values:
+                error = 'More values than columns in the header'
+            elif missing:
+                error = 'Missing %s' % ', '.join(missing)
+            elif not tenant_name_pattern.match(row['customer_name']):
+                error = 'Invalid customer_name %s' % row['customer_name']
+            elif row['customer_name'] in self._seen:
+                error = 'Duplicate customer_name %s' % row['customer_name']
+            elif sku is None:
+                error = 'Unknown service tier, size or term: %s, %s, %s' % (
+                    sku_utils.get_tier(row['snippet_name']), row['service_size'], row['service_term'])
+            elif not self._snippet_exists(row['snippet_name']):
+                error = 'Unknown service %s' % row['snippet_name']
+            else:
+                error = ''
+
+            if row['customer_name']:
+                self._seen.add(row['customer_name'])
+
+            if error:
+                row['status'] = 'failed'
+                row['message'] = error
+                continue
+
+            previous = self._previous.get(row['customer_name'], dict())
+            if previous.get('status', '') == 'success':
+                row['status'] = 'skipped'
+                row['message'] = 'Onboarded by an earlier run'
+            elif previous.get('config', '') == 'success' and previous.get('sku', '') == row['sku']:
+                # only the deployment is left to do
+                row['config'] = 'success'
+                row['batch'] = previous.get('batch', None)
+
+        return rows
+
+    def _get_value(self, row):
+        values = row['values']
+        computed = dict()
+        computed['sku'] = row['sku']
+        computed['FW_NAME'] = row['customer_name']
+        # same values the GSB workflow sets for the device group, stack and EDL rules
+        computed['STACK'] = row['customer_name']
+        computed['DEVICE_GROUP'] = row['customer_name']
+        computed['INCLUDE_PAN_EDL'] = 'False'
+
+        def get_value(name):
+            if name in computed:
+                return computed[name]
+
+            return values.get(name, None)
+
+        return get_value
+
+    def configure_rows(self, rows):
+        """
+        Config stage, stage the service of every tenant in one provisioning batch and apply it
+        :param rows: list of validated row dicts without a final status
+        :return: the rows updated with 'config' and, on failure, 'status' and 'message'
+        """
+        todo = [r for r in rows if r.get('config', '') != 'success']
+        if not self.configure:
+            for row in todo:
+                row['config'] = 'skipped'
+
+            return rows
+
+        if not todo:
+            return rows
+
+        batch = provision_utils.batch_provisioner.create_batch(
+            'Onboarding rows %s to %s' % (todo[0]['row'], todo[-1]['row']))
+        staged = list()
+        for row in todo:
+            row['batch'] = batch.id
+            try:
+                service = snippet_index.load_snippet_with_name(row['snippet_name'])
+                context = provision_utils.get_service_context(service, self._get_value(row))
+                provision_utils.batch_provisioner.stage(batch, row['customer_name'], row['snippet_name'], context,
+                                                        device_group=row['customer_name'],
+                                                        stack=row['customer_name'])
+                staged.append(row)
+            except ValueError as ve:
+                row['config'] = 'failed'
+                row['status'] = 'failed'
+                row['message'] = str(ve)
+
+        if not staged:
+            return rows
+
+        if not provision_utils.batch_provisioner.claim(batch.id):
+            for row in staged:
+                row['config'] = 'failed'
+                row['status'] = 'failed'
+                row['message'] = 'Batch %s was applied by someone else' % batch.id
+
+            return rows
+
+        provision_utils.batch_provisioner.apply(batch.id)
+        tenants = dict((t.tenant, t) for t in StagedTenant.objects.filter(batch_id=batch.id))
+        for row in staged:
+            tenant = tenants.get(row['customer_name'], None)
+            if tenant is not None and tenant.status == StagedTenant.SUCCESS:
+                row['config'] = 'success'
+                continue
+
+            row['config'] = 'failed'
+            row['status'] = 'failed'
+            row['message'] = tenant.message if tenant is not None else 'Configuration was not applied'
+
+        return rows
+
+    def deploy_row(self, row):
+        """
+        Deploy stage, build the firewall of a single tenant. Deployments go through the deploy queue when it is
+        enabled so the per node build limits hold for the whole fleet, a deployment still queued or running from
+        an interrupted run is picked up again instead of being queued twice
+        :param row: row dict with a chosen minion
+        :return: the row updated with 'deploy', 'status' and 'message'
+        """
+        deploy_row = dict((k, v) for k, v in row['values'].items() if k in deploy_utils.row_fields)
+        deploy_row['minion'] = row['minion']
+        deploy_row['vm_name'] = row['vm_name']
+        common_context = dict(self._common_context)
+        for name in ('admin_username', 'admin_password', 'auth_key'):
+            if row['values'].get(name, ''):
+                common_context[name] = row['values'][name]
+
+        try:
+            payload = deploy_utils.render_row_payload(self._service, common_context, deploy_row)
+        except ValueError as ve:
+            print('Could not render payload for %s' % row['vm_name'])
+            print(ve)
+            row['deploy'] = 'failed'
+            row['status'] = 'failed'
+            row['message'] = 'Could not render deployment payload'
+            return row
+
+        scheduler = scheduler_utils.deploy_scheduler
+        if not scheduler.enabled:
+            with operator_utils.acting_as(self._operator):
+                deploy_utils.deploy_minion_rows(row['minion'], [deploy_row], [payload])
+            row['deploy'] = deploy_row['status']
+            row['status'] = deploy_row['status']
+            row['message'] = deploy_row['message']
+            return row
+
+        request_key = idempotency_utils.request_key('onboard', row['customer_name'])
+        request = scheduler.find_active(request_key)
+        if request is None:
+            with operator_utils.acting_as(self._operator):
+                request = scheduler.enqueue(payload, row['minion'], row['vm_name'], request_key)
+
+        if request is None:
+            row['deploy'] = 'failed'
+            row['status'] = 'failed'
+            row['message'] = 'Could not queue the deployment'
+            return row
+
+        row['request'] = request.id
+        deadline = time.time() + self.deploy_timeout
+        while request.status in (DeployRequest.QUEUED, DeployRequest.RUNNING) and time.time() < deadline:
+            time.sleep(scheduler.interval)
+            request = DeployRequest.objects.get(id=request.id)
+
+        if request.status == DeployRequest.SUCCESS:
+            row['deploy'] = 'success'
+            row['status'] = 'success'
+            row['message'] = request.message or 'VM Deployed Successfully on CPE: %s' % row['minion']
+        elif request.status in (DeployRequest.QUEUED, DeployRequest.RUNNING):
+            # still building, the next run waits for the same request
+            row['deploy'] = 'failed'
+            row['status'] = 'failed'
+            row['message'] = 'Deployment request %s did not finish within %s seconds' % (request.id,
+                                                                                          self.deploy_timeout)
+        else:
+            row['deploy'] = 'failed'
+            row['status'] = 'failed'
+            row['message'] = request.message or 'Deployment %s' % request.status
+
+        return row
+
+    def _write(self, row):
+        status = row.get('status', 'failed')
+        self.counts[status] = self.counts.get(status, 0) + 1
+        metrics.registry.inc('vistoq_onboarding_rows_total', {'status': status},
+                             help_text='Tenants processed by the bulk onboarding command')
+        record = dict()
+        for field in self.result_fields:
+            record[field] = row.get(field, '')
+
+        record['finished'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        if self.report is not None:
+            self.report(record)
+
+        if status == 'skipped' or self._output is None:
+            return
+
+        self._output.write(json.dumps(record, default=str) + '\n')
+        # keep the file current so an interrupted run can be resumed
+        self._output.flush()
+
+    def _start_deploys(self, rows, future, executor, futures):
+        try:
+            future.result()
+        except Exception as e:
+            print('Could not configure rows %s to %s' % (rows[0]['row'], rows[-1]['row']))
+            print(e)
+            for row in rows:
+                if 'status' not in row:
+                    row['config'] = 'failed'
+                    row['status'] = 'failed'
+                    row['message'] = 'Could not configure tenant: %s' % e
+
+        ready = list()
+        for row in rows:
+            if 'status' in row:
+                self._write(row)
+            elif not self.deploy:
+                row['deploy'] = 'skipped'
+                row['status'] = 'success'
+                row['message'] = 'Configured, deployment skipped'
+                self._write(row)
+            else:
+                ready.append(row)
+
+        # choose nodes for the whole chunk at once so it is spread over the fleet
+        placement_rows = [{'line': r['row'], 'minion': r['minion'], 'vm_name': r['vm_name']} for r in ready]
+        deploy_utils.place_auto_rows(placement_rows)
+        deploy_utils.check_duplicate_rows(placement_rows)
+        for row, placed in zip(ready, placement_rows):
+            if 'error' in placed:
+                row['deploy'] = 'failed'
+                row['status'] = 'failed'
+                row['message'] = placed['error']
+                self._write(row)
+                continue
+
+            row['minion'] = placed['minion']
+            futures[executor.submit(self.deploy_row, row)] = row
+
+    def _collect(self, futures, limit):
+        while len(futures) > limit:
+            done, pending = wait(list(futures.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                row = futures.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    print('Could not deploy %s' % row['vm_name'])
+                    print(e)
+                    row['deploy'] = 'failed'
+                    row['status'] = 'failed'
+                    row['message'] = 'Error deploying VM! %s' % e
+
+                self._write(row)
+
+    def run(self, rows):
+        """
+        Onboard tenants
+        :param rows: iterable of (row number, values) tuples such as returned by iter_rows
+        :return: dict of status -> number of rows
+        """
+        self.counts = dict()
+        # the deploy threads record their salt calls under the operator running the onboarding
+        self._operator = operator_utils.get_operator()
+        self._previous = load_results(self.results_file)
+        self._seen = set()
+
+        if self.dry_run:
+            for chunk in iter_chunks(rows, self.chunk_size):
+                for row in self.validate(chunk):
+                    if 'status' not in row:
+                        row['status'] = 'valid'
+                        row['message'] = 'Would onboard with sku %s' % row['sku']
+
+                    self._write(row)
+
+            return self.counts
+
+        if self.deploy:
+            self._service = snippet_registry.load_snippet('provision_firewall')
+            self._common_context['vm_auth_key'] = panorama_utils.vm_auth_key_cache.get_key()
+            self._common_context['panorama_ip'] = cnc_utils.get_config_value('PANORAMA_IP', '0.0.0.0')
+
+        with open(self.results_file, 'a') as output:
+            self._output = output
+            try:
+                self._run(rows)
+            finally:
+                self._output = None
+
+        return self.counts
+
+    def _run(self, rows):
+        # Panorama commits one batch at a time, so one config worker, while the builds run in parallel
+        with ThreadPoolExecutor(max_workers=1) as config_executor, \
+                ThreadPoolExecutor(max_workers=self.workers) as deploy_executor:
+            configuring = deque()
+            deploying = dict()
+            for chunk in iter_chunks(rows, self.chunk_size):
+                validated = self.validate(chunk)
+                todo = list()
+                for row in validated:
+                    if 'status' in row:
+                        self._write(row)
+                    else:
+                        todo.append(row)
+
+                if todo:
+                    configuring.append((todo, config_executor.submit(self.configure_rows, todo)))
+
+                # keep one chunk configuring while the one before it deploys
+                while len(configuring) > 1:
+                    self._start_deploys(*configuring.popleft(), deploy_executor, deploying)
+
+                self._collect(deploying, self.workers * 2)
+
+            while configuring:
+                self._start_deploys(*configuring.popleft(), deploy_executor, deploying)
+
+            self._collect(deploying, 0)
@@ -0,0 +1,39 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import threading
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+def get_operator():
+    """
+    :return: name of the user the current thread is working for, empty when unknown such as on background threads
+    """
+    return getattr(_local, 'operator', '')
+
+
+@contextmanager
+def acting_as(operator):
+    """
+    Attribute the salt calls made by this thread to an operator while the block runs
+    :param operator: user name
+    """
+    previous = get_operator()
+    _local.operator = operator or ''
+    try:
+        yield
+    finally:
+        _local.operator = previous
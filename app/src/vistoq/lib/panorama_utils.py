@@ -0,0 +1,285 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import re
+import time
+from datetime import datetime
+from xml.etree import ElementTree
+
+from django.core.cache import cache
+
+from vistoq.lib import metrics
+from vistoq.lib.import_utils import lazy_import
+from vistoq.lib.cache_utils import BackgroundRefreshCache
+from vistoq.lib.cache_utils import SingleFlight
+from vistoq.lib.cache_utils import get_int_config_value
+
+pan_utils = lazy_import('pan_cnc.lib.pan_utils')
+pan_xapi = lazy_import('pan.xapi')
+
+# VM auth key 7926396480153845 generated. Expires at: 2019/01/31 13:58:13
+vm_auth_key_pattern = re.compile(r'VM auth key\s+(\S+)\s+generated', re.IGNORECASE)
+vm_auth_key_expires_pattern = re.compile(r'Expires at:\s*(\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2})', re.IGNORECASE)
+
+
+def parse_vm_auth_key(response):
+    """
+    Parse the response of a VM auth key generation request from Panorama
+    :param response: response text such as 'VM auth key 7926396480153845 generated. Expires at: 2019/01/31 13:58:13'
+    :return: tuple of (key, expire time in epoch seconds), the key is None if it could not be found and the expire
+    time is None if Panorama did not report one
+    """
+    if not isinstance(response, str):
+        return None, None
+
+    key_match = vm_auth_key_pattern.search(response)
+    if key_match is None:
+        return None, None
+
+    expires = None
+    expires_match = vm_auth_key_expires_pattern.search(response)
+    if expires_match is not None:
+        try:
+            expires = time.mktime(datetime.strptime(expires_match.group(1), '%Y/%m/%d %H:%M:%S').timetuple())
+        except ValueError:
+            print('Could not parse vm auth key expire time: %s' % expires_match.group(1))
+
+    return key_match.group(1), expires
+
+
+class VmAuthKeyCache():
+    """
+    Cache the VM auth key generated on Panorama and reuse it across sessions until shortly before it expires.
+    Generation is single flight both within a process and, through a lock in the django cache, across workers
+    """
+    cache_key = 'vistoq.vm_auth_key'
+    lock_key = 'vistoq.vm_auth_key.lock'
+    # how long another worker waits for the lock holder to store a new key
+    lock_timeout = 30
+
+    def __init__(self):
+        # lifetime Panorama generates keys with, used when the response carries no usable expire time
+        self.lifetime = get_int_config_value('VM_AUTH_KEY_LIFETIME', 24) * 3600
+        # stop handing out keys this many seconds before they expire
+        self.refresh_margin = get_int_config_value('VM_AUTH_KEY_REFRESH_MARGIN', 3600)
+        self._entry = None
+        self._flight = SingleFlight()
+
+    def _is_valid(self, entry):
+        return entry is not None and entry['expire'] - self.refresh_margin > time.time()
+
+    def get_key(self):
+        """
+        Get a VM auth key that is valid for at least refresh_margin seconds, generating a new one only if required
+        :return: key string or empty string if no key could be generated
+        """
+        if self._is_valid(self._entry):
+            metrics.registry.cache_hit('vm_auth_key', 'hit')
+            return self._entry['key']
+
+        entry = cache.get(self.cache_key)
+        if self._is_valid(entry):
+            metrics.registry.cache_hit('vm_auth_key', 'hit')
+            self._entry = entry
+            return entry['key']
+
+        metrics.registry.cache_hit('vm_auth_key', 'miss')
+        entry = self._flight.do(self.cache_key, self._generate)
+        if entry is None:
+            return ''
+
+        return entry['key']
+
+    def invalidate(self):
+        self._entry = None
+        cache.delete(self.cache_key)
+
+    def _generate(self):
+        # only one worker generates a key, the others wait for it to show up in the cache
+        if not cache.add(self.lock_key, 1, self.lock_timeout):
+            deadline = time.time() + self.lock_timeout
+            while time.time() < deadline:
+                time.sleep(0.5)
+                entry = cache.get(self.cache_key)
+                if self._is_valid(entry):
+                    self._entry = entry
+                    return entry
+
+            print('Timed out waiting on another worker for the vm auth key')
+
+        try:
+            print('Generating new vm auth key on Panorama')
+            labels = {'call': 'get_vm_auth_key', 'status': ''}
+            with metrics.registry.timer('vistoq_panorama_request_seconds', labels,
+                                        'Latency of requests to Panorama') as labels:
+                response = pan_utils.get_vm_auth_key_from_panorama()
+                labels['status'] = 'success' if response else 'failure'
+
+            key, expires = parse_vm_auth_key(response)
+            if key is None:
+                print('Could not parse vm auth key from Panorama response: %s' % response)
+                return None
+
+            now = time.time()
+            # expire times are reported in Panorama local time, do not trust values that are out of range
+            if expires is None or expires <= now or expires > now + self.lifetime:
+                expires = now + self.lifetime
+
+            entry = {'key': key, 'expire': expires}
+            self._entry = entry
+            cache.set(self.cache_key, entry, int(expires - now))
+            return entry
+        finally:
+            cache.delete(self.lock_key)
+
+
+vm_auth_key_cache = VmAuthKeyCache()
+
+
+class DeviceGroupIndex():
+    """
+    Local index of the device groups configured on Panorama. Page views read from the index, which is refreshed in
+    the background. A refresh only pulls the list of device group names and then fetches the details of the device
+    groups that were added since the last refresh. A full resync runs every DEVICE_GROUP_FULL_SYNC seconds to pick
+    up changes to existing device groups
+    """
+    device_group_xpath = "/config/devices/entry[@name='localhost.localdomain']/device-group"
+
+    def __init__(self):
+        ttl = get_int_config_value('DEVICE_GROUP_CACHE_TTL', 60)
+        max_stale = get_int_config_value('DEVICE_GROUP_CACHE_MAX_STALE', 86400)
+        self.full_sync_interval = get_int_config_value('DEVICE_GROUP_FULL_SYNC', 3600)
+        self._cache = BackgroundRefreshCache('device_group_index', self._refresh, ttl=ttl, max_stale=max_stale)
+
+    @staticmethod
+    def parse_device_group(entry):
+        """
+        :param entry: device-group entry element
+        :return: dict with the device group 'name', 'description' and 'customer_name'
+        """
+        device_group = dict()
+        device_group['name'] = entry.attrib['name']
+        description = entry.findtext('description', default='')
+        device_group['description'] = description
+        device_group['customer_name'] = description
+        return device_group
+
+    def _get_xml(self, xapi, xpath):
+        labels = {'call': 'get_device_groups', 'status': ''}
+        with metrics.registry.timer('vistoq_panorama_request_seconds', labels,
+                                    'Latency of requests to Panorama') as labels:
+            xapi.get(xpath=xpath)
+            labels['status'] = str(xapi.status)
+
+        xml = xapi.xml_result()
+        if xml is None:
+            return ElementTree.Element('result')
+
+        # xml_result returns the children of the result element which may have several roots
+        return ElementTree.fromstring('<result>%s</result>' % xml)
+
+    def _fetch_names(self, xapi):
+        doc = self._get_xml(xapi, self.device_group_xpath + '/entry/@name')
+        return set(e.attrib['name'] for e in doc.iter('entry') if 'name' in e.attrib)
+
+    def _fetch_device_groups(self, xapi, names=None):
+        if names is None:
+            xpath = self.device_group_xpath + '/entry'
+        else:
+            name_filter = ' or '.join("@name='%s'" % n for n in names)
+            xpath = self.device_group_xpath + '/entry[%s]' % name_filter
+
+        doc = self._get_xml(xapi, xpath)
+        device_groups = dict()
+        # only the top level entries are device groups, nested entries are objects inside of them
+        for entry in doc.findall('./entry') + doc.findall('./device-group/entry'):
+            if 'name' in entry.attrib:
+                device_groups[entry.attrib['name']] = self.parse_device_group(entry)
+
+        return device_groups
+
+    def _refresh(self):
+        index = self._cache.peek()
+        try:
+            labels = {'call': 'login', 'status': ''}
+            with metrics.registry.timer('vistoq_panorama_request_seconds', labels) as labels:
+                xapi = pan_utils.panorama_login()
+                labels['status'] = 'failure' if xapi is None else 'success'
+
+            if xapi is None:
+                print('Could not login to Panorama to refresh device groups')
+                return None
+
+            now = time.time()
+            if index is None or now - index['full_sync'] > self.full_sync_interval:
+                print('Loading all device groups from Panorama')
+                device_groups = self._fetch_device_groups(xapi)
+                full_sync = now
+            else:
+                names = self._fetch_names(xapi)
+                current_names = set(index['device_groups'].keys())
+                added = names - current_names
+                removed = current_names - names
+                if not added and not removed:
+                    return index
+
+                print('Device groups changed: %s added, %s removed' % (len(added), len(removed)))
+                device_groups = dict(index['device_groups'])
+                for name in removed:
+                    device_groups.pop(name, None)
+
+                added = sorted(added)
+                # keep the xpath filter to a reasonable size
+                for i in range(0, len(added), 50):
+                    device_groups.update(self._fetch_device_groups(xapi, added[i:i + 50]))
+
+                full_sync = index['full_sync']
+
+        except pan_xapi.PanXapiError as pxe:
+            print('Could not refresh device groups from Panorama')
+            print(pxe)
+            return None
+
+        new_index = dict()
+        new_index['device_groups'] = device_groups
+        new_index['names'] = sorted(device_groups.keys(), key=lambda n: n.lower())
+        new_index['full_sync'] = full_sync
+        return new_index
+
+    def search(self, query=''):
+        """
+        Search the device group index
+        :param query: only return device groups whose name or customer name contain this value when set
+        :return: list of device group dicts sorted by name
+        """
+        index = self._cache.get()
+        if index is None:
+            return list()
+
+        device_groups = index['device_groups']
+        results = [device_groups[n] for n in index['names']]
+        if query != '':
+            query = query.lower()
+            results = [dg for dg in results if query in dg['name'].lower() or query in dg['customer_name'].lower()]
+
+        return results
+
+    def refresh(self, wait=True):
+        return self._cache.refresh(wait=wait)
+
+    def invalidate(self):
+        self._cache.invalidate()
+
+
+device_group_index = DeviceGroupIndex()
@@ -0,0 +1,205 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import json
+import threading
+
+from vistoq.lib import metrics
+from vistoq.lib import salt_utils
+from vistoq.lib.cache_utils import BackgroundRefreshCache
+from vistoq.lib.cache_utils import get_int_config_value
+from vistoq.lib.snippet_registry import snippet_registry
+
+# minion value that asks for the best compute node to be chosen
+auto_minion = 'auto'
+
+
+class NodeCapacityInventory():
+    """
+    Free memory, free vCPUs and VM count of every compute node, collected from all minions in a single compound
+    salt call and cached for PLACEMENT_CACHE_TTL seconds. Placements are reserved against the cached figures so
+    deployments made before the next refresh do not all land on the same node
+    """
+    snippet = 'show_node_capacity'
+
+    def __init__(self):
+        ttl = get_int_config_value('PLACEMENT_CACHE_TTL', 15)
+        max_stale = get_int_config_value('PLACEMENT_CACHE_MAX_STALE', 60)
+        self._cache = BackgroundRefreshCache('node_capacity', self._load, ttl=ttl, max_stale=max_stale)
+        self._lock = threading.Lock()
+
+    def _load(self):
+        payload = snippet_registry.render_payload(self.snippet, {'target': '*', 'tgt_type': 'glob'})
+        salt_util = salt_utils.SaltUtil()
+        res = salt_util.deploy_payload(payload)
+        try:
+            # {"return": [{"compute-01...": {"virt.freemem": 1024, "virt.freecpu": 4, "virt.vm_state": {...}}}]}
+            returns = json.loads(res)['return'][0]
+        except (ValueError, TypeError, KeyError, IndexError) as e:
+            print('Could not get node capacity from provisioner')
+            print(e)
+            return None
+
+        capacity = dict()
+        for minion, ret in returns.items():
+            node = self.parse_node(ret)
+            if node is None:
+                print('Ignoring capacity of %s: %s' % (minion, ret))
+                continue
+
+            capacity[minion] = node
+
+        return capacity
+
+    @staticmethod
+    def parse_node(ret):
+        """
+        :param ret: return of the compound call for one minion
+        :return: dict with 'freemem' in MB, 'freecpu' and 'vms' keys or None if the minion returned an error
+        """
+        if not isinstance(ret, dict):
+            return None
+
+        try:
+            node = dict()
+            node['freemem'] = int(ret['virt.freemem'])
+            node['freecpu'] = int(ret['virt.freecpu'])
+            vms = ret['virt.vm_state']
+            node['vms'] = len(vms) if isinstance(vms, dict) else 0
+            return node
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def get_capacity(self):
+        """
+        :return: dict of minion -> node capacity dict, empty if the provisioner could not be reached
+        """
+        capacity = self._cache.get()
+        if capacity is None:
+            return dict()
+
+        return {minion: dict(node) for minion, node in capacity.items()}
+
+    def reserve(self, placements, vm_memory, vm_cpus):
+        """
+        Subtract new placements from the cached capacity until the next refresh replaces it
+        :param placements: list of minions a VM was placed on
+        :param vm_memory: memory of each VM in MB
+        :param vm_cpus: vCPUs of each VM
+        :return: None
+        """
+        with self._lock:
+            capacity = self._cache.peek()
+            if capacity is None:
+                return
+
+            capacity = {minion: dict(node) for minion, node in capacity.items()}
+            for minion in placements:
+                if minion in capacity:
+                    capacity[minion]['freemem'] -= vm_memory
+                    capacity[minion]['freecpu'] -= vm_cpus
+                    capacity[minion]['vms'] += 1
+
+            self._cache.update(capacity)
+
+    def invalidate(self):
+        self._cache.invalidate()
+
+
+node_capacity = NodeCapacityInventory()
+
+
+class PlacementError(Exception):
+    pass
+
+
+class NodePlacer():
+    """
+    Choose compute nodes for new firewalls. A node fits a VM when it has PLACEMENT_VM_MEMORY MB and
+    PLACEMENT_VM_CPUS vCPUs free. Nodes are scored by the number of additional VMs they can still hold, ties go to
+    the node running the fewest VMs, so a batch is spread over the emptiest nodes first
+    """
+
+    def __init__(self, inventory):
+        self.inventory = inventory
+        self.vm_memory = get_int_config_value('PLACEMENT_VM_MEMORY', 6656)
+        self.vm_cpus = get_int_config_value('PLACEMENT_VM_CPUS', 2)
+
+    def get_headroom(self, node):
+        """
+        :param node: node capacity dict
+        :return: number of firewalls that still fit on the node
+        """
+        if self.vm_memory <= 0 or self.vm_cpus <= 0:
+            return 0
+
+        return max(0, min(node['freemem'] // self.vm_memory, node['freecpu'] // self.vm_cpus))
+
+    def score(self, minion, node):
+        # higher is better, the minion name makes the order stable
+        return self.get_headroom(node), -node['vms'], node['freemem'], minion
+
+    @staticmethod
+    def describe(node):
+        return '%.1f GB memory and %s vCPUs free, %s VMs running' % (node['freemem'] / 1024.0, node['freecpu'],
+                                                                     node['vms'])
+
+    def place(self, count=1, pending=None, candidates=None):
+        """
+        Place one or more firewalls, spreading them over the nodes with the most headroom
+        :param count: number of firewalls to place
+        :param pending: dict of minion -> number of deployments queued but not yet built there. The placements
+        are expected to be queued and show up in these counts, so they are not reserved in the cached capacity
+        :param candidates: list of minions to choose from, defaults to all nodes
+        :return: list of dicts with 'minion', 'headroom' (firewalls that still fit after this one) and 'summary'
+        :raises PlacementError: when there is not enough capacity for all of them
+        """
+        capacity = self.inventory.get_capacity()
+        if candidates is not None:
+            capacity = {m: n for m, n in capacity.items() if m in candidates}
+
+        if not capacity:
+            raise PlacementError('Could not get the capacity of the compute nodes')
+
+        for minion, count_pending in (pending or dict()).items():
+            if minion in capacity:
+                capacity[minion]['freemem'] -= self.vm_memory * count_pending
+                capacity[minion]['freecpu'] -= self.vm_cpus * count_pending
+                capacity[minion]['vms'] += count_pending
+
+        placements = list()
+        for _ in range(count):
+            minion = max(capacity, key=lambda m: self.score(m, capacity[m]))
+            node = capacity[minion]
+            if self.get_headroom(node) < 1:
+                raise PlacementError('Not enough capacity for %s firewalls, %s placed before every compute node '
+                                     'was full' % (count, len(placements)))
+
+            node['freemem'] -= self.vm_memory
+            node['freecpu'] -= self.vm_cpus
+            node['vms'] += 1
+            placements.append({'minion': minion, 'headroom': self.get_headroom(node),
+                               'summary': self.describe(node)})
+
+        if pending is None:
+            # with pending counts these placements are queued and counted there, reserving them as well would
+            # count each one twice until the capacity is refreshed
+            self.inventory.reserve([p['minion'] for p in placements], self.vm_memory, self.vm_cpus)
+
+        metrics.registry.inc('vistoq_placements_total', value=len(placements),
+                             help_text='Firewalls placed on a compute node automatically')
+        return placements
+
+
+node_placer = NodePlacer(node_capacity)
@@ -0,0 +1,431 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr, escape
+
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.utils import timezone
+from pan_cnc.lib import cnc_utils
+
+from vistoq.lib import metrics
+from vistoq.lib.cache_utils import get_int_config_value
+from vistoq.lib.import_utils import lazy_import
+from vistoq.lib.snippet_index import snippet_index
+from vistoq.models import ProvisionBatch
+from vistoq.models import StagedTenant
+
+jinja2 = lazy_import('jinja2')
+pan_utils = lazy_import('pan_cnc.lib.pan_utils')
+pan_xapi = lazy_import('pan.xapi')
+
+
+def render_snippet(snippet_name, context):
+    """
+    Render the xpath and element of every snippet of a panos type service
+    :param snippet_name: name of the service, i.e. 'gsb_gold'
+    :param context: jinja context
+    :return: list of dicts with 'name', 'xpath' and 'element' keys, in the order they have to be applied
+    :raises ValueError: when the service can not be found or rendered
+    """
+    service = snippet_index.load_snippet_with_name(snippet_name)
+    if service is None:
+        raise ValueError('Could not find snippet with name %s' % snippet_name)
+
+    environment = jinja2.Environment(loader=jinja2.BaseLoader())
+    elements = list()
+    for snippet in service.get('snippets', None) or list():
+        if 'xpath' not in snippet or 'file' not in snippet:
+            continue
+
+        try:
+            with open(os.path.join(service['snippet_path'], snippet['file']), 'r') as snippet_file:
+                element_template = snippet_file.read()
+
+            element = dict()
+            element['name'] = snippet.get('name', snippet['file'])
+            element['xpath'] = environment.from_string(snippet['xpath']).render(context)
+            element['element'] = environment.from_string(element_template).render(context).strip()
+            elements.append(element)
+        except (IOError, jinja2.TemplateError) as e:
+            raise ValueError('Could not render %s of %s: %s' % (snippet.get('name', ''), snippet_name, e))
+
+    return elements
+
+
+def get_service_context(service, get_value):
+    """
+    Build the jinja context of a service from its variables
+    :param service: snippet metadata
+    :param get_value: function returning the value of a variable name, or None when it was not provided
+    :return: dict of variable name -> value, falling back to the variable defaults
+    """
+    context = dict()
+    for variable in service.get('variables', None) or list():
+        value = get_value(variable['name'])
+        context[variable['name']] = value if value is not None else variable.get('default', '')
+
+    return context
+
+
+class BatchProvisioner():
+    """
+    Stage the rendered Panorama configuration of many tenants and apply it in one go. Every staged element is set,
+    then Panorama is committed once and all device groups of the batch are pushed together with their template
+    stacks in a single push, so onboarding many tenants costs a fixed number of commits instead of one commit and
+    push per tenant. Only one batch commits at a time, as Panorama takes a commit lock
+    """
+    lock_key = 'vistoq.provision_batch.commit_lock'
+
+    def __init__(self):
+        self.commit_timeout = get_int_config_value('PANORAMA_COMMIT_TIMEOUT', 1800)
+        self.commit_interval = get_int_config_value('PANORAMA_COMMIT_POLL_INTERVAL', 5)
+        self.push = str(cnc_utils.get_config_value('PANORAMA_BATCH_PUSH', 'true')).lower() == 'true'
+        # a single commit or push may run for the commit timeout without reporting progress
+        self.stale_after = get_int_config_value('PROVISION_BATCH_STALE_AFTER', self.commit_timeout + 600)
+
+    @staticmethod
+    def create_batch(name=''):
+        return ProvisionBatch.objects.create(name=name)
+
+    def get_batch(self, batch_id):
+        self.reset_stale()
+        try:
+            return ProvisionBatch.objects.get(id=batch_id)
+        except (ProvisionBatch.DoesNotExist, ValueError):
+            return None
+
+    def get_recent_batches(self, limit=50):
+        self.reset_stale()
+        return list(ProvisionBatch.objects.order_by('-id')[:limit])
+
+    def reset_stale(self):
+        """
+        Fail the batches left applying by a process that died or was restarted, so they can be applied again
+        :return: number of batches reset
+        """
+        cutoff = timezone.now() - timedelta(seconds=self.stale_after)
+        return ProvisionBatch.objects.filter(status=ProvisionBatch.APPLYING, updated__lt=cutoff).update(
+            status=ProvisionBatch.FAILED, message='Interrupted while applying, apply the batch again to retry',
+            finished=timezone.now())
+
+    @staticmethod
+    def _progress(batch_id, message):
+        ProvisionBatch.objects.filter(id=batch_id).update(message=message, updated=timezone.now())
+
+    @staticmethod
+    def stage(batch, tenant, snippet_name, context, device_group='', stack=''):
+        """
+        Render a tenant configuration into an open batch
+        :param batch: ProvisionBatch
+        :param tenant: name of the tenant, such as the customer or firewall name
+        :param snippet_name: name of the panos service to render
+        :param context: jinja context of the service
+        :param device_group: device group to push for this tenant, if any
+        :param stack: template stack to push for this tenant, if any
+        :return: StagedTenant
+        :raises ValueError: when the batch is not open or the service can not be rendered
+        """
+        if batch.status != ProvisionBatch.OPEN:
+            raise ValueError('Batch %s has already been applied' % batch.id)
+
+        elements = render_snippet(snippet_name, context)
+        if not elements:
+            raise ValueError('Service %s has no Panorama configuration to stage' % snippet_name)
+
+        return StagedTenant.objects.create(batch=batch, tenant=tenant, snippet_name=snippet_name,
+                                           device_group=device_group, stack=stack, elements=json.dumps(elements))
+
+    def claim(self, batch_id):
+        """
+        Move an open or failed batch to the applying state so it can not be applied twice. The tenants of a failed
+        batch are staged again
+        :param batch_id: ProvisionBatch id
+        :return: True if the batch was open or failed and is now claimed
+        """
+        self.reset_stale()
+        claimed = ProvisionBatch.objects.filter(
+            id=batch_id, status__in=(ProvisionBatch.OPEN, ProvisionBatch.FAILED)).update(
+            status=ProvisionBatch.APPLYING, applied=timezone.now(), updated=timezone.now(), finished=None,
+            message='Waiting for the Panorama commit lock')
+        if claimed != 1:
+            return False
+
+        StagedTenant.objects.filter(batch_id=batch_id, status__in=(StagedTenant.APPLIED, StagedTenant.FAILED)).update(
+            status=StagedTenant.STAGED, message='')
+        return True
+
+    def start_apply(self, batch_id):
+        """
+        Apply an open batch on a background thread
+        :param batch_id: ProvisionBatch id
+        :return: True if the batch was open or failed and is now being applied
+        """
+        if not self.claim(batch_id):
+            return False
+
+        threading.Thread(target=self.apply, args=(batch_id,), name='provision-batch-%s' % batch_id,
+                         daemon=True).start()
+        return True
+
+    def apply(self, batch_id):
+        """
+        Set the configuration of every staged tenant, commit once and push the device groups and stacks at once
+        :param batch_id: id of a ProvisionBatch in the applying state
+        :return: None, the outcome is saved on the batch and each tenant
+        """
+        try:
+            # commits of other batches have to finish first
+            while not cache.add(self.lock_key, batch_id, self.commit_timeout):
+                self._progress(batch_id, 'Waiting for the Panorama commit lock')
+                time.sleep(self.commit_interval)
+        except Exception as e:
+            print('Could not wait for the Panorama commit lock for batch %s' % batch_id)
+            print(e)
+            self._fail(batch_id, e)
+            return
+
+        try:
+            self._apply(batch_id)
+        except Exception as e:
+            print('Could not apply provisioning batch %s' % batch_id)
+            print(e)
+            self._fail(batch_id, e)
+        finally:
+            cache.delete(self.lock_key)
+
+    def _hold_lock(self, batch_id):
+        # the lock expires after the commit timeout in case this worker dies, renew it before every step that may
+        # take that long so a batch with many tenants keeps it through the commit and the pushes
+        cache.set(self.lock_key, batch_id, self.commit_timeout)
+
+    @staticmethod
+    def _fail(batch_id, error):
+        try:
+            ProvisionBatch.objects.filter(id=batch_id).update(status=ProvisionBatch.FAILED, message=str(error),
+                                                              finished=timezone.now())
+        except DatabaseError as de:
+            # left applying, reset_stale fails it later
+            print('Could not save the outcome of provisioning batch %s' % batch_id)
+            print(de)
+
+    def _call(self, name, fn, **kwargs):
+        labels = {'call': name, 'status': ''}
+        with metrics.registry.timer('vistoq_panorama_request_seconds', labels,
+                                    'Latency of requests to Panorama') as labels:
+            try:
+                fn(**kwargs)
+                labels['status'] = 'success'
+            except pan_xapi.PanXapiError:
+                labels['status'] = 'failure'
+                raise
+
+    def _get_element(self, xapi, xpath):
+        """
+        :param xapi: PanXapi
+        :param xpath: xpath of the candidate configuration
+        :return: the element at the xpath as a string, or None when there is none
+        """
+        self._call('get_config', xapi.get, xpath=xpath)
+        try:
+            result = ElementTree.fromstring(xapi.xml_document).find('./result')
+        except (ElementTree.ParseError, TypeError):
+            raise pan_xapi.PanXapiError('Could not parse the configuration at %s' % xpath)
+
+        if result is None or len(result) == 0:
+            return None
+
+        return ElementTree.tostring(result[0], encoding='unicode')
+
+    def _revert(self, xapi, previous):
+        """
+        Put the elements a failed tenant changed back the way they were, newest first
+        :param xapi: PanXapi
+        :param previous: list of tuples of (xpath, element before the tenant or None)
+        :return: True when every element was reverted
+        """
+        for xpath, element in reversed(previous):
+            try:
+                if element is None:
+                    self._call('delete_config', xapi.delete, xpath=xpath)
+                else:
+                    self._call('edit_config', xapi.edit, xpath=xpath, element=element)
+            except pan_xapi.PanXapiError as pxe:
+                print('Could not revert the configuration at %s' % xpath)
+                print(pxe)
+                return False
+
+        return True
+
+    @staticmethod
+    def get_job_result(xapi):
+        """
+        :param xapi: PanXapi after a synchronous commit
+        :return: tuple of (success, message)
+        """
+        try:
+            doc = ElementTree.fromstring(xapi.xml_document)
+        except (ElementTree.ParseError, TypeError):
+            return xapi.status == 'success', str(xapi.status_detail or '')
+
+        result = doc.findtext('.//job/result', default='')
+        details = ' '.join(line.text.strip() for line in doc.iter('line') if line.text and line.text.strip())
+        if result == '':
+            # nothing to commit, or no devices to push to
+            return xapi.status == 'success', details or str(xapi.status_detail or '')
+
+        return result == 'OK', details or result
+
+    def _commit(self, xapi, name, cmd, action=None):
+        labels = {'call': name, 'status': ''}
+        with metrics.registry.timer('vistoq_panorama_request_seconds', labels,
+                                    'Latency of requests to Panorama') as labels:
+            try:
+                xapi.commit(cmd=cmd, action=action, sync=True, interval=self.commit_interval,
+                            timeout=self.commit_timeout)
+            except pan_xapi.PanXapiError as pxe:
+                labels['status'] = 'failure'
+                return False, str(pxe)
+
+            success, message = self.get_job_result(xapi)
+            labels['status'] = 'success' if success else 'failure'
+
+        metrics.registry.inc('vistoq_panorama_commits_total', {'type': name, 'status': labels['status']},
+                             help_text='Commits and pushes run on Panorama by provisioning batches')
+        return success, message
+
+    def _apply(self, batch_id):
+        xapi = pan_utils.panorama_login()
+        if xapi is None:
+            raise pan_xapi.PanXapiError('Could not login to Panorama')
+
+        tenants = list(StagedTenant.objects.filter(batch_id=batch_id, status=StagedTenant.STAGED))
+        dirty = list()
+        for tenant in tenants:
+            # the elements at each xpath before this tenant changed them, to revert a partly applied tenant
+            previous = list()
+            self._hold_lock(batch_id)
+            self._progress(batch_id, 'Applying configuration of %s' % tenant.tenant)
+            try:
+                for element in json.loads(tenant.elements):
+                    if element['xpath'] not in [xpath for xpath, p in previous]:
+                        previous.append((element['xpath'], self._get_element(xapi, element['xpath'])))
+
+                    self._call('set_config', xapi.set, xpath=element['xpath'], element=element['element'])
+
+                tenant.status = StagedTenant.APPLIED
+                tenant.message = 'Configuration applied'
+            except pan_xapi.PanXapiError as pxe:
+                print('Could not apply configuration of %s' % tenant.tenant)
+                print(pxe)
+                tenant.status = StagedTenant.FAILED
+                tenant.message = 'Could not apply configuration: %s' % pxe
+                if not self._revert(xapi, previous):
+                    dirty.append(tenant.tenant)
+                    tenant.message += ', and could not remove the part that was applied'
+
+            tenant.save(update_fields=['status', 'message'])
+
+        applied = [t for t in tenants if t.status == StagedTenant.APPLIED]
+        if dirty:
+            # committing now would also commit the half configured tenants
+            message = 'Not committed, the candidate configuration holds part of the configuration of %s' % \
+                      ', '.join(dirty)
+            for tenant in applied:
+                tenant.status = StagedTenant.FAILED
+                tenant.message = message
+                tenant.save(update_fields=['status', 'message'])
+
+            self._finish(batch_id, tenants, message)
+            return
+
+        if not applied:
+            self._finish(batch_id, tenants, 'No tenant configuration could be applied')
+            return
+
+        self._hold_lock(batch_id)
+        self._progress(batch_id, 'Committing to Panorama')
+        success, message = self._commit(xapi, 'commit', '<commit></commit>')
+        if not success:
+            for tenant in applied:
+                tenant.status = StagedTenant.FAILED
+                tenant.message = 'Panorama commit failed: %s' % message
+                tenant.save(update_fields=['status', 'message'])
+
+            self._finish(batch_id, tenants, 'Panorama commit failed: %s' % message)
+            return
+
+        push_results = dict()
+        pushes = 0
+        if self.push:
+            device_groups = sorted(set(t.device_group for t in applied if t.device_group))
+            if device_groups:
+                # include-template pushes the template stacks of the firewalls in these device groups as well, so
+                # tenants with a device group need no stack push of their own
+                self._hold_lock(batch_id)
+                self._progress(batch_id, 'Pushing %s device groups and their template stacks' % len(device_groups))
+                entries = ''.join('<entry name=%s/>' % quoteattr(device_group) for device_group in device_groups)
+                cmd = '<commit-all><shared-policy><device-group>%s</device-group>' \
+                      '<include-template>yes</include-template></shared-policy></commit-all>' % entries
+                result = self._commit(xapi, 'push_device_group', cmd, 'all')
+                pushes += 1
+                for device_group in device_groups:
+                    push_results[('device_group', device_group)] = result
+
+            # the template-stack push takes a single stack
+            for stack in sorted(set(t.stack for t in applied if t.stack and not t.device_group)):
+                self._hold_lock(batch_id)
+                self._progress(batch_id, 'Pushing template stack %s' % stack)
+                cmd = '<commit-all><template-stack><name>%s</name></template-stack></commit-all>' % escape(stack)
+                push_results[('stack', stack)] = self._commit(xapi, 'push_template_stack', cmd, 'all')
+                pushes += 1
+
+        for tenant in applied:
+            failures = list()
+            for key in (('device_group', tenant.device_group), ('stack', tenant.stack)):
+                if key in push_results and not push_results[key][0]:
+                    failures.append('push to %s %s failed: %s' % (key[0].replace('_', ' '), key[1],
+                                                                  push_results[key][1]))
+
+            if failures:
+                tenant.status = StagedTenant.FAILED
+                tenant.message = 'Committed, but ' + '; '.join(failures)
+            else:
+                tenant.status = StagedTenant.SUCCESS
+                tenant.message = 'Committed and pushed' if self.push else 'Committed'
+
+            tenant.save(update_fields=['status', 'message'])
+
+        self._finish(batch_id, tenants, '1 commit and %s pushes for %s tenants' % (pushes, len(tenants)))
+
+    @staticmethod
+    def _finish(batch_id, tenants, message):
+        succeeded = len([t for t in tenants if t.status == StagedTenant.SUCCESS])
+        if succeeded == len(tenants):
+            status = ProvisionBatch.SUCCESS
+        elif succeeded == 0:
+            status = ProvisionBatch.FAILED
+        else:
+            status = ProvisionBatch.PARTIAL
+
+        ProvisionBatch.objects.filter(id=batch_id).update(status=status, message=message, finished=timezone.now())
+
+
+batch_provisioner = BatchProvisioner()
@@ -13,14 +13,219 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 import json
-import os
-from pathlib import Path
+import random
+import threading
+import time
 
 import requests
-from django.conf import settings
-from jinja2 import Environment, BaseLoader
-from requests.exceptions import ConnectionError
-from pan_cnc.lib import snippet_utils
+from django.core.cache import cache
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, RequestException, Timeout
+from pan_cnc.lib import cnc_utils
+
+from vistoq.lib import metrics
+from vistoq.lib import operator_utils
+
+# keep-alive sessions to the provisioner, one per salt-api base url
+_session_lock = threading.Lock()
+_sessions = dict()
+
+
+def get_session(base_url, pool_size=10):
+    """
+    Return a shared requests.Session for the given salt-api base url. The session keeps connections to the
+    provisioner alive between calls so each salt call costs a single http request
+    :param base_url: salt-api url such as http://provisioner:9000
+    :param pool_size: max number of pooled connections to keep open to the provisioner
+    :return: requests.Session
+    """
+    with _session_lock:
+        if base_url not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({'Accept': 'application/json'})
+            _sessions[base_url] = session
+
+        return _sessions[base_url]
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Raised instead of sending a request while the circuit breaker for the provisioner is open
+    """
+    pass
+
+
+class CircuitBreaker():
+    """
+    Fail fast while the provisioner is unhealthy. After 'threshold' consecutive failures the breaker opens and all
+    requests fail immediately for 'reset_timeout' seconds. A single trial request is then let through, closing the
+    breaker again if it succeeds
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.opened is None:
+                return True
+
+            if time.time() - self.opened < self.reset_timeout or self._trial_running:
+                return False
+
+            # half open, let a single trial request through
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.failures >= self.threshold:
+                if self.opened is None:
+                    print('Opening circuit breaker to the provisioner after %s failures' % self.failures)
+
+                self.opened = time.time()
+
+    def is_open(self):
+        return self.opened is not None
+
+
+_breaker_lock = threading.Lock()
+_breakers = dict()
+
+
+def get_circuit_breaker(base_url):
+    """
+    :param base_url: salt-api base url
+    :return: the process wide CircuitBreaker for this provisioner
+    """
+    with _breaker_lock:
+        if base_url not in _breakers:
+            threshold = int(cnc_utils.get_config_value('SALT_BREAKER_THRESHOLD', 5))
+            reset_timeout = int(cnc_utils.get_config_value('SALT_BREAKER_RESET', 30))
+            _breakers[base_url] = CircuitBreaker(threshold, reset_timeout)
+
+        return _breakers[base_url]
+
+
+class SaltAuthTokenCache():
+    """
+    Process wide cache of salt-api auth tokens. Tokens are kept in memory along with the expire time reported by
+    salt-api and are also written to the django cache, so all gunicorn workers share a single login when that cache
+    is shared between them, see docs/running.rst. Tokens that are close to expiring are refreshed in a background
+    thread while the current token is still handed out
+    """
+    # refresh tokens in the background once they are within this many seconds of expiring
+    refresh_margin = 300
+    # tokens this close to expiring are considered already expired
+    expire_margin = 10
+
+    def __init__(self):
+        self._tokens = dict()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    @staticmethod
+    def cache_key(salt_util):
+        return 'vistoq.salt_auth_token.%s@%s' % (salt_util.username, salt_util.base_url)
+
+    def get_token(self, salt_util):
+        """
+        Get a valid auth token for the given SaltUtil, logging in only when no usable token is cached
+        :param salt_util: SaltUtil instance holding the base_url and credentials
+        :return: token string or None if we could not login
+        """
+        key = self.cache_key(salt_util)
+        now = time.time()
+
+        token_info = self._tokens.get(key, None)
+        if token_info is None or token_info['expire'] - self.expire_margin < now:
+            token_info = cache.get(key)
+            if token_info is not None:
+                self._tokens[key] = token_info
+
+        if token_info is not None and token_info['expire'] - self.expire_margin > now:
+            if token_info['expire'] - self.refresh_margin < now:
+                metrics.registry.cache_hit('salt_auth_token', 'stale')
+                self._refresh_in_background(key, salt_util)
+            else:
+                metrics.registry.cache_hit('salt_auth_token', 'hit')
+
+            return token_info['token']
+
+        metrics.registry.cache_hit('salt_auth_token', 'miss')
+
+        # no valid token found, we have to wait on a new login
+        with self._lock:
+            # another thread may have logged in while we waited on the lock
+            token_info = self._tokens.get(key, None)
+            if token_info is not None and token_info['expire'] - self.expire_margin > time.time():
+                return token_info['token']
+
+            token_info = self._login(key, salt_util)
+
+        if token_info is None:
+            return None
+
+        return token_info['token']
+
+    def invalidate(self, salt_util):
+        """
+        Drop the cached token for this SaltUtil, used when salt-api rejects a token we believed was still valid
+        :param salt_util: SaltUtil instance
+        :return: None
+        """
+        key = self.cache_key(salt_util)
+        self._tokens.pop(key, None)
+        cache.delete(key)
+
+    def _login(self, key, salt_util):
+        token_info = salt_util.login()
+        if token_info is None:
+            return None
+
+        self._tokens[key] = token_info
+        timeout = int(token_info['expire'] - time.time())
+        if timeout > 0:
+            cache.set(key, token_info, timeout)
+
+        return token_info
+
+    def _refresh_in_background(self, key, salt_util):
+        with self._lock:
+            if key in self._refreshing:
+                return
+
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._login(key, salt_util)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        t = threading.Thread(target=refresh, name='salt-token-refresh', daemon=True)
+        t.start()
+
+
+token_cache = SaltAuthTokenCache()
 
 
 class SaltUtil():
@@ -29,99 +234,439 @@ class SaltUtil():
     base_url = "http://provisioner:9000"
     login_url = '/login'
     auth_token = ''
+    pool_size = 10
+    connect_timeout = 3.05
+    # default read timeouts in seconds by endpoint or salt function, override with SALT_READ_TIMEOUTS
+    read_timeouts = {
+        'default': 60,
+        'login': 15,
+        '/minions': 30,
+        '/jobs': 15,
+        'virt.vm_state': 30,
+        'state.apply create_ngfw': 1800,
+        'state.apply delete_all_ngfw': 600,
+        'state.apply delete_all_vms': 1800,
+    }
+    # salt functions that only read state and are safe to retry
+    idempotent_functions = ('login', 'virt.vm_state', 'virt.freemem', 'virt.freecpu', 'virt.list_domains', 'test.ping',
+                            'grains.items', 'grains.item')
+    retry_attempts = 3
+    retry_backoff = 0.5
 
-    def __get_salt_auth_token(self):
+    def __init__(self):
+        self.username = cnc_utils.get_config_value('SALT_USERNAME', self.username)
+        self.password = cnc_utils.get_config_value('SALT_PASSWORD', self.password)
+        self.base_url = cnc_utils.get_config_value('SALT_API_URL', self.base_url)
+        self.session = get_session(self.base_url, self.pool_size)
+        self.breaker = get_circuit_breaker(self.base_url)
+        self.connect_timeout = float(cnc_utils.get_config_value('SALT_CONNECT_TIMEOUT', self.connect_timeout))
+        self.retry_attempts = int(cnc_utils.get_config_value('SALT_RETRY_ATTEMPTS', self.retry_attempts))
+        self.record_history = str(cnc_utils.get_config_value('HISTORY_ENABLED', 'true')).lower() == 'true'
+        self.read_timeouts = dict(self.read_timeouts)
+        # i.e. SALT_READ_TIMEOUTS='{"virt.vm_state": 20, "state.apply create_ngfw": 2400}'
+        read_timeouts = cnc_utils.get_config_value('SALT_READ_TIMEOUTS', '')
+        if read_timeouts:
+            try:
+                self.read_timeouts.update(json.loads(read_timeouts))
+            except ValueError:
+                print('Could not parse SALT_READ_TIMEOUTS, using defaults')
 
-        try:
-            print('Here we go')
-            # FIXME - check timeout here
-            if self.auth_token != '':
-                print('we have an auth token already')
-                return True
-            else:
-                print('No auth token found!')
+    def get_read_timeout(self, labels):
+        return float(self.read_timeouts.get(labels['function'],
+                                            self.read_timeouts.get(labels['endpoint'], self.read_timeouts['default'])))
 
-            _auth_json = """
-               {
-                "username" : "%s",
-                "password" : "%s",
-                "eauth": "pam"
-                }
-                """ % (self.username, self.password)
-            print(_auth_json)
-            aj = json.loads(_auth_json)
-            headers = {"Content-Type": "application/json"}
-
-            url = self.base_url + self.login_url
-            print('Using url: %s' % url)
-            res = requests.post(url, json=aj, headers=headers)
-            print(res)
-            if res.status_code == 200:
-                json_results = res.json()
-                if 'return' in json_results:
-                    self._auth_token = json_results['return'][0]['token']
-                    print(self._auth_token)
-                    return True
-                else:
-                    return False
+    def get_timeout(self, labels, payload=None):
+        """
+        :param labels: request labels as returned by get_request_labels
+        :param payload: list of lowstate dicts of the request or None
+        :return: tuple of (connect timeout, read timeout) for this request
+        """
+        if not isinstance(payload, list) or len(payload) < 2:
+            return self.connect_timeout, self.get_read_timeout(labels)
 
-            else:
+        # salt-api runs the chunks of a payload one after another, such as every build of a batch on one node
+        read_timeout = 0
+        for lowstate in payload:
+            read_timeout += self.get_read_timeout(self.get_request_labels(labels['endpoint'], [lowstate]))
+
+        return self.connect_timeout, read_timeout
+
+    def is_idempotent(self, method, labels):
+        if method == 'GET':
+            return True
+
+        functions = labels['function'].split(',')
+        return all(f in self.idempotent_functions for f in functions)
+
+    def login(self):
+        """
+        Perform a PAM login against salt-api
+        :return: dict containing the 'token' and the 'expire' time in epoch seconds or None on error
+        """
+        auth_json = {
+            "username": self.username,
+            "password": self.password,
+            "eauth": "pam"
+        }
+
+        url = self.base_url + self.login_url
+        print('Logging in to salt-api at: %s' % url)
+        try:
+            res = self._send('POST', url, self.login_url, auth_json, dict())
+            if res.status_code != 200:
                 print(res.text)
+                return None
+
+            json_results = res.json()
+            if 'return' not in json_results:
+                return None
+
+            login_details = json_results['return'][0]
+            token_info = dict()
+            token_info['token'] = login_details['token']
+            # salt-api reports the expire time of the token, default to the salt default of 12 hours
+            token_info['expire'] = float(login_details.get('expire', time.time() + 43200))
+            return token_info
+
+        except RequestException as re:
+            print(re)
+            return None
+        except (ValueError, KeyError, IndexError) as e:
+            print('Could not parse login response from salt-api')
+            print(e)
+            return None
+
+    def __get_salt_auth_token(self):
+
+        try:
+            token = token_cache.get_token(self)
+            if token is None:
+                print('No auth token found!')
                 return False
 
-        except ConnectionError as ce:
-            print(ce)
-            return False
+            self.auth_token = token
+            return True
+
         except Exception as e:
             print(e)
             return False
 
+    def _request(self, method, path, payload=None):
+        """
+        Send an authenticated request to salt-api using the pooled session. If salt-api rejects our cached token
+        it is dropped and the request is retried once with a fresh login
+        :param method: http method, GET or POST
+        :param path: url path such as '/' or '/minions'
+        :param payload: optional json payload
+        :return: requests.Response
+        """
+        url = self.base_url + path
+        headers = {"X-Auth-Token": self.auth_token}
+        res = self._send(method, url, path, payload, headers)
+        if res.status_code == 401:
+            print('Auth token rejected by salt-api, logging in again')
+            token_cache.invalidate(self)
+            if not self.__get_salt_auth_token():
+                return res
+
+            headers = {"X-Auth-Token": self.auth_token}
+            res = self._send(method, url, path, payload, headers)
+
+        return res
+
+    @staticmethod
+    def get_request_labels(path, payload):
+        """
+        Build the metric labels of a salt-api request
+        :param path: url path of the request
+        :param payload: list of lowstate dicts or None
+        :return: dict of endpoint, function and minion labels, the minion is 'multi' for calls on more than one
+        """
+        labels = dict()
+        # /jobs/<jid> is reported as /jobs to keep the number of series bounded
+        labels['endpoint'] = '/' + path.strip('/').split('/')[0]
+        labels['function'] = ''
+        labels['minion'] = ''
+        if labels['endpoint'] == '/login':
+            labels['function'] = 'login'
+        elif payload:
+            lowstate = payload[0]
+            labels['function'] = lowstate.get('fun', '')
+            if isinstance(labels['function'], list):
+                # compound command
+                labels['function'] = ','.join(labels['function'])
+            elif lowstate.get('fun', '') == 'state.apply' and lowstate.get('arg', None):
+                labels['function'] = 'state.apply %s' % lowstate['arg'][0]
+
+            tgt = lowstate.get('tgt', '')
+            if isinstance(tgt, list) and len(tgt) == 1:
+                tgt = tgt[0]
+
+            # calls on many minions share one label to keep the number of series bounded
+            if isinstance(tgt, list) or lowstate.get('tgt_type', 'glob') != 'glob' or \
+                    any(c in str(tgt) for c in '*?[,'):
+                labels['minion'] = 'multi'
+            else:
+                labels['minion'] = str(tgt)
+
+        return labels
+
+    def _send(self, method, url, path, payload, headers):
+        """
+        Send a request through the circuit breaker with the timeouts of its salt function. Idempotent requests are
+        retried with jittered exponential backoff on connection errors, timeouts and 5xx responses. Other requests
+        are only retried when the connection could not be established, as salt never received them
+        :raises CircuitOpenError: when the provisioner is considered unhealthy
+        :raises RequestException: when the request failed after all attempts
+        """
+        request_labels = self.get_request_labels(path, payload)
+        timeout = self.get_timeout(request_labels, payload)
+        idempotent = self.is_idempotent(method, request_labels)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            if not self.breaker.allow_request():
+                metrics.registry.inc('vistoq_salt_api_circuit_open_total', {'endpoint': request_labels['endpoint']},
+                                     help_text='Requests rejected while the salt-api circuit breaker was open')
+                raise CircuitOpenError('Provisioner is unavailable, not sending request to %s' % path)
+
+            labels = dict(request_labels)
+            labels['status'] = ''
+            try:
+                with metrics.registry.timer('vistoq_salt_api_request_seconds', labels,
+                                            'Latency of requests to salt-api') as labels:
+                    res = self.session.request(method, url, json=payload, headers=headers, timeout=timeout)
+                    labels['status'] = str(res.status_code)
+
+            except RequestException as re:
+                self.breaker.record_failure()
+                retryable = idempotent or isinstance(re, ConnectTimeout) or \
+                    (isinstance(re, ConnectionError) and not isinstance(re, Timeout) and self._not_sent(re))
+                if not retryable or attempt >= self.retry_attempts:
+                    raise
+
+                self._backoff(attempt, path, re)
+                continue
+            except Exception:
+                # anything else still has to end a half open trial, or the breaker would never close again
+                self.breaker.record_failure()
+                raise
+
+            if res.status_code >= 500:
+                self.breaker.record_failure()
+                if idempotent and attempt < self.retry_attempts:
+                    self._backoff(attempt, path, res.status_code)
+                    continue
+            else:
+                self.breaker.record_success()
+
+            return res
+
+    @staticmethod
+    def _not_sent(error):
+        # connection refused / name resolution errors happen before anything is sent
+        message = str(error).lower()
+        return 'refused' in message or 'name or service not known' in message or 'failed to establish' in message
+
+    def _backoff(self, attempt, path, reason):
+        # full jitter exponential backoff
+        delay = random.uniform(0, self.retry_backoff * (2 ** (attempt - 1)))
+        print('Retrying request to %s in %.2f seconds: %s' % (path, delay, reason))
+        metrics.registry.inc('vistoq_salt_api_retries_total', {'endpoint': '/' + path.strip('/').split('/')[0]},
+                             help_text='Retried requests to salt-api')
+        time.sleep(delay)
+
     def get_minion_list(self):
 
-        print('HERE WE GO')
         minion_list = list()
         if not self.__get_salt_auth_token():
             print('Could not connect to provisioner')
             return minion_list
 
-        url = self.base_url + '/minions'
-        headers = {"X-Auth-Token": self._auth_token}
-        res = requests.get(url, headers=headers)
-        print(res)
-        print(res.text)
-        minion_list_json = res.json()
-        print(minion_list_json)
+        try:
+            res = self._request('GET', '/minions')
+        except RequestException as re:
+            print(re)
+            return minion_list
 
         if res.status_code != 200:
             print('Invalid return code')
             return minion_list
 
+        minion_list_json = res.json()
         if 'return' not in minion_list_json:
             print('Invalid return data')
             return minion_list
 
         return_dict = minion_list_json['return'][0]
         for m in list(return_dict.keys()):
-            print(m)
             minion_list.append(m)
 
         return minion_list
 
     def deploy_template(self, template):
+        payload_json = json.loads(template)
+        return self.deploy_payload(payload_json)
+
+    def deploy_payload(self, payload_json):
+        """
+        Send a salt payload to the provisioner. The call and its result are recorded in the deployment history
+        :param payload_json: list of salt lowstate dicts, such as returned by SnippetRegistry.render_payload
+        :return: response text from the provisioner
+        """
+        started = timezone.now()
         if not self.__get_salt_auth_token():
             print('Could not connect to provisioner')
-            return 'Could not login to provisioner!'
+            res_text = 'Could not login to provisioner!'
+        else:
+            try:
+                res = self._request('POST', '/', payload_json)
+                print(res.status_code)
+                res_text = res.text
+            except RequestException as re:
+                print(re)
+                res_text = 'Error during deploy'
 
-        url = self.base_url + '/'
-        headers = {"X-Auth-Token": self._auth_token}
-        payload_json = json.loads(template)
+        self._record(payload_json, res_text, started)
+        return res_text
+
+    def _record(self, payload_json, response, started, jid=None):
+        """
+        Record a call in the deployment history. Reads such as virt.vm_state are only recorded when an operator
+        asked for them, the background inventory refreshes would otherwise flood the history
+        """
+        if not self.record_history or not payload_json:
+            return
+
+        labels = self.get_request_labels('/', payload_json)
+        if operator_utils.get_operator() == '' and self.is_idempotent('POST', labels):
+            return
+
+        try:
+            # the history pulls in the django models, so it is only imported once it is needed
+            from vistoq.lib import history_utils
+            if jid is None:
+                history_utils.record_salt_call(payload_json, response, started)
+            else:
+                history_utils.record_submission(payload_json, jid, started)
+        except Exception as e:
+            print('Could not record %s in the deployment history' % labels['function'])
+            print(e)
+
+    def submit_job(self, template):
+        """
+        Submit a rendered salt payload through the local_async client. Salt returns the job id right away and the
+        job continues to run on the minion
+        :param template: rendered payload template string such as provision_ngfw.j2 or the payload itself
+        :return: job id string or None on error
+        """
+        if not self.__get_salt_auth_token():
+            print('Could not connect to provisioner')
+            return None
+
+        if isinstance(template, str):
+            payload_json = json.loads(template)
+        else:
+            payload_json = [dict(lowstate) for lowstate in template]
+
+        for lowstate in payload_json:
+            lowstate['client'] = 'local_async'
+
+        started = timezone.now()
+        try:
+            res = self._request('POST', '/', payload_json)
+        except RequestException as re:
+            print(re)
+            self._record(payload_json, 'Error submitting job: %s' % re, started)
+            return None
+
+        if res.status_code != 200:
+            print('Invalid return code submitting job: %s' % res.status_code)
+            self._record(payload_json, 'Invalid return code submitting job: %s' % res.status_code, started)
+            return None
+
+        try:
+            # {"return": [{"jid": "20190128193017123456", "minions": ["compute-01.c.vistoq-demo.internal"]}]}
+            jid = res.json()['return'][0]['jid']
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            print('Could not get jid from provisioner response')
+            print(e)
+            self._record(payload_json, 'Could not get jid from provisioner response', started)
+            return None
+
+        self._record(payload_json, '', started, jid)
+        return jid
+
+    def open_event_stream(self, read_timeout=60):
+        """
+        Open the salt-api /events server sent events stream. The stream is long lived so it does not go through the
+        retries and circuit breaker of regular requests, callers reconnect on their own
+        :param read_timeout: seconds without any data, salt-api sends a retry line and events, before giving up
+        :return: streaming requests.Response or None on error
+        """
+        if not self.__get_salt_auth_token():
+            print('Could not connect to provisioner')
+            return None
+
+        url = self.base_url + '/events'
         try:
-            res = requests.post(url, json=payload_json, headers=headers)
-            print(res.status_code)
-            return res.text
-        except ConnectionError as ce:
-            print(ce)
-            return 'Error during deploy'
+            res = self.session.get(url, headers={'X-Auth-Token': self.auth_token, 'Accept': 'text/event-stream'},
+                                   stream=True, timeout=(self.connect_timeout, read_timeout))
+        except RequestException as re:
+            print(re)
+            return None
+
+        if res.status_code == 401:
+            print('Auth token rejected by salt-api /events')
+            token_cache.invalidate(self)
+            res.close()
+            return None
+
+        if res.status_code != 200:
+            print('Invalid return code from /events: %s' % res.status_code)
+            res.close()
+            return None
+
+        return res
+
+    def get_job(self, jid):
+        """
+        Look up a job from the salt job cache
+        :param jid: salt job id
+        :return: dict containing the targeted 'minions' and the 'return' dict of each minion that has returned so
+        far, or None on error
+        """
+        if not self.__get_salt_auth_token():
+            print('Could not connect to provisioner')
+            return None
+
+        try:
+            res = self._request('GET', '/jobs/%s' % jid)
+        except RequestException as re:
+            print(re)
+            return None
+
+        if res.status_code != 200:
+            print('Invalid return code looking up job %s: %s' % (jid, res.status_code))
+            return None
+
+        try:
+            job_json = res.json()
+            job = dict()
+            job['minions'] = list()
+            if 'info' in job_json and len(job_json['info']) > 0:
+                job['minions'] = job_json['info'][0].get('Minions', list())
+
+            job['return'] = dict()
+            if 'return' in job_json and len(job_json['return']) > 0:
+                job['return'] = job_json['return'][0]
+
+            return job
+        except (ValueError, AttributeError) as e:
+            print('Could not parse job %s from provisioner' % jid)
+            print(e)
+            return None
 
     # def deploy_service(self, service, context):
     #     if not self.__get_salt_auth_token():
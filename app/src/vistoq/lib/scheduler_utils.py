@@ -0,0 +1,366 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import json
+import threading
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.db import transaction
+from django.utils import timezone
+from pan_cnc.lib import cnc_utils
+
+from vistoq.lib import history_utils
+from vistoq.lib import job_utils
+from vistoq.lib import metrics
+from vistoq.lib import operator_utils
+from vistoq.lib.cache_utils import get_int_config_value
+from vistoq.models import DeployRequest
+
+
+class DeployScheduler():
+    """
+    Database backed queue of firewall deployments. Requests are dispatched to salt as background jobs in the order
+    they were queued, at most DEPLOY_MAX_PER_MINION builds run on a compute node and DEPLOY_MAX_CONCURRENT builds
+    run in total. The queue is kept in the database so it survives restarts, every web worker runs a scheduler
+    thread while there is work and requests are claimed in a database transaction that locks the active rows, so
+    the caps hold however many workers dispatch
+    """
+    estimate_key = 'vistoq.deploy_scheduler.estimates'
+
+    def __init__(self):
+        self.enabled = str(cnc_utils.get_config_value('DEPLOY_QUEUE_ENABLED', 'false')).lower() == 'true'
+        self.max_per_minion = get_int_config_value('DEPLOY_MAX_PER_MINION', 1)
+        self.max_concurrent = get_int_config_value('DEPLOY_MAX_CONCURRENT', 8)
+        self.interval = get_int_config_value('DEPLOY_SCHEDULER_INTERVAL', 5)
+        self.submit_attempts = get_int_config_value('DEPLOY_SUBMIT_ATTEMPTS', 3)
+        # expected build time in seconds until there is history to go on
+        self.default_build_time = get_int_config_value('DEPLOY_ETA_DEFAULT', 900)
+        self._thread = None
+        self._pending = False
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def enqueue(self, payload, minion, vm_name='', request_key=''):
+        """
+        Queue a deployment
+        :param payload: rendered payload as a list of salt lowstate dicts
+        :param minion: minion targeted by the payload
+        :param vm_name: name of the VM being built
+        :param request_key: idempotency key of the submission
+        :return: DeployRequest or None if it could not be saved
+        """
+        try:
+            request = DeployRequest.objects.create(minion=minion, vm_name=vm_name, payload=json.dumps(payload),
+                                                   request_key=request_key, operator=operator_utils.get_operator())
+        except DatabaseError as de:
+            print('Could not queue deployment of %s on %s' % (vm_name, minion))
+            print(de)
+            return None
+
+        metrics.registry.inc('vistoq_deploy_requests_total', {'status': 'queued'},
+                             help_text='Deployments queued and finished by the deploy scheduler')
+        self.ensure_started()
+        return request
+
+    @staticmethod
+    def find_active(request_key):
+        """
+        :param request_key: idempotency key of a submission
+        :return: the queued or running DeployRequest submitted with this key or None
+        """
+        if not request_key:
+            return None
+
+        active = DeployRequest.objects.filter(request_key=request_key,
+                                              status__in=(DeployRequest.QUEUED, DeployRequest.RUNNING))
+        return active.order_by('id').first()
+
+    def cancel(self, request_id):
+        """
+        Cancel a deployment that has not been dispatched yet
+        :param request_id: DeployRequest id
+        :return: True if the request was cancelled
+        """
+        updated = DeployRequest.objects.filter(id=request_id, status=DeployRequest.QUEUED).update(
+            status=DeployRequest.CANCELLED, message='Cancelled before it was started', finished=timezone.now())
+        return updated == 1
+
+    def ensure_started(self):
+        """
+        Start the scheduler thread of this process, or wake it up when it is already running
+        :return: None
+        """
+        with self._lock:
+            self._pending = True
+            self._wake.set()
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            self._thread = threading.Thread(target=self._run, name='deploy-scheduler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._pending = False
+                self._wake.clear()
+
+            active = True
+            try:
+                active = self.process()
+            except Exception as e:
+                print('Error running the deploy scheduler')
+                print(e)
+
+            if not active:
+                with self._lock:
+                    # stop unless something was queued while we were busy
+                    if not self._pending:
+                        self._thread = None
+                        return
+
+                continue
+
+            self._wake.wait(self.interval)
+
+    def process(self):
+        """
+        Update the running requests from their salt jobs and dispatch queued requests into the free slots
+        :return: True while there are queued or running requests
+        """
+        self._sync_running()
+        self._dispatch()
+
+        return DeployRequest.objects.filter(status__in=(DeployRequest.QUEUED, DeployRequest.RUNNING)).exists()
+
+    def _sync_running(self):
+        for request in DeployRequest.objects.filter(status=DeployRequest.RUNNING):
+            if request.jid == '':
+                # claimed by a worker that stopped before it could submit the job
+                if request.started is None or (timezone.now() - request.started).total_seconds() > 60:
+                    DeployRequest.objects.filter(id=request.id, status=DeployRequest.RUNNING, jid='').update(
+                        status=DeployRequest.QUEUED, started=None)
+
+                continue
+
+            job = job_utils.job_tracker.get_job(request.jid)
+            if job is None:
+                # the job record was lost with the cache on restart, poll salt for it again
+                submitted = request.started.timestamp() if request.started else None
+                job = job_utils.job_tracker.track(request.jid, request.minion, request.vm_name, submitted)
+
+            if job['status'] == 'running':
+                continue
+
+            status = DeployRequest.SUCCESS if job['status'] == 'success' else DeployRequest.FAILED
+            finished = timezone.now()
+            updated = DeployRequest.objects.filter(id=request.id, status=DeployRequest.RUNNING).update(
+                status=status, message=job['message'], finished=finished)
+            if updated == 1 and request.started is not None:
+                metrics.registry.inc('vistoq_deploy_requests_total', {'status': status},
+                                     help_text='Deployments queued and finished by the deploy scheduler')
+                metrics.registry.observe('vistoq_deploy_build_seconds', (finished - request.started).total_seconds(),
+                                         {'status': status}, help_text='Time from dispatch to the end of a build')
+
+    def _claim(self):
+        """
+        Move the queued requests that fit within the caps to running. The queued and running rows are locked until
+        the claim commits, so a dispatcher in another worker waits and then sees the claimed requests as running
+        :return: list of claimed DeployRequests, in queue order
+        """
+        claimed = list()
+        with transaction.atomic():
+            active = list(DeployRequest.objects.select_for_update().filter(
+                status__in=(DeployRequest.QUEUED, DeployRequest.RUNNING)).order_by('id'))
+            running = dict()
+            for request in active:
+                if request.status == DeployRequest.RUNNING:
+                    running[request.minion] = running.get(request.minion, 0) + 1
+
+            total = sum(running.values())
+            for request in active:
+                if total >= self.max_concurrent:
+                    break
+
+                if request.status != DeployRequest.QUEUED or running.get(request.minion, 0) >= self.max_per_minion:
+                    continue
+
+                DeployRequest.objects.filter(id=request.id).update(
+                    status=DeployRequest.RUNNING, started=timezone.now(), message='Submitting job to the provisioner')
+                running[request.minion] = running.get(request.minion, 0) + 1
+                total += 1
+                claimed.append(request)
+
+        return claimed
+
+    def _dispatch(self):
+        claimed = self._claim()
+        for index, request in enumerate(claimed):
+            # _sync_running requeues claims that were not submitted within a minute, renew ours right before
+            renewed = DeployRequest.objects.filter(id=request.id, status=DeployRequest.RUNNING, jid='').update(
+                started=timezone.now())
+            if renewed != 1:
+                continue
+
+            # recorded in the deployment history under the user who queued it
+            with operator_utils.acting_as(request.operator):
+                job = job_utils.job_tracker.submit(json.loads(request.payload), request.minion, request.vm_name)
+            if job is not None:
+                DeployRequest.objects.filter(id=request.id).update(jid=job['jid'], message=job['message'])
+                continue
+
+            request.attempts += 1
+            if request.attempts >= self.submit_attempts:
+                DeployRequest.objects.filter(id=request.id).update(
+                    status=DeployRequest.FAILED, attempts=request.attempts, finished=timezone.now(),
+                    message='Error deploying VM! Could not submit job to the provisioner')
+                continue
+
+            # salt is unavailable, put this and the other claimed requests back at the head of the queue
+            DeployRequest.objects.filter(id=request.id).update(
+                status=DeployRequest.QUEUED, attempts=request.attempts, started=None,
+                message='Could not submit job to the provisioner, will retry')
+            for later in claimed[index + 1:]:
+                DeployRequest.objects.filter(id=later.id).update(status=DeployRequest.QUEUED, started=None,
+                                                                 message='')
+            return
+
+    @staticmethod
+    def get_pending_counts():
+        """
+        :return: dict of minion -> number of queued deployments, used to reserve capacity for them
+        """
+        pending = dict()
+        for minion in DeployRequest.objects.filter(status=DeployRequest.QUEUED).values_list('minion', flat=True):
+            pending[minion] = pending.get(minion, 0) + 1
+
+        return pending
+
+    def get_build_estimates(self):
+        """
+        Median build time of the recent successful deployments of each compute node, taken from dispatch to
+        completion so it includes the time salt spends outside of the states
+        :return: dict of minion -> seconds, the '*' key holds the median over all compute nodes
+        """
+        estimates = cache.get(self.estimate_key)
+        if estimates is not None:
+            return estimates
+
+        since = timezone.now() - timedelta(days=30)
+        builds = DeployRequest.objects.filter(status=DeployRequest.SUCCESS, finished__gte=since,
+                                              started__isnull=False)
+        durations = dict()
+        for minion, started, finished in builds.values_list('minion', 'started', 'finished'):
+            seconds = (finished - started).total_seconds()
+            durations.setdefault(minion, list()).append(seconds)
+            durations.setdefault('*', list()).append(seconds)
+
+        estimates = dict()
+        for minion, values in durations.items():
+            estimates[minion] = history_utils.percentile(sorted(values), 50)
+
+        estimates.setdefault('*', self.default_build_time)
+        cache.set(self.estimate_key, estimates, 300)
+        return estimates
+
+    def get_queue(self):
+        """
+        List the running and queued deployments. The start time of each queued request is estimated by replaying
+        the dispatch rules against the expected build time of each compute node
+        :return: dict with 'running' and 'queued' lists of request dicts. Queued requests have their 'position' in
+        the queue, their 'minion_position' on the compute node and 'eta', the expected seconds until they start
+        """
+        estimates = self.get_build_estimates()
+        now = timezone.now()
+
+        # time from now at which each busy slot frees up
+        minion_slots = dict()
+        global_slots = list()
+        running = list()
+        for request in DeployRequest.objects.filter(status=DeployRequest.RUNNING):
+            build_time = estimates.get(request.minion, estimates['*'])
+            elapsed = (now - request.started).total_seconds() if request.started else 0
+            remaining = max(build_time - elapsed, 0)
+            minion_slots.setdefault(request.minion, list()).append(remaining)
+            global_slots.append(remaining)
+            item = self.to_dict(request)
+            item['eta_finish'] = int(remaining)
+            running.append(item)
+
+        queued = list()
+        minion_positions = dict()
+        for position, request in enumerate(DeployRequest.objects.filter(status=DeployRequest.QUEUED), start=1):
+            slots = minion_slots.setdefault(request.minion, list())
+            start = 0
+            if len(slots) >= self.max_per_minion:
+                start = max(start, min(slots))
+            if len(global_slots) >= self.max_concurrent:
+                start = max(start, min(global_slots))
+
+            # this request takes over the first slot to free up on its node and overall
+            if len(slots) >= self.max_per_minion:
+                slots.remove(min(slots))
+            if len(global_slots) >= self.max_concurrent:
+                global_slots.remove(min(global_slots))
+
+            finish = start + estimates.get(request.minion, estimates['*'])
+            slots.append(finish)
+            global_slots.append(finish)
+
+            minion_positions[request.minion] = minion_positions.get(request.minion, 0) + 1
+            item = self.to_dict(request)
+            item['position'] = position
+            item['minion_position'] = minion_positions[request.minion]
+            item['eta'] = int(start)
+            item['eta_finish'] = int(finish)
+            queued.append(item)
+
+        return {'running': running, 'queued': queued}
+
+    def get_request(self, request_id):
+        """
+        :param request_id: DeployRequest id
+        :return: request dict, with the queue position and eta while it is queued, or None if not found
+        """
+        try:
+            request = DeployRequest.objects.get(id=request_id)
+        except (DeployRequest.DoesNotExist, ValueError):
+            return None
+
+        if request.status in (DeployRequest.QUEUED, DeployRequest.RUNNING):
+            queue = self.get_queue()
+            for item in queue['queued'] + queue['running']:
+                if item['id'] == request.id:
+                    return item
+
+        return self.to_dict(request)
+
+    @staticmethod
+    def to_dict(request):
+        item = dict()
+        item['id'] = request.id
+        item['minion'] = request.minion
+        item['vm_name'] = request.vm_name
+        item['status'] = request.status
+        item['jid'] = request.jid
+        item['message'] = request.message
+        item['created'] = request.created.isoformat() if request.created else None
+        item['started'] = request.started.isoformat() if request.started else None
+        item['finished'] = request.finished.isoformat() if request.finished else None
+        return item
+
+
+deploy_scheduler = DeployScheduler()
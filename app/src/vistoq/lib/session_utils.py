@@ -0,0 +1,240 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from django.contrib.sessions.backends.base import CreateError
+from django.contrib.sessions.backends.cache import SessionStore as CacheSessionStore
+
+from vistoq.lib import metrics
+from vistoq.lib.cache_utils import get_int_config_value
+
+# marks a value that was moved out of the session record into the shared blob cache
+blob_marker = '__vistoq_blob__'
+blob_key_prefix = 'vistoq.session.blob.'
+
+
+def encode(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), default=str)
+
+
+def digest(encoded):
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class BlobCache():
+    """
+    Process local copy of the shared session blobs. Blobs are immutable and named by the hash of their content,
+    so they never have to be invalidated
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._blobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, blob_hash):
+        with self._lock:
+            if blob_hash not in self._blobs:
+                return None
+
+            self._blobs.move_to_end(blob_hash)
+            return self._blobs[blob_hash]
+
+    def put(self, blob_hash, value):
+        with self._lock:
+            self._blobs[blob_hash] = value
+            self._blobs.move_to_end(blob_hash)
+            while len(self._blobs) > self.max_entries:
+                self._blobs.popitem(last=False)
+
+
+local_blobs = BlobCache()
+
+
+class SessionStore(CacheSessionStore):
+    """
+    Cache backed session engine that keeps the per request session I/O small however long a workflow runs. Set
+    SESSION_ENGINE = 'vistoq.lib.session_utils' to use it.
+
+    Large values, such as the snippet variable sets accumulated by the provisioning workflows, are stored once in
+    the shared cache under the hash of their content and the session record only holds the hash. Identical values
+    of different operators share one blob. The record is only written when its content changed, otherwise only its
+    expiry is refreshed
+    """
+    cache_key_prefix = 'vistoq.session.'
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        self.blob_min_size = get_int_config_value('SESSION_BLOB_MIN_SIZE', 1024)
+        self._stored_digest = None
+
+    def _compact_value(self, value, blobs):
+        encoded = encode(value)
+        if len(encoded) < self.blob_min_size:
+            return value
+
+        blob_hash = digest(encoded)
+        blobs[blob_hash] = value
+        return {blob_marker: blob_hash}
+
+    def compact(self, data):
+        """
+        :param data: session dict
+        :return: tuple of (compact session record, dict of blob hash -> value)
+        """
+        blobs = dict()
+        record = dict()
+        for key, value in data.items():
+            if isinstance(value, dict):
+                # workflows are stored as one dict per app, each of their values can become a blob on its own
+                record[key] = dict((k, self._compact_value(v, blobs)) for k, v in value.items())
+            else:
+                record[key] = self._compact_value(value, blobs)
+
+        return record, blobs
+
+    @staticmethod
+    def _blob_hash(value):
+        if isinstance(value, dict) and len(value) == 1 and blob_marker in value:
+            return value[blob_marker]
+
+        return None
+
+    def _record_blobs(self, record):
+        hashes = set()
+        for value in record.values():
+            values = value.values() if isinstance(value, dict) and self._blob_hash(value) is None else [value]
+            for v in values:
+                blob_hash = self._blob_hash(v)
+                if blob_hash is not None:
+                    hashes.add(blob_hash)
+
+        return hashes
+
+    def expand(self, record):
+        """
+        :param record: compact session record
+        :return: session dict with every blob reference replaced by its value, or None when a blob was evicted
+        from the cache and the session can not be restored as it was
+        """
+        hashes = self._record_blobs(record)
+        values = dict()
+        missing = list()
+        for blob_hash in hashes:
+            value = local_blobs.get(blob_hash)
+            if value is None:
+                missing.append(blob_hash)
+            else:
+                values[blob_hash] = value
+
+        if missing:
+            fetched = self._cache.get_many([blob_key_prefix + h for h in missing])
+            for blob_hash in missing:
+                if blob_key_prefix + blob_hash not in fetched:
+                    # carrying on without the value would run the workflow with missing variables
+                    print('Session blob %s is no longer cached, expiring the session' % blob_hash)
+                    metrics.registry.inc('vistoq_session_blob_evictions_total',
+                                         help_text='Sessions expired because a shared session blob was evicted')
+                    return None
+
+                values[blob_hash] = fetched[blob_key_prefix + blob_hash]
+                local_blobs.put(blob_hash, values[blob_hash])
+
+        metrics.registry.inc('vistoq_session_blob_reads_total', {'source': 'local'}, len(hashes) - len(missing),
+                             help_text='Shared session blobs resolved when loading sessions')
+        metrics.registry.inc('vistoq_session_blob_reads_total', {'source': 'cache'}, len(missing),
+                             help_text='Shared session blobs resolved when loading sessions')
+
+        data = dict()
+        for key, value in record.items():
+            blob_hash = self._blob_hash(value)
+            if blob_hash is not None:
+                data[key] = values[blob_hash]
+            elif isinstance(value, dict):
+                data[key] = dict()
+                for k, v in value.items():
+                    blob_hash = self._blob_hash(v)
+                    if blob_hash is None:
+                        data[key][k] = v
+                    else:
+                        data[key][k] = values[blob_hash]
+            else:
+                data[key] = value
+
+        return data
+
+    def load(self):
+        try:
+            record = self._cache.get(self.cache_key)
+        except Exception:
+            # a cache backend that is down or a corrupt entry, start over like the django cache engine does
+            record = None
+
+        if record is None:
+            self._session_key = None
+            self._stored_digest = None
+            return dict()
+
+        data = self.expand(record)
+        if data is None:
+            self._session_key = None
+            self._stored_digest = None
+            return dict()
+
+        self._stored_digest = digest(encode(record))
+        return data
+
+    def _keep_blob(self, blob_hash, value, timeout):
+        # blobs are shared with other sessions, only missing content is written and the rest lives as long as the
+        # longest lived session referencing it
+        key = blob_key_prefix + blob_hash
+        if not self._cache.touch(key, timeout):
+            self._cache.add(key, value, timeout)
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+
+        record, blobs = self.compact(self._get_session(no_load=must_create))
+        record_digest = digest(encode(record))
+        timeout = self.get_expiry_age()
+
+        if not must_create and record_digest == self._stored_digest:
+            # views mark the session modified on every workflow step, even when nothing changed
+            self._cache.touch(self.cache_key, timeout)
+            for blob_hash, value in blobs.items():
+                self._keep_blob(blob_hash, value, timeout)
+
+            metrics.registry.inc('vistoq_session_writes_total', {'result': 'unchanged'},
+                                 help_text='Session saves by the vistoq session engine')
+            return
+
+        for blob_hash, value in blobs.items():
+            local_blobs.put(blob_hash, value)
+            self._keep_blob(blob_hash, value, timeout)
+
+        func = self._cache.add if must_create else self._cache.set
+        result = func(self.cache_key, record, timeout)
+        if must_create and not result:
+            raise CreateError
+
+        self._stored_digest = record_digest
+        metrics.registry.inc('vistoq_session_writes_total', {'result': 'written'},
+                             help_text='Session saves by the vistoq session engine')
+        metrics.registry.inc('vistoq_session_written_bytes_total', value=len(encode(record)),
+                             help_text='Bytes of session records written by the vistoq session engine')
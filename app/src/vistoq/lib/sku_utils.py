@@ -0,0 +1,54 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# decoder ring to map menu values to SKU elements
+sku_tier = {'gold': 'BND2', 'silver': 'BND1', 'bronze': 'BASIC'}
+sku_size = {'small': 'VM-50', 'medium': 'VM-300', 'large': 'VM-500'}
+sku_term = {'M': 'MU', '1': 'YU', '3': '3YU'}
+
+
+def get_tier(snippet_name):
+    """
+    :param snippet_name: name of the chosen service, such as 'gold_gsb'
+    :return: service tier, i.e. 'gold'
+    """
+    return snippet_name.split('_')[0]
+
+
+def build_sku(snippet_name, service_size, service_term):
+    """
+    :param snippet_name: name of the chosen service, its prefix is the tier
+    :param service_size: 'small', 'medium' or 'large'
+    :param service_term: 'M', '1' or '3'
+    :return: sku string such as PAN-VM-300-SP-BKLN-BND2-YU
+    :raises KeyError: for an unknown tier, size or term
+    """
+    return 'PAN-{0}-SP-BKLN-{1}-{2}'.format(sku_size[service_size],
+                                           sku_tier[get_tier(snippet_name)],
+                                           sku_term[service_term])
+
+
+def build_skus(snippet_names, service_sizes, service_terms):
+    """
+    Build the skus of many tenants at once
+    :param snippet_names: list of service names
+    :param service_sizes: list of sizes, in the same order
+    :param service_terms: list of terms, in the same order
+    :return: list of skus, None for tenants with an unknown tier, size or term
+    """
+    tiers = [sku_tier.get(get_tier(n), None) for n in snippet_names]
+    sizes = [sku_size.get(s, None) for s in service_sizes]
+    terms = [sku_term.get(t, None) for t in service_terms]
+    return ['PAN-{0}-SP-BKLN-{1}-{2}'.format(size, tier, term) if tier and size and term else None
+            for tier, size, term in zip(tiers, sizes, terms)]
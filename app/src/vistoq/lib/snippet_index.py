@@ -0,0 +1,237 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import copy
+import json
+import os
+import threading
+import time
+
+import oyaml
+from pan_cnc.lib import cnc_utils
+
+from vistoq.lib import metrics
+from vistoq.lib.cache_utils import SingleFlight
+from vistoq.lib.cache_utils import get_int_config_value
+
+# vistoq/snippets holds the vistoq app snippets and the repositories cloned from .pan-cnc.yaml
+default_snippets_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'snippets')
+default_index_file = os.path.join(os.path.expanduser('~'), '.vistoq', 'snippet_index.json')
+
+
+class SnippetIndex():
+    """
+    On disk index of the snippet metadata found below the snippet directories, keyed by snippet type and by label.
+    The index is loaded from disk at startup and refreshed in the background every SNIPPET_INDEX_CHECK_INTERVAL
+    seconds, only .meta-cnc.yaml files with a new modification time are parsed again. Queries are answered from
+    memory and never walk the file system
+    """
+
+    def __init__(self, snippets_dirs=None, index_file=None):
+        if snippets_dirs is None:
+            configured = cnc_utils.get_config_value('SNIPPET_INDEX_DIRS', '')
+            snippets_dirs = [d.strip() for d in configured.split(',') if d.strip()] or [default_snippets_dir]
+
+        self.snippets_dirs = snippets_dirs
+        self.index_file = index_file or cnc_utils.get_config_value('SNIPPET_INDEX_FILE', default_index_file)
+        self.check_interval = get_int_config_value('SNIPPET_INDEX_CHECK_INTERVAL', 60)
+        self._entries = None
+        self._by_type = dict()
+        self._by_label = dict()
+        self._by_name = dict()
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+
+    @staticmethod
+    def _label_values(value):
+        if isinstance(value, list):
+            return [str(v) for v in value]
+
+        return [str(value)]
+
+    def _build_lookups(self, entries):
+        by_type = dict()
+        by_label = dict()
+        by_name = dict()
+        for path in sorted(entries):
+            metadata = entries[path]['metadata']
+            by_name.setdefault(str(metadata['name']), list()).append(path)
+            by_type.setdefault(str(metadata.get('type', '')), list()).append(path)
+            labels = metadata.get('labels', None)
+            if isinstance(labels, dict):
+                for label_name, label_value in labels.items():
+                    for value in self._label_values(label_value):
+                        by_label.setdefault('%s=%s' % (label_name, value), list()).append(path)
+
+        with self._lock:
+            self._entries = entries
+            self._by_type = by_type
+            self._by_label = by_label
+            self._by_name = by_name
+
+    def _scan(self):
+        """
+        :return: dict of .meta-cnc.yaml path -> modification time
+        """
+        found = dict()
+        for snippets_dir in self.snippets_dirs:
+            for root, dirs, files in os.walk(snippets_dir):
+                # skip .git and other hidden directories of the cloned repositories
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                if '.meta-cnc.yaml' in files:
+                    path = os.path.join(root, '.meta-cnc.yaml')
+                    try:
+                        found[path] = os.stat(path).st_mtime
+                    except OSError:
+                        continue
+
+        return found
+
+    def _load_file(self):
+        try:
+            with open(self.index_file, 'r') as index_file:
+                return json.load(index_file).get('entries', dict())
+        except (IOError, ValueError, AttributeError):
+            return None
+
+    def _save_file(self, entries):
+        try:
+            os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+            tmp_file = '%s.%s.tmp' % (self.index_file, os.getpid())
+            with open(tmp_file, 'w') as index_file:
+                json.dump({'entries': entries}, index_file, default=str)
+
+            os.replace(tmp_file, self.index_file)
+        except (IOError, OSError) as e:
+            print('Could not save snippet index to %s' % self.index_file)
+            print(e)
+
+    def refresh(self):
+        """
+        Bring the index up to date with the snippet directories, parsing only new and modified metadata files.
+        Call after pulling a repository to pick up its changes right away
+        :return: number of metadata files parsed
+        """
+        return self._flight.do('refresh', self._refresh)
+
+    def _refresh(self):
+        start = time.time()
+        with self._lock:
+            entries = self._entries
+
+        if entries is None:
+            entries = self._load_file() or dict()
+
+        found = self._scan()
+        updated = dict()
+        parsed = 0
+        for path, mtime in found.items():
+            entry = entries.get(path, None)
+            if entry is not None and entry['mtime'] == mtime:
+                updated[path] = entry
+                continue
+
+            try:
+                with open(path, 'r') as meta_file:
+                    metadata = oyaml.safe_load(meta_file.read())
+            except (IOError, oyaml.YAMLError) as e:
+                print('Could not load snippet metadata from %s' % path)
+                print(e)
+                continue
+
+            parsed += 1
+            if not isinstance(metadata, dict) or 'name' not in metadata:
+                continue
+
+            # round trip through json so the in memory and on disk copies are the same
+            metadata = json.loads(json.dumps(metadata, default=str))
+            updated[path] = {'mtime': mtime, 'metadata': metadata}
+
+        changed = parsed > 0 or set(updated.keys()) != set(entries.keys())
+        self._build_lookups(updated)
+        self._checked = time.time()
+        if changed:
+            self._save_file(updated)
+
+        metrics.registry.observe('vistoq_snippet_index_refresh_seconds', time.time() - start,
+                                 help_text='Time taken to refresh the snippet index')
+        return parsed
+
+    def _ensure_loaded(self):
+        with self._lock:
+            loaded = self._entries is not None
+
+        if not loaded:
+            entries = self._load_file()
+            if entries is None:
+                self.refresh()
+                return
+
+            self._build_lookups(entries)
+            self._checked = 0
+
+        if time.time() - self._checked > self.check_interval:
+            self._checked = time.time()
+            threading.Thread(target=self.refresh, name='snippet-index-refresh', daemon=True).start()
+
+    def _lookup(self, table, key):
+        self._ensure_loaded()
+        with self._lock:
+            paths = list(table().get(key, list()))
+            entries = self._entries
+
+        results = list()
+        for path in paths:
+            if path not in entries:
+                continue
+
+            # callers such as the choose views may modify the returned metadata
+            metadata = copy.deepcopy(entries[path]['metadata'])
+            metadata['snippet_path'] = os.path.dirname(path)
+            results.append(metadata)
+
+        return results
+
+    def load_snippets_of_type(self, snippet_type):
+        """
+        Index backed replacement of snippet_utils.load_snippets_of_type
+        :param snippet_type: type of the snippets, i.e. 'gpcs'
+        :return: list of snippet metadata dicts
+        """
+        return self._lookup(lambda: self._by_type, str(snippet_type))
+
+    def load_snippets_by_label(self, label_name, label_value):
+        """
+        Index backed replacement of snippet_utils.load_snippets_by_label
+        :param label_name: name of the label, i.e. 'service_type'
+        :param label_value: value of the label, i.e. 'gpcs-cpe'
+        :return: list of snippet metadata dicts
+        """
+        return self._lookup(lambda: self._by_label, '%s=%s' % (label_name, label_value))
+
+    def load_snippet_with_name(self, snippet_name):
+        """
+        Index backed replacement of snippet_utils.load_snippet_with_name
+        :param snippet_name: name of the snippet
+        :return: snippet metadata dict, including the 'snippet_path' directory it was loaded from, or None
+        """
+        snippets = self._lookup(lambda: self._by_name, str(snippet_name))
+        if not snippets:
+            return None
+
+        return snippets[0]
+
+
+snippet_index = SnippetIndex()
@@ -0,0 +1,248 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import json
+import os
+import threading
+from pathlib import Path
+
+import oyaml
+
+from vistoq.lib import metrics
+from vistoq.lib.import_utils import lazy_import
+
+jinja2 = lazy_import('jinja2')
+
+# vistoq/snippets/app holds the salt payload snippets used by the vistoq views
+default_snippets_dir = Path(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) / 'snippets' / 'app'
+
+
+class CompiledSnippet():
+    """
+    A snippet loaded from a .meta-cnc.yaml file along with its compiled templates. Templates that are valid json
+    with jinja expressions only inside string values are also compiled into a payload tree so they can be rendered
+    straight to a salt payload object
+    """
+
+    def __init__(self, snippet_dir, environment):
+        self.snippet_dir = snippet_dir
+        self.meta_file = snippet_dir / '.meta-cnc.yaml'
+        with self.meta_file.open('r') as meta_file:
+            self.metadata = oyaml.safe_load(meta_file.read())
+
+        self.name = self.metadata['name']
+        self.templates = list()
+        self.payload_trees = list()
+        self.mtimes = {self.meta_file: self.meta_file.stat().st_mtime}
+
+        snippets = self.metadata.get('snippets', None) or list()
+        for snippet in snippets:
+            template_file = snippet_dir / snippet['file']
+            with template_file.open('r') as tf:
+                template_string = tf.read()
+
+            self.mtimes[template_file] = template_file.stat().st_mtime
+            self.templates.append(environment.from_string(template_string))
+            self.payload_trees.append(self._compile_tree(template_string, environment))
+
+    @staticmethod
+    def _compile_tree(template_string, environment):
+        try:
+            tree = json.loads(template_string)
+        except ValueError:
+            # jinja outside of json strings, fall back to rendering and parsing the result
+            return None
+
+        def compile_node(node):
+            if isinstance(node, dict):
+                return {k: compile_node(v) for k, v in node.items()}
+            elif isinstance(node, list):
+                return [compile_node(v) for v in node]
+            elif isinstance(node, str) and ('{{' in node or '{%' in node):
+                return environment.from_string(node)
+
+            return node
+
+        return compile_node(tree)
+
+    def is_current(self):
+        """
+        :return: False when any of the files this snippet was loaded from has changed or been removed
+        """
+        try:
+            for path, mtime in self.mtimes.items():
+                if path.stat().st_mtime != mtime:
+                    return False
+        except OSError:
+            return False
+
+        return True
+
+    def render(self, context):
+        """
+        Render all templates of this snippet to a single string
+        :param context: jinja context
+        :return: rendered string
+        """
+        return ''.join(t.render(context) for t in self.templates)
+
+    def render_payload(self, context):
+        """
+        Render this snippet directly into a salt payload
+        :param context: jinja context
+        :return: list of salt lowstate dicts
+        """
+        payload = list()
+        for template, tree in zip(self.templates, self.payload_trees):
+            if tree is None:
+                rendered = json.loads(template.render(context))
+            else:
+                rendered = self._render_node(tree, context)
+
+            if isinstance(rendered, list):
+                payload.extend(rendered)
+            else:
+                payload.append(rendered)
+
+        return payload
+
+    def _render_node(self, node, context):
+        if isinstance(node, dict):
+            return {k: self._render_node(v, context) for k, v in node.items()}
+        elif isinstance(node, list):
+            return [self._render_node(v, context) for v in node]
+        elif hasattr(node, 'render'):
+            return node.render(context)
+
+        return node
+
+
+class SnippetRegistry():
+    """
+    Registry of the vistoq app snippets. Metadata is parsed and templates compiled once, and a snippet is reloaded
+    only when the modification time of one of its files changes
+    """
+
+    def __init__(self, snippets_dir=default_snippets_dir):
+        self.snippets_dir = Path(snippets_dir)
+        self._environment = None
+        self._snippet_dirs = dict()
+        self._snippets = dict()
+        self._lock = threading.Lock()
+
+    @property
+    def environment(self):
+        # created on first use so importing the registry does not import jinja2
+        if self._environment is None:
+            self._environment = jinja2.Environment(loader=jinja2.BaseLoader())
+
+        return self._environment
+
+    def preload(self):
+        """
+        Load and compile every snippet ahead of the first request
+        :return: number of snippets loaded
+        """
+        with self._lock:
+            self._scan()
+            names = list(self._snippet_dirs.keys())
+
+        return len([n for n in names if self.get_snippet(n) is not None])
+
+    def _scan(self):
+        snippet_dirs = dict()
+        for meta_file in self.snippets_dir.rglob('.meta-cnc.yaml'):
+            try:
+                with meta_file.open('r') as mf:
+                    metadata = oyaml.safe_load(mf.read())
+
+                snippet_dirs[metadata['name']] = meta_file.parent
+            except (IOError, KeyError, TypeError, oyaml.YAMLError) as e:
+                print('Could not load snippet metadata from %s' % meta_file)
+                print(e)
+
+        self._snippet_dirs = snippet_dirs
+
+    def get_snippet(self, snippet_name):
+        """
+        Get a compiled snippet by name
+        :param snippet_name: name of the snippet as found in the .meta-cnc.yaml file
+        :return: CompiledSnippet or None if not found
+        """
+        snippet = self._snippets.get(snippet_name, None)
+        if snippet is not None and snippet.is_current():
+            metrics.registry.cache_hit('snippet_registry', 'hit')
+            return snippet
+
+        metrics.registry.cache_hit('snippet_registry', 'miss')
+        with self._lock:
+            snippet = self._snippets.get(snippet_name, None)
+            if snippet is not None and snippet.is_current():
+                return snippet
+
+            if snippet_name not in self._snippet_dirs or not self._snippet_dirs[snippet_name].exists():
+                self._scan()
+
+            if snippet_name not in self._snippet_dirs:
+                print('Could not find snippet with name %s' % snippet_name)
+                return None
+
+            try:
+                snippet = CompiledSnippet(self._snippet_dirs[snippet_name], self.environment)
+            except (IOError, KeyError, TypeError, oyaml.YAMLError) as e:
+                print('Could not load snippet %s' % snippet_name)
+                print(e)
+                return None
+
+            if snippet.name != snippet_name:
+                # the snippet was renamed on disk
+                self._scan()
+                return None
+
+            self._snippets[snippet_name] = snippet
+            return snippet
+
+    def load_snippet(self, snippet_name):
+        """
+        :param snippet_name: name of the snippet
+        :return: snippet metadata dict, as returned by snippet_utils.load_snippet_with_name, or None if not found
+        """
+        snippet = self.get_snippet(snippet_name)
+        if snippet is None:
+            return None
+
+        return snippet.metadata
+
+    def render(self, snippet_name, context):
+        snippet = self.get_snippet(snippet_name)
+        if snippet is None:
+            return None
+
+        return snippet.render(context)
+
+    def render_payload(self, snippet_name, context):
+        """
+        Render a snippet straight into a salt payload without a round trip through a json string
+        :param snippet_name: name of the snippet
+        :param context: jinja context
+        :return: list of salt lowstate dicts or None if the snippet was not found
+        """
+        snippet = self.get_snippet(snippet_name)
+        if snippet is None:
+            return None
+
+        return snippet.render_payload(context)
+
+
+snippet_registry = SnippetRegistry()
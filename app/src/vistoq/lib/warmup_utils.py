@@ -0,0 +1,272 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from pan_cnc.lib import cnc_utils
+
+from vistoq.lib import metrics
+from vistoq.lib.cache_utils import get_int_config_value
+from vistoq.lib.import_utils import lazy_import
+
+inventory_utils = lazy_import('vistoq.lib.inventory_utils')
+panorama_utils = lazy_import('vistoq.lib.panorama_utils')
+salt_utils = lazy_import('vistoq.lib.salt_utils')
+scheduler_utils = lazy_import('vistoq.lib.scheduler_utils')
+snippet_index = lazy_import('vistoq.lib.snippet_index')
+snippet_registry = lazy_import('vistoq.lib.snippet_registry')
+
+# fallback for platforms without /proc, set when the vistoq app is first imported
+_imported = time.time()
+
+
+def get_process_start_time():
+    """
+    :return: epoch time this process was started, read from /proc when available so the report includes the time
+    spent importing django and the framework
+    """
+    try:
+        with open('/proc/self/stat', 'r') as stat_file:
+            # the command name may contain spaces, the fields we need follow the closing parenthesis
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+
+        start_ticks = int(fields[19])
+        with open('/proc/stat', 'r') as proc_stat:
+            for line in proc_stat:
+                if line.startswith('btime'):
+                    return int(line.split()[1]) + start_ticks / os.sysconf('SC_CLK_TCK')
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+
+    return _imported
+
+
+def _salt_login():
+    salt_util = salt_utils.SaltUtil()
+    if salt_utils.token_cache.get_token(salt_util) is None:
+        raise ConnectionError('Could not login to salt-api at %s' % salt_util.base_url)
+
+
+def _minions():
+    inventory_utils.minion_inventory.refresh(wait=True)
+    minions = inventory_utils.minion_inventory.get_minions()
+    if not minions:
+        raise ConnectionError('No minions returned from salt-api')
+
+    return '%s minions' % len(minions)
+
+
+def _fleet_vms():
+    index = inventory_utils.fleet_inventory.refresh()
+    if index is None:
+        raise ConnectionError('Could not load the VMs of the compute nodes')
+
+    return '%s VMs' % len(index['vms'])
+
+
+def _vm_auth_key():
+    if not panorama_utils.vm_auth_key_cache.get_key():
+        raise ConnectionError('Could not get a vm auth key from Panorama')
+
+
+def _device_groups():
+    panorama_utils.device_group_index.refresh(wait=True)
+    return '%s device groups' % len(panorama_utils.device_group_index.search())
+
+
+def _snippets():
+    return '%s snippets' % snippet_registry.snippet_registry.preload()
+
+
+def _snippet_index():
+    return '%s metadata files parsed' % snippet_index.snippet_index.refresh()
+
+
+def _deploy_queue():
+    # resume the deployments queued or running before the restart
+    if not scheduler_utils.deploy_scheduler.enabled:
+        return 'disabled'
+
+    scheduler_utils.deploy_scheduler.ensure_started()
+
+
+# name -> function, each is run once on its own thread. A function fails by raising, and may return a short
+# description of what it loaded
+warmup_tasks = OrderedDict([
+    ('salt_login', _salt_login),
+    ('minions', _minions),
+    ('fleet_vms', _fleet_vms),
+    ('vm_auth_key', _vm_auth_key),
+    ('device_groups', _device_groups),
+    ('snippets', _snippets),
+    ('snippet_index', _snippet_index),
+    ('deploy_queue', _deploy_queue),
+])
+
+
+class CacheWarmup():
+    """
+    Pre-warm the vistoq caches in parallel so the first operator request after a restart does not pay for the salt
+    login, minion discovery, the Panorama calls and the snippet parsing. Keeps a report of how long startup and
+    each task took, which is shown by the warmup management command and the /vistoq/ready probe
+    """
+
+    def __init__(self):
+        self.timeout = get_int_config_value('VISTOQ_WARMUP_TIMEOUT', 120)
+        self._ready = False
+        self._report = dict()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def is_ready(self):
+        return self._ready
+
+    def get_report(self):
+        """
+        :return: dict with 'ready', 'process_start', 'ready_seconds' and per task 'tasks' results
+        """
+        with self._lock:
+            report = dict(self._report)
+
+        report['ready'] = self._ready
+        return report
+
+    @staticmethod
+    def _run_task(name, fn):
+        result = dict()
+        start = time.time()
+        try:
+            detail = fn()
+            result['status'] = 'success'
+            result['detail'] = detail or ''
+        except Exception as e:
+            print('Cache warm-up task %s failed' % name)
+            print(e)
+            result['status'] = 'failed'
+            result['detail'] = str(e)
+
+        result['seconds'] = round(time.time() - start, 3)
+        metrics.registry.observe('vistoq_warmup_seconds', result['seconds'],
+                                 {'task': name, 'status': result['status']},
+                                 help_text='Time taken by each cache warm-up task')
+        return result
+
+    def run(self, task_names=None, timeout=None):
+        """
+        Run the warm-up tasks in parallel and wait for them to finish. The app is marked ready afterwards even when
+        tasks failed or timed out, the caches then fill on first use as before
+        :param task_names: list of task names to run, defaults to all of warmup_tasks
+        :param timeout: seconds to wait for the tasks
+        :return: report dict, see get_report
+        """
+        if task_names is None:
+            task_names = list(warmup_tasks.keys())
+
+        if timeout is None:
+            timeout = self.timeout
+
+        unknown = [n for n in task_names if n not in warmup_tasks]
+        if unknown:
+            raise ValueError('Unknown warm-up tasks: %s' % ', '.join(unknown))
+
+        start = time.time()
+        tasks = OrderedDict()
+        executor = ThreadPoolExecutor(max_workers=max(len(task_names), 1), thread_name_prefix='vistoq-warmup')
+        for name in task_names:
+            tasks[name] = executor.submit(self._run_task, name, warmup_tasks[name])
+
+        wait(list(tasks.values()), timeout=timeout)
+        # do not block on tasks that are still running, they finish filling their cache in the background
+        executor.shutdown(wait=False)
+
+        results = OrderedDict()
+        for name, future in tasks.items():
+            if future.done():
+                results[name] = future.result()
+            else:
+                results[name] = {'status': 'timeout', 'detail': 'still running after %ss' % timeout,
+                                 'seconds': round(time.time() - start, 3)}
+
+        process_start = get_process_start_time()
+        now = time.time()
+        report = dict()
+        report['process_start'] = process_start
+        report['warmup_seconds'] = round(now - start, 3)
+        report['ready_seconds'] = round(now - process_start, 3)
+        report['tasks'] = results
+        with self._lock:
+            self._report = report
+
+        self._ready = True
+        metrics.registry.observe('vistoq_startup_seconds', report['ready_seconds'],
+                                 help_text='Time from process start until the vistoq app was ready')
+        return self.get_report()
+
+    def start_on_startup(self):
+        """
+        Warm the caches when the web server starts, as configured by VISTOQ_WARMUP: 'background' (the default) warms
+        them on a background thread and reports ready when done, 'blocking' delays startup until they are warm and
+        'off' reports ready right away
+        :return: None
+        """
+        mode = str(cnc_utils.get_config_value('VISTOQ_WARMUP', 'background')).lower()
+        command = os.path.basename(sys.argv[0]) if sys.argv else ''
+        if command == 'manage.py' and (len(sys.argv) < 2 or sys.argv[1] != 'runserver'):
+            # migrate, the warmup command itself and friends do not serve requests
+            return
+
+        if command == 'manage.py' and os.environ.get('RUN_MAIN', '') != 'true' and '--noreload' not in sys.argv:
+            # parent process of the runserver autoreloader
+            return
+
+        if mode == 'off':
+            self._ready = True
+            return
+
+        if mode == 'blocking':
+            report = self.run()
+            print(format_report(report))
+            return
+
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            def warm():
+                print(format_report(self.run()))
+
+            self._thread = threading.Thread(target=warm, name='vistoq-warmup', daemon=True)
+            self._thread.start()
+
+
+def format_report(report):
+    """
+    :param report: report dict as returned by CacheWarmup.run
+    :return: human readable startup time report
+    """
+    lines = list()
+    lines.append('vistoq ready in %.2fs after process start, cache warm-up took %.2fs'
+                 % (report.get('ready_seconds', 0), report.get('warmup_seconds', 0)))
+    for name, result in report.get('tasks', dict()).items():
+        lines.append('  %-15s %-8s %7.2fs  %s' % (name, result['status'], result['seconds'], result['detail']))
+
+    return '\n'.join(lines)
+
+
+warmup = CacheWarmup()
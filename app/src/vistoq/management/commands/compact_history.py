@@ -0,0 +1,30 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+from django.core.management.base import BaseCommand
+
+from vistoq.lib import history_utils
+
+
+class Command(BaseCommand):
+    help = 'Remove expired deployment history and compact old records, see HISTORY_RETENTION_DAYS, ' \
+           'HISTORY_COMPACT_DAYS and HISTORY_MAX_ROWS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='records changed per transaction')
+
+    def handle(self, *args, **options):
+        result = history_utils.compact_history(options['batch_size'])
+        self.stdout.write('Removed %s and compacted %s deployment history records' % (result['removed'],
+                                                                                      result['compacted']))
@@ -0,0 +1,85 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import getpass
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from vistoq.lib import onboarding_utils
+from vistoq.lib import operator_utils
+
+
+class Command(BaseCommand):
+    help = 'Onboard GSB tenants in bulk from a csv or yaml file. Each tenant is configured on Panorama and gets ' \
+           'its firewall deployed, the result of every row is appended to a results file. Running again with the ' \
+           'same results file resumes where the last run stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tenants_file', help='csv file with a header line, or yaml file of tenants')
+        parser.add_argument('--format', choices=('csv', 'yaml'), default=None,
+                            help='format of the tenants file, guessed from its extension by default')
+        parser.add_argument('--results', default=None,
+                            help='json lines results file, defaults to the tenants file with .results.jsonl')
+        parser.add_argument('--restart', action='store_true', help='ignore the results of earlier runs')
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help='tenants per Panorama commit, ONBOARDING_CHUNK_SIZE by default')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='parallel deployments, BATCH_DEPLOY_WORKERS by default')
+        parser.add_argument('--minion', default=None,
+                            help="compute node of tenants without a minion column, 'auto' to place them")
+        parser.add_argument('--skip-config', action='store_true', help='do not configure Panorama')
+        parser.add_argument('--skip-deploy', action='store_true', help='do not deploy the firewalls')
+        parser.add_argument('--dry-run', action='store_true', help='only validate the tenants and compute skus')
+
+    def report(self, record):
+        if record['status'] in ('success', 'valid'):
+            style = self.style.SUCCESS
+        elif record['status'] == 'skipped':
+            style = self.style.WARNING
+        else:
+            style = self.style.ERROR
+
+        self.stdout.write(style('row %s %s: %s %s' % (record['row'], record['customer_name'] or '-',
+                                                      record['status'], record['message'])))
+
+    def handle(self, *args, **options):
+        tenants_file = options['tenants_file']
+        if not os.path.isfile(tenants_file):
+            raise CommandError('Could not find tenants file %s' % tenants_file)
+
+        file_format = options['format'] or os.path.splitext(tenants_file)[1].lstrip('.').lower()
+        if file_format not in ('csv', 'yaml', 'yml'):
+            raise CommandError('Could not guess the format of %s, use --format' % tenants_file)
+
+        results_file = options['results'] or '%s.results.jsonl' % os.path.splitext(tenants_file)[0]
+        if options['restart'] and os.path.isfile(results_file) and not options['dry_run']:
+            os.replace(results_file, '%s.old' % results_file)
+
+        onboarding = onboarding_utils.TenantOnboarding(results_file, chunk_size=options['chunk_size'],
+                                                       workers=options['workers'],
+                                                       configure=not options['skip_config'],
+                                                       deploy=not options['skip_deploy'],
+                                                       default_minion=options['minion'],
+                                                       dry_run=options['dry_run'], report=self.report)
+
+        with open(tenants_file, 'r', newline='') as tf, operator_utils.acting_as(getpass.getuser()):
+            counts = onboarding.run(onboarding_utils.iter_rows(tf, file_format))
+
+        self.stdout.write(', '.join('%s %s' % (n, s) for s, n in sorted(counts.items())) or 'No tenants found')
+        if not options['dry_run']:
+            self.stdout.write('Results written to %s' % results_file)
+
+        if counts.get('failed', 0):
+            raise CommandError('%s tenants could not be onboarded, run again to retry them' % counts['failed'])
@@ -0,0 +1,47 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from vistoq.lib import warmup_utils
+
+
+class Command(BaseCommand):
+    help = 'Pre-warm the vistoq caches in parallel and print a startup time report'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tasks', default='',
+                            help='comma separated warm-up tasks to run, one of %s'
+                                 % ', '.join(warmup_utils.warmup_tasks.keys()))
+        parser.add_argument('--timeout', type=int, default=None, help='seconds to wait for the tasks')
+        parser.add_argument('--strict', action='store_true', help='exit with an error if any task did not succeed')
+        parser.add_argument('--json', action='store_true', help='print the report as json')
+
+    def handle(self, *args, **options):
+        task_names = [t.strip() for t in options['tasks'].split(',') if t.strip()] or None
+        try:
+            report = warmup_utils.warmup.run(task_names, options['timeout'])
+        except ValueError as ve:
+            raise CommandError(str(ve))
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.stdout.write(warmup_utils.format_report(report))
+
+        failed = [n for n, r in report['tasks'].items() if r['status'] != 'success']
+        if options['strict'] and failed:
+            raise CommandError('Warm-up tasks did not succeed: %s' % ', '.join(failed))
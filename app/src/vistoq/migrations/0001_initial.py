@@ -0,0 +1,67 @@
+# Generated by Django 2.1.5 on 2019-01-30 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Deployment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('minion', models.CharField(max_length=255)),
+                ('vm_name', models.CharField(max_length=255)),
+                ('jid', models.CharField(blank=True, default='', max_length=64)),
+                ('success', models.BooleanField(default=False)),
+                ('message', models.TextField(blank=True, default='')),
+                ('duration', models.FloatField(null=True)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DeploymentStep',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('minion', models.CharField(max_length=255)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('state', models.CharField(max_length=255)),
+                ('name', models.CharField(max_length=255)),
+                ('run_num', models.IntegerField(default=0)),
+                ('result', models.NullBooleanField()),
+                ('comment', models.TextField(blank=True, default='')),
+                ('duration', models.FloatField(null=True)),
+                ('start_time', models.CharField(blank=True, default='', max_length=32)),
+                ('deployment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='steps', to='vistoq.Deployment')),
+            ],
+            options={
+                'ordering': ['run_num'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='deployment',
+            index=models.Index(fields=['minion', 'vm_name', 'jid'], name='vistoq_deploy_lookup_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deployment',
+            index=models.Index(fields=['vm_name'], name='vistoq_deploy_vm_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deployment',
+            index=models.Index(fields=['jid'], name='vistoq_deploy_jid_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deploymentstep',
+            index=models.Index(fields=['name', 'created'], name='vistoq_step_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deploymentstep',
+            index=models.Index(fields=['minion', 'created'], name='vistoq_step_minion_idx'),
+        ),
+    ]
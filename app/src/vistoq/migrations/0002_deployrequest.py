@@ -0,0 +1,36 @@
+# Generated by Django 2.1.5 on 2019-02-20 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vistoq', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeployRequest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('minion', models.CharField(max_length=255)),
+                ('vm_name', models.CharField(blank=True, default='', max_length=255)),
+                ('payload', models.TextField()),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('success', 'Success'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='queued', max_length=16)),
+                ('jid', models.CharField(blank=True, default='', max_length=64)),
+                ('message', models.TextField(blank=True, default='')),
+                ('attempts', models.IntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='deployrequest',
+            index=models.Index(fields=['status', 'minion'], name='vistoq_request_status_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.5 on 2019-02-27 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vistoq', '0002_deployrequest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deployrequest',
+            name='request_key',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=128),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.1.5 on 2019-03-06 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vistoq', '0003_deployrequest_request_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProvisionBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, default='', max_length=255)),
+                ('status', models.CharField(choices=[('open', 'Open'), ('applying', 'Applying'), ('success', 'Success'), ('partial', 'Partial'), ('failed', 'Failed')], default='open', max_length=16)),
+                ('message', models.TextField(blank=True, default='')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('applied', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StagedTenant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tenant', models.CharField(max_length=255)),
+                ('snippet_name', models.CharField(max_length=255)),
+                ('device_group', models.CharField(blank=True, default='', max_length=255)),
+                ('stack', models.CharField(blank=True, default='', max_length=255)),
+                ('elements', models.TextField()),
+                ('status', models.CharField(choices=[('staged', 'Staged'), ('applied', 'Applied'), ('success', 'Success'), ('failed', 'Failed')], default='staged', max_length=16)),
+                ('message', models.TextField(blank=True, default='')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tenants', to='vistoq.ProvisionBatch')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 2.1.5 on 2019-03-12 12:00
+
+from django.db import migrations, models
+
+
+def set_outcome(apps, schema_editor):
+    Deployment = apps.get_model('vistoq', 'Deployment')
+    Deployment.objects.filter(success=False).update(outcome='failed')
+    Deployment.objects.filter(function='').update(function='state.apply create_ngfw')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vistoq', '0004_provisionbatch_stagedtenant'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deployment',
+            name='operator',
+            field=models.CharField(blank=True, default='', max_length=150),
+        ),
+        migrations.AddField(
+            model_name='deployment',
+            name='function',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='deployment',
+            name='outcome',
+            field=models.CharField(choices=[('running', 'Running'), ('success', 'Success'), ('failed', 'Failed'), ('error', 'Error')], default='success', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='deployment',
+            name='started',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='deployment',
+            name='finished',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='deployment',
+            name='elapsed',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='deployment',
+            name='compacted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='deployrequest',
+            name='operator',
+            field=models.CharField(blank=True, default='', max_length=150),
+        ),
+        migrations.RunPython(set_outcome, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='deployment',
+            index=models.Index(fields=['minion', 'created'], name='vistoq_deploy_minion_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deployment',
+            index=models.Index(fields=['operator', 'created'], name='vistoq_deploy_operator_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deployment',
+            index=models.Index(fields=['function', 'created'], name='vistoq_deploy_function_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deployment',
+            index=models.Index(fields=['outcome', 'created'], name='vistoq_deploy_outcome_idx'),
+        ),
+    ]
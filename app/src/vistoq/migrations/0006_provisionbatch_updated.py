@@ -0,0 +1,18 @@
+# Generated by Django 2.1.5 on 2019-03-14 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vistoq', '0005_deployment_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='provisionbatch',
+            name='updated',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
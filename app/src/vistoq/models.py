@@ -0,0 +1,203 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+from django.db import models
+
+
+class Deployment(models.Model):
+    """
+    A single salt call against a compute node, such as a firewall deployment, a delete or a VM listing, along with
+    who ran it, its overall outcome and timing
+    """
+    RUNNING = 'running'
+    SUCCESS = 'success'
+    FAILED = 'failed'
+    ERROR = 'error'
+    OUTCOME_CHOICES = (
+        (RUNNING, 'Running'),
+        (SUCCESS, 'Success'),
+        (FAILED, 'Failed'),
+        (ERROR, 'Error'),
+    )
+
+    minion = models.CharField(max_length=255)
+    vm_name = models.CharField(max_length=255)
+    jid = models.CharField(max_length=64, blank=True, default='')
+    success = models.BooleanField(default=False)
+    message = models.TextField(blank=True, default='')
+    # sum of the durations of all steps in milliseconds
+    duration = models.FloatField(null=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    # user the call was made for, empty for background jobs
+    operator = models.CharField(max_length=150, blank=True, default='')
+    # salt function such as 'state.apply create_ngfw' or 'virt.vm_state'
+    function = models.CharField(max_length=255, blank=True, default='')
+    outcome = models.CharField(max_length=16, choices=OUTCOME_CHOICES, default=SUCCESS)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+    # wall clock time from sending the call to its return in milliseconds
+    elapsed = models.FloatField(null=True)
+    # old records keep their summary but lose their steps and full message
+    compacted = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['minion', 'vm_name', 'jid'], name='vistoq_deploy_lookup_idx'),
+            models.Index(fields=['vm_name'], name='vistoq_deploy_vm_name_idx'),
+            models.Index(fields=['jid'], name='vistoq_deploy_jid_idx'),
+            models.Index(fields=['minion', 'created'], name='vistoq_deploy_minion_idx'),
+            models.Index(fields=['operator', 'created'], name='vistoq_deploy_operator_idx'),
+            models.Index(fields=['function', 'created'], name='vistoq_deploy_function_idx'),
+            models.Index(fields=['outcome', 'created'], name='vistoq_deploy_outcome_idx'),
+        ]
+
+    def __str__(self):
+        return '%s on %s' % (self.vm_name, self.minion)
+
+
+class DeploymentStep(models.Model):
+    """
+    The result of a single state of a deployment as returned by state.apply
+    """
+    deployment = models.ForeignKey(Deployment, related_name='steps', on_delete=models.CASCADE)
+    # denormalized from the deployment so step timings can be aggregated per node without a join
+    minion = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True)
+    state = models.CharField(max_length=255)
+    name = models.CharField(max_length=255)
+    run_num = models.IntegerField(default=0)
+    result = models.NullBooleanField()
+    comment = models.TextField(blank=True, default='')
+    # duration in milliseconds as reported by salt
+    duration = models.FloatField(null=True)
+    start_time = models.CharField(max_length=32, blank=True, default='')
+
+    class Meta:
+        ordering = ['run_num']
+        indexes = [
+            models.Index(fields=['name', 'created'], name='vistoq_step_name_idx'),
+            models.Index(fields=['minion', 'created'], name='vistoq_step_minion_idx'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+
+class DeployRequest(models.Model):
+    """
+    A firewall deployment waiting for, or holding, a build slot on its compute node. Requests are dispatched in
+    the order they were queued as the per node and global concurrency limits allow
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCESS = 'success'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCESS, 'Success'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    )
+
+    minion = models.CharField(max_length=255)
+    vm_name = models.CharField(max_length=255, blank=True, default='')
+    # rendered salt payload as json
+    payload = models.TextField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    jid = models.CharField(max_length=64, blank=True, default='')
+    message = models.TextField(blank=True, default='')
+    # idempotency key of the submission, repeated submissions attach to the request while it is in flight
+    request_key = models.CharField(max_length=128, blank=True, default='', db_index=True)
+    # user who queued the deployment, recorded with its history once it runs
+    operator = models.CharField(max_length=150, blank=True, default='')
+    # number of times submitting the job to salt failed
+    attempts = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'minion'], name='vistoq_request_status_idx'),
+        ]
+
+    def __str__(self):
+        return '%s on %s (%s)' % (self.vm_name, self.minion, self.status)
+
+
+class ProvisionBatch(models.Model):
+    """
+    Tenant configurations staged for Panorama. The configuration of every tenant in the batch is applied, then
+    committed once and pushed once per device group and template stack
+    """
+    OPEN = 'open'
+    APPLYING = 'applying'
+    SUCCESS = 'success'
+    PARTIAL = 'partial'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (OPEN, 'Open'),
+        (APPLYING, 'Applying'),
+        (SUCCESS, 'Success'),
+        (PARTIAL, 'Partial'),
+        (FAILED, 'Failed'),
+    )
+
+    name = models.CharField(max_length=255, blank=True, default='')
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=OPEN)
+    message = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    applied = models.DateTimeField(null=True)
+    # last progress of a batch being applied, an applying batch without progress for too long was interrupted
+    updated = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return self.name or 'batch %s' % self.id
+
+
+class StagedTenant(models.Model):
+    """
+    The rendered Panorama configuration of one tenant in a provisioning batch and the outcome of applying it
+    """
+    STAGED = 'staged'
+    APPLIED = 'applied'
+    SUCCESS = 'success'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STAGED, 'Staged'),
+        (APPLIED, 'Applied'),
+        (SUCCESS, 'Success'),
+        (FAILED, 'Failed'),
+    )
+
+    batch = models.ForeignKey(ProvisionBatch, related_name='tenants', on_delete=models.CASCADE)
+    tenant = models.CharField(max_length=255)
+    snippet_name = models.CharField(max_length=255)
+    device_group = models.CharField(max_length=255, blank=True, default='')
+    stack = models.CharField(max_length=255, blank=True, default='')
+    # json list of dicts with the 'name', 'xpath' and 'element' of each rendered snippet
+    elements = models.TextField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STAGED)
+    message = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return self.tenant
@@ -12,47 +12,106 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+import hmac
+import ipaddress
 import json
+from datetime import timedelta
+from urllib.parse import urlencode
 
 from django import forms
 from django.contrib import messages
+from django.core.paginator import Paginator
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render, HttpResponseRedirect
+from django.utils import timezone
+from django.views.generic import View
 
 from pan_cnc.lib import cnc_utils
-from pan_cnc.lib import pan_utils
-from pan_cnc.lib import snippet_utils
-from pan_cnc.views import CNCBaseFormView, ProvisionSnippetView, ChooseSnippetView, CNCView
+from pan_cnc.views import CNCBaseFormView, ProvisionSnippetView, ChooseSnippetView, ChooseSnippetByLabelView, CNCView
+from vistoq.lib import idempotency_utils
+from vistoq.lib import inventory_utils
+from vistoq.lib import job_utils
+from vistoq.lib import metrics
 from vistoq.lib import salt_utils
+from vistoq.lib import sku_utils
+from vistoq.lib import warmup_utils
+from vistoq.lib.cache_utils import get_int_config_value
+from vistoq.lib.import_utils import lazy_import
+from vistoq.lib.metrics import TimedViewMixin
+from vistoq.lib.snippet_index import snippet_index
+from vistoq.lib.snippet_registry import snippet_registry
+
+# only imported by the pages that use them
+delete_utils = lazy_import('vistoq.lib.delete_utils')
+deploy_utils = lazy_import('vistoq.lib.deploy_utils')
+event_utils = lazy_import('vistoq.lib.event_utils')
+history_utils = lazy_import('vistoq.lib.history_utils')
+panorama_utils = lazy_import('vistoq.lib.panorama_utils')
+placement_utils = lazy_import('vistoq.lib.placement_utils')
+provision_utils = lazy_import('vistoq.lib.provision_utils')
+scheduler_utils = lazy_import('vistoq.lib.scheduler_utils')
+
+
+class CompactWorkflowMixin():
+    """
+    Only save the session when a workflow step actually changes the workflow. The pan-cnc workflow helpers store the
+    whole workflow dict back into the session on every call, which writes the complete session each request even
+    when the operator only moved to the next page. Pair with the vistoq.lib.session_utils session engine to keep
+    the large snippet values out of the session record as well
+    """
+
+    def save_workflow_to_session(self):
+        session = self.request.session
+        was_modified = session.modified
+        before = dict(session.get(self.app_dir, None) or dict())
+        super().save_workflow_to_session()
+        if not was_modified and dict(session.get(self.app_dir, None) or dict()) == before:
+            session.modified = False
 
+    def save_value_to_workflow(self, var_name, var_value):
+        missing = object()
+        if self.get_value_from_workflow(var_name, missing) == var_value:
+            return
 
-class ViewServicesView(CNCView):
-    template_name = "mssp/service_list.html"
+        super().save_value_to_workflow(var_name, var_value)
+
+
+class ViewServicesView(TimedViewMixin, CNCView):
+    template_name = "vistoq/service_list.html"
     base_html = 'vistoq/base.html'
+    page_size = 50
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        service_list = pan_utils.get_device_groups_from_panorama()
-        context['service_list'] = service_list
+        query = self.request.GET.get('q', '')
+        # device groups are served from the local index, which is refreshed from Panorama in the background
+        service_list = panorama_utils.device_group_index.search(query)
+        paginator = Paginator(service_list, self.page_size)
+        page = paginator.get_page(self.request.GET.get('page', 1))
+        context['service_list'] = page
+        context['page'] = page
+        context['q'] = query
         return context
 
 
-class ViewMinionsView(CNCView):
+class ViewMinionsView(TimedViewMixin, CNCView):
     template_name = "vistoq/minion_list.html"
     base_html = 'vistoq/base.html'
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        salt_util = salt_utils.SaltUtil()
-        minion_list = salt_util.get_minion_list()
+        minion_list = inventory_utils.minion_inventory.get_minions()
         context['minion_list'] = minion_list
         return context
 
 
-class DeployServiceView(CNCBaseFormView):
+class DeployServiceView(CompactWorkflowMixin, TimedViewMixin, CNCBaseFormView):
     # template_name = 'vistoq/deploy_service.html'
     snippet = 'provision_firewall'
     base_html = 'vistoq/base.html'
     app_dir = 'vistoq'
+    # submit through salt local_async and track the job in the background instead of waiting on the minion
+    async_deploy = False
 
     def get_snippet(self):
         return self.snippet
@@ -63,13 +122,32 @@ class DeployServiceView(CNCBaseFormView):
         :param kwargs:
         :return:
         """
+        self.save_panorama_details_to_workflow()
+
+        context = super().get_context_data(**kwargs)
+        form = context['form']
+
+        # the minion choices are cached and sorted by the shared minion inventory
+        choices_set = inventory_utils.minion_inventory.get_choices()
+        # let vistoq pick the node with the most free capacity
+        choices_set = ((placement_utils.auto_minion, 'Auto (most free capacity)'),) + tuple(choices_set)
+        # make our new field
+        new_choices_field = forms.ChoiceField(choices=choices_set)
+        # set it on the original form, overwriting the hardcoded GSB version
+        form.fields['minion'] = new_choices_field
+        # save to kwargs and call parent for additional processing
+        context['form'] = form
+        return context
+
+    def save_panorama_details_to_workflow(self):
+        """
+        Ensure the workflow contains the vm_auth_key and panorama_ip used to bootstrap the firewall
+        :return: None
+        """
         print('Getting vm_auth_key')
         vm_auth_key = self.get_value_from_workflow('vm_auth_key', '')
         if vm_auth_key == '':
-            vm_auth_key = pan_utils.get_vm_auth_key_from_panorama()
-            vakl = vm_auth_key.split(' ')
-            if len(vakl) > 2:
-                vm_auth_key = vakl[3]
+            vm_auth_key = panorama_utils.vm_auth_key_cache.get_key()
 
         print(vm_auth_key)
         panorama_ip = cnc_utils.get_config_value('PANORAMA_IP', '0.0.0.0')
@@ -82,86 +160,410 @@ class DeployServiceView(CNCBaseFormView):
         if fw_name != '':
             self.save_value_to_workflow('vm_name', fw_name)
 
-        context = super().get_context_data(**kwargs)
-        form = context['form']
+    def submit_deploy_job(self, payload, jinja_context):
+        """
+        Submit the deployment as a background salt job
+        :param payload: rendered provision_ngfw payload
+        :param jinja_context: variables used to render the payload
+        :return: dict with the 'redirect' to the job page or the error 'results'
+        """
+        minion = jinja_context.get('minion', '')
+        vm_name = jinja_context.get('vm_name', '')
+        # completes the job as soon as salt publishes its return
+        event_utils.event_consumer.ensure_started()
+        job = job_utils.job_tracker.submit(payload, minion, vm_name)
+        if job is None:
+            return {'success': False, 'results': 'Error deploying VM! Could not submit job to the provisioner'}
 
-        # load all snippets with a type of 'service'
-        salt_util = salt_utils.SaltUtil()
-        minion_list = salt_util.get_minion_list()
+        return {'success': True, 'redirect': '/vistoq/deploy_job/%s' % job['jid']}
 
-        # we need to construct a new ChoiceField with the following basic format
-        # snippet_name = forms.ChoiceField(choices=(('gold', 'Gold'), ('silver', 'Silver'), ('bronze', 'Bronze')))
-        choices_list = list()
-        # grab each service and construct a simple tuple with name and label, append to the list
-        for minion in minion_list:
-            minion_label = minion.split('.')[0]
-            choice = (minion, minion_label)
-            choices_list.append(choice)
+    def queue_deploy_job(self, payload, jinja_context, request_key=''):
+        """
+        Queue the deployment with the deploy scheduler
+        :param payload: rendered provision_ngfw payload
+        :param jinja_context: variables used to render the payload
+        :param request_key: idempotency key of the submission
+        :return: dict with the 'redirect' to the queued request page or the error 'results'
+        """
+        event_utils.event_consumer.ensure_started()
+        request = scheduler_utils.deploy_scheduler.enqueue(payload, jinja_context.get('minion', ''),
+                                                           jinja_context.get('vm_name', ''), request_key)
+        if request is None:
+            return {'success': False, 'results': 'Error deploying VM! Could not queue the deployment'}
 
-        # let's sort the list by the label attribute (index 1 in the tuple)
-        choices_list = sorted(choices_list, key=lambda k: k[1])
-        # convert our list of tuples into a tuple itself
-        choices_set = tuple(choices_list)
-        # make our new field
-        new_choices_field = forms.ChoiceField(choices=choices_set)
-        # set it on the original form, overwriting the hardcoded GSB version
-        form.fields['minion'] = new_choices_field
-        # save to kwargs and call parent for additional processing
-        context['form'] = form
-        return context
+        return {'success': True, 'redirect': '/vistoq/deploy_request/%s' % request.id}
 
-    def form_valid(self, form):
-        print('Here we go deploying %s' % self.app_dir)
-        jinja_context = dict()
-        service = snippet_utils.load_snippet_with_name('provision_firewall', self.app_dir)
-        for v in service['variables']:
-            if self.request.POST.get(v['name']):
-                jinja_context[v['name']] = self.request.POST.get(v['name'])
+    def deploy(self, jinja_context, request_key=''):
+        """
+        Place, render and deploy a firewall through the deploy queue, as a background job or right away
+        :param jinja_context: variables from the deploy form
+        :param request_key: idempotency key of the submission
+        :return: dict with 'success' and either a 'redirect' or the 'results' message
+        """
+        if jinja_context.get('minion', '') == placement_utils.auto_minion:
+            pending = scheduler_utils.deploy_scheduler.get_pending_counts() \
+                if scheduler_utils.deploy_scheduler.enabled else None
+            try:
+                placement = placement_utils.node_placer.place(1, pending)[0]
+            except placement_utils.PlacementError as pe:
+                return {'success': False, 'results': 'Error deploying VM! %s' % pe}
+
+            jinja_context['minion'] = placement['minion']
+            # shown on the results, job and queued deployment pages alike
+            messages.add_message(self.request, messages.INFO, 'Placed %s on %s: %s, room for %s more firewalls' % (
+                jinja_context.get('vm_name', ''), placement['minion'], placement['summary'], placement['headroom']))
+
+        payload = snippet_registry.render_payload('provision_firewall', jinja_context)
 
-        template = snippet_utils.render_snippet_template(service, self.app_dir, jinja_context)
-        print(template)
+        if scheduler_utils.deploy_scheduler.enabled:
+            # builds on a compute node are limited to DEPLOY_MAX_PER_MINION at a time
+            return self.queue_deploy_job(payload, jinja_context, request_key)
+
+        if self.async_deploy:
+            return self.submit_deploy_job(payload, jinja_context)
 
         salt_util = salt_utils.SaltUtil()
-        res = salt_util.deploy_template(template)
+        res = salt_util.deploy_payload(payload)
         print(res)
-        context = dict()
-        context['base_html'] = self.base_html
-        context['title'] = 'Deploy Next Generation Firewall'
-        context['header'] = 'Deployment Results'
 
         try:
             results_json = json.loads(res)
         except ValueError as ve:
             print('Could not load results from provisioner!')
             print(ve)
-            context['results'] = 'Error deploying VM!'
-            return render(self.request, 'pan_cnc/results.html', context=context)
+            return {'success': False, 'results': 'Error deploying VM!'}
         except TypeError as te:
             print('Could not load results from provisioner!')
             print(te)
-            context['results'] = 'Error deploying VM!'
-            return render(self.request, 'pan_cnc/results.html', context=context)
+            return {'success': False, 'results': 'Error deploying VM!'}
 
         if 'minion' not in jinja_context:
-            context['results'] = 'Error deploying VM! No compute node found in response'
-            return render(self.request, 'pan_cnc/results.html', context=context)
+            return {'success': False, 'results': 'Error deploying VM! No compute node found in response'}
 
+        # the call and its steps are recorded in the deployment history by SaltUtil
         minion = jinja_context['minion']
-        if 'return' in results_json and minion in results_json['return'][0]:
-            r = results_json['return'][0][minion]
-            steps = r.keys()
-            for step in steps:
-                step_detail = r[step]
-                if step_detail['result'] is not True:
-                    context['results'] = 'Error deploying VM! Not all steps completed successfully!\n\n'
-                    context['results'] += step_detail['comment']
-                    return render(self.request, 'pan_cnc/results.html', context=context)
-
-        context['results'] = 'VM Deployed Successfully on CPE: %s' % minion
+        success, message = job_utils.get_deploy_results_message(results_json, minion)
+        return {'success': success, 'results': message}
+
+    def form_valid(self, form):
+        print('Here we go deploying %s' % self.app_dir)
+        jinja_context = dict()
+        service = snippet_registry.load_snippet('provision_firewall')
+        for v in service['variables']:
+            if self.request.POST.get(v['name']):
+                jinja_context[v['name']] = self.request.POST.get(v['name'])
+
+        # keyed on the payload as submitted, before auto placement, so a double click matches the original
+        # whichever node it was placed on. Clients may send their own key instead
+        token = self.request.POST.get('idempotency_key', '') or self.request.META.get('HTTP_IDEMPOTENCY_KEY', '')
+        if token:
+            request_key = idempotency_utils.request_key('deploy', token)
+        else:
+            request_key = idempotency_utils.request_key(
+                'deploy', snippet_registry.render_payload('provision_firewall', jinja_context))
+
+        active = None
+        if scheduler_utils.deploy_scheduler.enabled:
+            active = scheduler_utils.deploy_scheduler.find_active(request_key)
+
+        if active is not None:
+            # still queued or building long after the guard forgot about it
+            result, duplicate = {'success': True, 'redirect': '/vistoq/deploy_request/%s' % active.id}, True
+        else:
+            # a synchronous build holds the request for as long as the create_ngfw state may take
+            wait_timeout = salt_utils.SaltUtil().read_timeouts.get('state.apply create_ngfw', 1800)
+            result, duplicate = idempotency_utils.guard.run(
+                request_key, lambda: self.deploy(jinja_context, request_key), pending_ttl=int(wait_timeout) + 60,
+                succeeded=lambda r: r['success'])
+
+        if duplicate and result is None:
+            messages.add_message(self.request, messages.INFO, 'This deployment was already submitted')
+            return HttpResponseRedirect(idempotency_utils.status_link(request_key))
+
+        if duplicate:
+            messages.add_message(self.request, messages.INFO,
+                                 'This deployment was already submitted, showing the original request')
+
+        if 'redirect' in result:
+            return HttpResponseRedirect(result['redirect'])
+
+        context = dict()
+        context['base_html'] = self.base_html
+        context['title'] = 'Deploy Next Generation Firewall'
+        context['header'] = 'Deployment Results'
+        context['results'] = result['results']
         return render(self.request, 'pan_cnc/results.html', context=context)
 
 
-class ViewDeployedVmsView(CNCBaseFormView):
+class BatchDeployServiceView(DeployServiceView):
+    """
+    /vistoq/deployfw_batch
+
+    Deploy many firewalls across many compute nodes in a single form submit. Each row of the 'deployments' field
+    holds the minion, vm_name and optional bridges of one firewall. With the deploy scheduler enabled every row is
+    queued and the results link to the queued deployments
+    """
+    snippet = 'batch_provision_firewall'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        form = context['form']
+        # each row names its own minion
+        form.fields.pop('minion', None)
+        initial = form.fields['deployments'].initial
+        form.fields['deployments'] = forms.CharField(widget=forms.Textarea(attrs={'rows': 10}), initial=initial)
+        context['form'] = form
+        return context
+
+    def form_valid(self, form):
+        common_context = dict()
+        service = snippet_registry.load_snippet(self.snippet)
+        for v in service['variables']:
+            if v['name'] != 'deployments' and self.request.POST.get(v['name']):
+                common_context[v['name']] = self.request.POST.get(v['name'])
+
+        rows_text = self.request.POST.get('deployments', '')
+        rows = deploy_utils.parse_deployment_rows(rows_text)
+        request_key = idempotency_utils.request_key('deploy_batch', rows_text, common_context)
+        wait_timeout = salt_utils.SaltUtil().read_timeouts.get('state.apply create_ngfw', 1800)
+        if not scheduler_utils.deploy_scheduler.enabled:
+            # the builds of a node run one after another in a single call, any node may get every 'auto' row
+            per_minion = dict()
+            for row in rows:
+                per_minion[row.get('minion', '')] = per_minion.get(row.get('minion', ''), 0) + 1
+
+            auto_rows = per_minion.pop(placement_utils.auto_minion, 0)
+            wait_timeout *= max(per_minion.values(), default=0) + auto_rows
+
+        results, duplicate = idempotency_utils.guard.run(
+            request_key, lambda: deploy_utils.deploy_batch(rows, common_context), pending_ttl=int(wait_timeout) + 60,
+            succeeded=lambda r: all(row['status'] in ('success', 'queued') for row in r))
+        if duplicate and results is None:
+            messages.add_message(self.request, messages.INFO, 'This batch was already submitted')
+            return HttpResponseRedirect(idempotency_utils.status_link(request_key))
+
+        if duplicate:
+            messages.add_message(self.request, messages.INFO,
+                                 'This batch was already submitted, showing the original results')
+
+        context = dict()
+        context['base_html'] = self.base_html
+        context['title'] = 'Deploy Next Generation Firewalls'
+        context['header'] = 'Batch Deployment Results'
+        context['results'] = results
+        context['failed'] = len([r for r in results if r['status'] == 'failed'])
+        return render(self.request, 'vistoq/batch_results.html', context=context)
+
+
+class DeployJobView(TimedViewMixin, CNCView):
+    """
+    /vistoq/deploy_job/<jid>
+
+    Show the status and per step results of a background deployment job
+    """
+    template_name = 'vistoq/deploy_job.html'
+    base_html = 'vistoq/base.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        jid = self.kwargs['jid']
+        context['jid'] = jid
+        context['job'] = job_utils.job_tracker.get_job(jid)
+        return context
+
+
+class DeployJobStatusView(TimedViewMixin, CNCView):
+    """
+    /vistoq/deploy_job_status/<jid>
+
+    Return the status of a background deployment job as json
+    """
+
+    def get(self, request, *args, **kwargs):
+        jid = self.kwargs['jid']
+        job = job_utils.job_tracker.get_job(jid)
+        if job is None:
+            return JsonResponse({'jid': jid, 'status': 'not_found'}, status=404)
+
+        return JsonResponse(job)
+
+
+class DeployQueueView(TimedViewMixin, CNCView):
+    """
+    /vistoq/deploy_queue
+
+    Show the running and queued deployments with their queue position and expected start time
+    """
+    template_name = 'vistoq/deploy_queue.html'
+    base_html = 'vistoq/base.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        scheduler_utils.deploy_scheduler.ensure_started()
+        queue = scheduler_utils.deploy_scheduler.get_queue()
+        context['running'] = queue['running']
+        context['queued'] = queue['queued']
+        context['max_per_minion'] = scheduler_utils.deploy_scheduler.max_per_minion
+        context['max_concurrent'] = scheduler_utils.deploy_scheduler.max_concurrent
+        return context
+
+
+class DeployRequestView(TimedViewMixin, CNCView):
+    """
+    /vistoq/deploy_request/<request_id>
+
+    Show the queue position and expected start time of a queued deployment, and link to its job once it has been
+    dispatched. Posting 'cancel' removes the request from the queue
+    """
+    template_name = 'vistoq/deploy_request.html'
+    base_html = 'vistoq/base.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        request_id = self.kwargs['request_id']
+        context['request_id'] = request_id
+        context['deploy_request'] = scheduler_utils.deploy_scheduler.get_request(request_id)
+        return context
+
+    def post(self, request, *args, **kwargs):
+        request_id = self.kwargs['request_id']
+        if request.POST.get('cancel', '') != '':
+            if scheduler_utils.deploy_scheduler.cancel(request_id):
+                messages.add_message(request, messages.INFO, 'Deployment cancelled')
+            else:
+                messages.add_message(request, messages.ERROR, 'Deployment has already been started')
+
+        return HttpResponseRedirect('/vistoq/deploy_request/%s' % request_id)
+
+
+class DeployRequestStatusView(TimedViewMixin, CNCView):
+    """
+    /vistoq/deploy_request_status/<request_id>
+
+    Return the status, queue position and eta of a queued deployment as json
+    """
+
+    def get(self, request, *args, **kwargs):
+        request_id = self.kwargs['request_id']
+        deploy_request = scheduler_utils.deploy_scheduler.get_request(request_id)
+        if deploy_request is None:
+            return JsonResponse({'id': request_id, 'status': 'not_found'}, status=404)
+
+        return JsonResponse(deploy_request)
+
+
+class RequestStatusView(TimedViewMixin, CNCView):
+    """
+    /vistoq/request_status/<request_key>
+
+    Show the progress of a deploy or delete request that is still running, and its result once it finished.
+    Duplicate submissions of a request are sent here instead of holding a request worker until the original is done
+    """
+    base_html = 'vistoq/base.html'
+
+    def get(self, request, *args, **kwargs):
+        request_key = self.kwargs['request_key']
+        record = idempotency_utils.guard.status(request_key)
+        context = dict()
+        context['base_html'] = self.base_html
+        if record is None:
+            context['results'] = 'Request not found! It did not complete or its result has expired'
+            return render(request, 'pan_cnc/results.html', context=context)
+
+        if record['status'] == 'pending':
+            context['request_key'] = request_key
+            context['elapsed'] = int(max(0, timezone.now().timestamp() - record['started']))
+            return render(request, 'vistoq/request_status.html', context=context)
+
+        result = record['result']
+        if isinstance(result, dict) and 'redirect' in result:
+            return HttpResponseRedirect(result['redirect'])
+
+        if isinstance(result, list):
+            context['title'] = 'Request Results'
+            context['header'] = 'Request Results'
+            context['results'] = result
+            context['failed'] = len([r for r in result if r['status'] not in ('success', 'queued')])
+            return render(request, 'vistoq/batch_results.html', context=context)
+
+        context['results'] = result['results'] if isinstance(result, dict) else result
+        return render(request, 'pan_cnc/results.html', context=context)
+
+
+class DeploymentStatsView(TimedViewMixin, CNCView):
+    """
+    /vistoq/deployment_stats
+
+    Show p50 / p95 durations of each state step and each compute node from the deployment history
+    """
+    template_name = 'vistoq/deployment_stats.html'
+    base_html = 'vistoq/base.html'
+
+    def get_stats(self):
+        try:
+            days = int(self.request.GET.get('days', 30))
+        except ValueError:
+            days = 30
+
+        minion = self.request.GET.get('minion', '')
+        return history_utils.get_deployment_stats(days, minion)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['stats'] = self.get_stats()
+        return context
+
+
+class DeploymentStatsJsonView(DeploymentStatsView):
+    """
+    /vistoq/deployment_stats_json
+
+    Return the deployment duration statistics as json
+    """
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(self.get_stats())
+
+
+class DeploymentHistoryView(TimedViewMixin, CNCView):
+    """
+    /vistoq/deployment_history
+
+    Search the history of deployments, deletes and VM listings by operator, compute node, VM, salt function, job id
+    and outcome. Answered from the indexed history alone, the compute nodes are not asked
+    """
+    template_name = 'vistoq/deployment_history.html'
+    base_html = 'vistoq/base.html'
+    page_size = 50
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        filters = dict()
+        for field in history_utils.search_fields + ('vm_name',):
+            filters[field] = self.request.GET.get(field, '').strip()
+
+        since = None
+        days = self.request.GET.get('days', '')
+        if days.isdigit():
+            since = timezone.now() - timedelta(days=int(days))
+
+        deployments = history_utils.search_deployments(since=since, **filters)
+        paginator = Paginator(deployments, self.page_size)
+        page = paginator.get_page(self.request.GET.get('page', 1))
+
+        query = dict((k, v) for k, v in filters.items() if v)
+        if days.isdigit():
+            query['days'] = days
+
+        context['deployments'] = page
+        context['page'] = page
+        context['filters'] = filters
+        context['days'] = days
+        context['query'] = urlencode(query)
+        return context
+
+
+class ViewDeployedVmsView(TimedViewMixin, CNCBaseFormView):
     """
     Show all the VMs currently deployed on the compute node
 
@@ -190,23 +592,8 @@ class ViewDeployedVmsView(CNCBaseFormView):
         context = super().get_context_data(**kwargs)
         form = context['form']
 
-        # load all snippets with a type of 'service'
-        salt_util = salt_utils.SaltUtil()
-        minion_list = salt_util.get_minion_list()
-
-        # we need to construct a new ChoiceField with the following basic format
-        # snippet_name = forms.ChoiceField(choices=(('gold', 'Gold'), ('silver', 'Silver'), ('bronze', 'Bronze')))
-        choices_list = list()
-        # grab each service and construct a simple tuple with name and label, append to the list
-        for minion in minion_list:
-            minion_label = minion.split('.')[0]
-            choice = (minion, minion_label)
-            choices_list.append(choice)
-
-        # let's sort the list by the label attribute (index 1 in the tuple)
-        choices_list = sorted(choices_list, key=lambda k: k[1])
-        # convert our list of tuples into a tuple itself
-        choices_set = tuple(choices_list)
+        # the minion choices are cached and sorted by the shared minion inventory
+        choices_set = inventory_utils.minion_inventory.get_choices()
         # make our new field
         new_choices_field = forms.ChoiceField(choices=choices_set)
         # set it on the original form, overwriting the hardcoded GSB version
@@ -218,13 +605,23 @@ class ViewDeployedVmsView(CNCBaseFormView):
     def form_valid(self, form):
         print('Here we go deploying')
         minion = self.get_value_from_workflow('minion', '')
+        context = dict()
+        context['base_html'] = self.base_html
+
+        # serve from the live VM state table when the salt event stream is connected
+        event_utils.event_consumer.ensure_started()
+        if event_utils.event_consumer.is_current(minion):
+            context['vms'] = event_utils.vm_state_table.get_vms(minion)
+            context['minion'] = minion
+            context['live'] = True
+            context['poll_interval'] = get_int_config_value('VM_EVENTS_POLL_INTERVAL', 5)
+            return render(self.request, 'vistoq/deployed_vms.html', context=context)
+
         salt_util = salt_utils.SaltUtil()
 
-        template = snippet_utils.render_snippet_template(self.service, self.app_dir, self.get_workflow())
+        payload = snippet_registry.render_payload(self.snippet, self.get_workflow())
 
-        res = salt_util.deploy_template(template)
-        context = dict()
-        context['base_html'] = self.base_html
+        res = salt_util.deploy_payload(payload)
 
         try:
             if res is None:
@@ -252,38 +649,163 @@ class ViewDeployedVmsView(CNCBaseFormView):
         except ValueError as ve:
             print('Could not parse json')
             print(ve)
+            # fail fast with the last known data while the provisioner is unavailable
+            vms, age = inventory_utils.fleet_inventory.get_cached_vms(minion)
+            if vms is not None:
+                context['vms'] = vms
+                context['minion'] = minion
+                context['notice'] = 'The provisioner is unavailable, showing VMs as of %s seconds ago' % int(age)
+                return render(self.request, 'vistoq/deployed_vms.html', context=context)
+
             context['results'] = {'Error': 'Could not get deployed VMs list!'}
             return render(self.request, 'pan_cnc/results.html', context=context)
 
 
-class DeleteVMView(CNCView):
-    template_name = 'pan_cnc/results.html'
+class FleetVmsView(TimedViewMixin, CNCView):
+    """
+    /vistoq/fleet_vms
+
+    Show the VMs deployed on every compute node matching a target with a single salt call. Supports filtering by
+    state and hostname and paginates the results
+    """
+    template_name = 'vistoq/fleet_vms.html'
+    base_html = 'vistoq/base.html'
+    page_size = 50
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        target = self.request.GET.get('target', '*') or '*'
+        tgt_type = self.request.GET.get('tgt_type', 'glob')
+        if tgt_type not in ('glob', 'list'):
+            tgt_type = 'glob'
+
+        state = self.request.GET.get('state', '')
+        hostname = self.request.GET.get('hostname', '')
+
+        fleet_inventory = inventory_utils.fleet_inventory
+        vms = fleet_inventory.get_vms(target, tgt_type, state, hostname)
+        paginator = Paginator(vms, self.page_size)
+        page = paginator.get_page(self.request.GET.get('page', 1))
+
+        # keep the current filters on the pagination links
+        query = self.request.GET.copy()
+        query.pop('page', None)
+
+        context['page'] = page
+        context['query'] = query.urlencode()
+        context['target'] = target
+        context['tgt_type'] = tgt_type
+        context['state'] = state
+        context['hostname'] = hostname
+        context['states'] = fleet_inventory.get_index(target, tgt_type)['states']
+        return context
+
+
+class DeleteVMView(TimedViewMixin, CNCView):
+    """
+    /vistoq/delete_vm/<minion>/<hostname>
+
+    Ask for confirmation on GET and delete the VM on POST, so link prefetching and browser retries do not delete
+    anything. Repeated posts for the same VM attach to the delete in flight instead of running it again
+    """
+    template_name = 'vistoq/confirm_delete.html'
     base_html = 'vistoq/base.html'
     app_dir = 'vistoq'
 
     def get_context_data(self, **kwargs):
-        hostname = self.kwargs['hostname']
+        context = super().get_context_data(**kwargs)
+        context['base_html'] = self.base_html
+        context['minion'] = self.kwargs['minion']
+        context['hostname'] = self.kwargs['hostname']
+        return context
+
+    def delete_vm(self, payload):
         minion = self.kwargs['minion']
+        hostname = self.kwargs['hostname']
+        salt_util = salt_utils.SaltUtil()
+        res = salt_util.deploy_payload(payload)
+        print('deleting hostname %s' % hostname)
+        # the raw return is kept in the deployment history, only show its outcome
+        try:
+            success, comment = job_utils.check_state_return(json.loads(res)['return'][0][minion])
+        except (ValueError, TypeError, KeyError, IndexError):
+            return 'Error deleting VM! %s' % res
+
+        if not success:
+            return 'Error deleting VM! %s' % comment
+
+        inventory_utils.fleet_inventory.forget_vm(minion, hostname)
+        return 'VM %s deleted from %s' % (hostname, minion)
 
-        service = snippet_utils.load_snippet_with_name('delete_single_vm', self.app_dir)
+    def post(self, request, *args, **kwargs):
+        service = snippet_registry.load_snippet('delete_single_vm')
         jinja_context = dict()
         for v in service['variables']:
             if kwargs.get(v['name']):
                 jinja_context[v['name']] = kwargs.get(v['name'])
 
-        template = snippet_utils.render_snippet_template(service, self.app_dir, jinja_context)
-        salt_util = salt_utils.SaltUtil()
-        res = salt_util.deploy_template(template)
-        print(res)
-        print('deleting hostname %s' % hostname)
+        payload = snippet_registry.render_payload('delete_single_vm', jinja_context)
+        request_key = idempotency_utils.request_key('delete', payload)
+        res, duplicate = idempotency_utils.guard.run(request_key, lambda: self.delete_vm(payload),
+                                                     succeeded=lambda r: not r.startswith('Error'))
+        if duplicate and res is None:
+            messages.add_message(request, messages.INFO, 'This VM is already being deleted')
+            return HttpResponseRedirect(idempotency_utils.status_link(request_key))
+
+        if duplicate:
+            messages.add_message(request, messages.INFO, 'This VM was already being deleted, showing that result')
+
         context = dict()
         context['base_html'] = self.base_html
         context['results'] = res
+        return render(request, 'pan_cnc/results.html', context=context)
 
-        return context
 
+class BulkDeleteVMView(TimedViewMixin, CNCView):
+    """
+    /vistoq/delete_vms
 
-class GPCSView(CNCBaseFormView):
+    Delete the VMs selected on the deployed VMs pages. Each compute node receives a single salt call with the list
+    of hostnames to delete and the nodes are processed in parallel. Posting 'delete_all' with a minion removes every
+    VM on that node through the delete_all_vms snippet
+    """
+    base_html = 'vistoq/base.html'
+    app_dir = 'vistoq'
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponseRedirect('/vistoq/view_deployed_vms')
+
+    def post(self, request, *args, **kwargs):
+        selected = delete_utils.parse_selected_vms(request.POST.getlist('vms'))
+        delete_all_minions = list()
+        if request.POST.get('delete_all', '') != '' and request.POST.get('minion', '') != '':
+            delete_all_minions.append(request.POST.get('minion'))
+
+        if not selected and not delete_all_minions:
+            messages.add_message(request, messages.ERROR, 'No VMs selected')
+            return HttpResponseRedirect('/vistoq/view_deployed_vms')
+
+        request_key = idempotency_utils.request_key('delete_vms', selected, sorted(delete_all_minions))
+        results, duplicate = idempotency_utils.guard.run(
+            request_key, lambda: delete_utils.delete_vms(selected, delete_all_minions),
+            succeeded=lambda r: all(row['status'] == 'success' for row in r))
+        if duplicate and results is None:
+            messages.add_message(request, messages.INFO, 'These VMs are already being deleted')
+            return HttpResponseRedirect(idempotency_utils.status_link(request_key))
+
+        if duplicate:
+            messages.add_message(request, messages.INFO, 'These VMs were already being deleted, showing that result')
+
+        context = dict()
+        context['base_html'] = self.base_html
+        context['title'] = 'Delete Next Generation Firewalls'
+        context['header'] = 'Delete Results'
+        context['results'] = results
+        context['failed'] = len([r for r in results if r['status'] != 'success'])
+        return render(request, 'vistoq/batch_results.html', context=context)
+
+
+class GPCSView(TimedViewMixin, CNCBaseFormView):
     """
     /vistoq/configure
 
@@ -309,7 +831,7 @@ class GPCSView(CNCBaseFormView):
 
         form = context['form']
         # load all snippets with a type of 'service'
-        services = snippet_utils.load_snippets_of_type('gpcs')
+        services = snippet_index.load_snippets_of_type('gpcs')
 
         # we need to construct a new ChoiceField with the following basic format
         # snippet_name = forms.ChoiceField(choices=(('gold', 'Gold'), ('silver', 'Silver'), ('bronze', 'Bronze')))
@@ -341,7 +863,7 @@ class GPCSView(CNCBaseFormView):
         return HttpResponseRedirect('provision')
 
 
-class GsbProvisionView(ProvisionSnippetView):
+class GsbProvisionView(CompactWorkflowMixin, TimedViewMixin, ProvisionSnippetView):
     base_html = 'vistoq/base.html'
 
     def generate_dynamic_form(self):
@@ -357,22 +879,80 @@ class GsbProvisionView(ProvisionSnippetView):
         return super().generate_dynamic_form()
 
 
-class GsbWorkflow02(ProvisionSnippetView):
+class BatchProvisionMixin():
+    """
+    Stage the service chosen in the workflow into the operator's open provisioning batch instead of pushing it to
+    Panorama right away. The batch is committed once for all of its tenants from /vistoq/provision_batch/<batch_id>
+    """
+    batch_session_key = 'vistoq_provision_batch'
+
+    def get_open_batch(self):
+        batch = provision_utils.batch_provisioner.get_batch(self.request.session.get(self.batch_session_key, ''))
+        if batch is None or batch.status != batch.OPEN:
+            batch = provision_utils.batch_provisioner.create_batch('Batch by %s' % self.request.user)
+            self.request.session[self.batch_session_key] = batch.id
+
+        return batch
+
+    def get_batch_value(self, name):
+        value = self.request.POST.get(name, '')
+        if value == '':
+            value = self.get_value_from_workflow(name, None)
+
+        return value
+
+    def stage_tenant(self):
+        """
+        Render the service of the workflow and stage it in the open batch
+        :return: redirect to the batch page
+        """
+        snippet_name = self.get_value_from_workflow('snippet_name', '')
+        service = snippet_index.load_snippet_with_name(snippet_name)
+        if service is None:
+            messages.add_message(self.request, messages.ERROR, 'Could not find service %s' % snippet_name)
+            return HttpResponseRedirect('/vistoq/provision_batches')
+
+        context = provision_utils.get_service_context(service, self.get_batch_value)
+        device_group = self.get_batch_value('DEVICE_GROUP') or ''
+        stack = self.get_batch_value('STACK') or ''
+        tenant = self.get_batch_value('customer_name') or self.get_batch_value('FW_NAME') or device_group or \
+            snippet_name
+
+        batch = self.get_open_batch()
+        try:
+            provision_utils.batch_provisioner.stage(batch, tenant, snippet_name, context, device_group, stack)
+            messages.add_message(self.request, messages.INFO, 'Staged %s for the next commit' % tenant)
+        except ValueError as ve:
+            messages.add_message(self.request, messages.ERROR, 'Could not stage %s: %s' % (tenant, ve))
+
+        return HttpResponseRedirect('/vistoq/provision_batch/%s' % batch.id)
+
+
+class BatchProvisionSnippetView(BatchProvisionMixin, CompactWorkflowMixin, TimedViewMixin, ProvisionSnippetView):
+    """
+    /vistoq/provision_batch_tenant
+
+    Collect the variables of the chosen service, like ProvisionSnippetView, and stage the result in the open
+    provisioning batch
+    """
     base_html = 'vistoq/base.html'
 
-    def create_sku(self):
-        # decoder ring to map menu values to SKU elements
-        sku_tier = {'gold': 'BND2', 'silver': 'BND1', 'bronze': 'BASIC'}
-        sku_size = {'small': 'VM-50', 'medium': 'VM-300', 'large': 'VM-500'}
-        sku_term = {'M': 'MU', '1': 'YU', '3': '3YU'}
+    def form_valid(self, form):
+        return self.stage_tenant()
+
 
-        user_tier = self.get_value_from_workflow('snippet_name', '').split('_')[0]
+class GsbWorkflow02(BatchProvisionMixin, CompactWorkflowMixin, TimedViewMixin, ProvisionSnippetView):
+    base_html = 'vistoq/base.html'
+    # stage the tenant in the open provisioning batch instead of pushing it on its own
+    batch_provision = False
+
+    def create_sku(self):
+        snippet_name = self.get_value_from_workflow('snippet_name', '')
         user_size = self.get_value_from_workflow('service_size', '')
         user_term = self.get_value_from_workflow('service_term', '')
 
-        sku = 'PAN-{0}-SP-BKLN-{1}-{2}'.format(sku_size[user_size],
-                                               sku_tier[user_tier],
-                                               sku_term[user_term])
+        # shared with the bulk onboarding command
+        sku = sku_utils.build_sku(snippet_name, user_size, user_term)
 
         self.save_value_to_workflow('sku', sku)
         print('sku is {0}'.format(sku))
@@ -410,14 +990,170 @@ class GsbWorkflow02(ProvisionSnippetView):
 
         print('set device-group and stack to firewall name')
 
+        if self.batch_provision:
+            return self.stage_tenant()
+
         return super().form_valid(form)
 
 
-class VistoqChooseSnippetView(ChooseSnippetView):
+class ProvisionBatchListView(TimedViewMixin, CNCView):
+    """
+    /vistoq/provision_batches
+
+    List the recent provisioning batches
+    """
+    template_name = 'vistoq/provision_batches.html'
+    base_html = 'vistoq/base.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['batches'] = provision_utils.batch_provisioner.get_recent_batches()
+        context['open_batch'] = self.request.session.get(BatchProvisionMixin.batch_session_key, '')
+        return context
+
+
+class ProvisionBatchView(TimedViewMixin, CNCView):
+    """
+    /vistoq/provision_batch/<batch_id>
+
+    Show the tenants staged in a provisioning batch and the result of each. Posting 'apply' sets the configuration
+    of every tenant, commits Panorama once and pushes each device group and template stack once
+    """
+    template_name = 'vistoq/provision_batch.html'
+    base_html = 'vistoq/base.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        batch = provision_utils.batch_provisioner.get_batch(self.kwargs['batch_id'])
+        context['batch_id'] = self.kwargs['batch_id']
+        context['batch'] = batch
+        context['tenants'] = batch.tenants.all() if batch is not None else list()
+        return context
+
+    def post(self, request, *args, **kwargs):
+        batch_id = self.kwargs['batch_id']
+        if request.POST.get('apply', '') != '':
+            if provision_utils.batch_provisioner.start_apply(batch_id):
+                # the next tenant goes into a new batch
+                request.session.pop(BatchProvisionMixin.batch_session_key, None)
+                messages.add_message(request, messages.INFO, 'Applying the batch to Panorama')
+            else:
+                messages.add_message(request, messages.ERROR, 'This batch is being applied or has already been applied')
+
+        return HttpResponseRedirect('/vistoq/provision_batch/%s' % batch_id)
+
+
+class VistoqChooseSnippetView(TimedViewMixin, ChooseSnippetView):
     base_html = 'vistoq/base.html'
 
 
-class VistoqRedirectView(CNCView):
+class VistoqChooseSnippetByLabelView(TimedViewMixin, ChooseSnippetByLabelView):
+    """
+    ChooseSnippetByLabelView that finds the snippets with the configured label in the snippet index instead of
+    parsing every .meta-cnc.yaml file on each request
+    """
+
+    def get_context_data(self, **kwargs):
+        # skip the snippet scan of ChooseSnippetByLabelView, the choices are built from the index below
+        context = super(ChooseSnippetByLabelView, self).get_context_data(**kwargs)
+        form = context['form']
+
+        services = snippet_index.load_snippets_by_label(self.label_name, self.label_value)
+        choices_list = list()
+        for service in services:
+            choices_list.append((service['name'], service.get('label', service['name'])))
+
+        choices_list = sorted(choices_list, key=lambda k: k[1])
+        form.fields['snippet_name'] = forms.ChoiceField(choices=tuple(choices_list))
+        context['form'] = form
+        return context
+
+
+class VmEventsView(TimedViewMixin, CNCView):
+    """
+    /vistoq/vm_events?minion=<minion>&jid=<jid>&cursor=<cursor>
+
+    Return the VM state changes and deployment job returns since a cursor as json, the pages poll it every
+    VM_EVENTS_POLL_INTERVAL seconds. A snapshot of the VMs of the minion is returned instead when the cursor is
+    missing, too old or was handed out by another worker process, so no change is replayed or skipped
+    """
+
+    def get(self, request, *args, **kwargs):
+        event_utils.event_consumer.ensure_started()
+        minion = request.GET.get('minion', '')
+        jid = request.GET.get('jid', '')
+
+        def matches(change):
+            if change['type'] == 'job':
+                return change['jid'] == jid or (jid == '' and minion != '' and change['minion'] == minion)
+
+            return minion == '' or change['minion'] == minion
+
+        cursor, changes = event_utils.vm_state_table.get_changes(request.GET.get('cursor', ''))
+        data = dict()
+        data['cursor'] = cursor
+        data['live'] = event_utils.event_consumer.connected
+        if changes is None:
+            vms = event_utils.vm_state_table.get_vms(minion) if minion != '' else None
+            data['snapshot'] = {'minion': minion, 'vms': vms}
+            changes = list()
+
+        data['changes'] = [c for c in changes if matches(c)]
+        return JsonResponse(data)
+
+
+class MetricsView(View):
+    """
+    /vistoq/metrics
+
+    Export the vistoq instrumentation in the Prometheus text format. Set METRICS_TOKEN to require a bearer token,
+    without one only clients from METRICS_ALLOWED_NETWORKS are served
+    """
+    default_networks = '127.0.0.0/8,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16,fc00::/7'
+
+    def is_allowed_client(self, request):
+        networks = cnc_utils.get_config_value('METRICS_ALLOWED_NETWORKS', self.default_networks)
+        try:
+            address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+        except ValueError:
+            return False
+
+        for network in str(networks).split(','):
+            try:
+                if network.strip() and address in ipaddress.ip_network(network.strip(), strict=False):
+                    return True
+            except ValueError:
+                print('Ignoring invalid network %s in METRICS_ALLOWED_NETWORKS' % network)
+
+        return False
+
+    def get(self, request, *args, **kwargs):
+        token = cnc_utils.get_config_value('METRICS_TOKEN', '')
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if token and not hmac.compare_digest(authorization.encode('utf-8'), ('Bearer %s' % token).encode('utf-8')):
+            return HttpResponse('Unauthorized', status=401)
+
+        if not token and not self.is_allowed_client(request):
+            return HttpResponse('Forbidden', status=403)
+
+        return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4')
+
+
+class ReadyView(View):
+    """
+    /vistoq/ready
+
+    Readiness probe for rolling deployments. Returns 503 until the startup cache warm-up has finished, along with
+    the startup time report
+    """
+
+    def get(self, request, *args, **kwargs):
+        report = warmup_utils.warmup.get_report()
+        status = 200 if warmup_utils.warmup.is_ready() else 503
+        return JsonResponse(report, status=status)
+
+
+class VistoqRedirectView(TimedViewMixin, CNCView):
     template_name = 'vistoq/redirect.html'
 
     def get_context_data(self, **kwargs):
@@ -1,51 +1,302 @@
+import argparse
+import hashlib
+import json
 import jinja2
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import os
 import oyaml
 from jinja2 import meta
+from jinja2 import nodes
 import string
 
-snippets_dir = Path(sys.argv[1])
-snippet_name = os.path.basename(snippets_dir)
+# bump when the parsing below changes to invalidate existing caches
+cache_version = 1
 
-# get the jinja environment to use it's parse function
-env = jinja2.Environment()
-all_variables = list()
+# files of a new snippet directory that are treated as templates, READMEs, licenses and the like are not
+template_extensions = ('.j2', '.jinja', '.jinja2', '.xml', '.conf', '.cfg', '.json', '.sls', '.set', '.tmpl')
 
-metadata = dict()
-metadata['variables'] = list()
-metadata['snippets'] = list()
-metadata['name'] = snippet_name
 
-# env.filters['sha512_hash'] = jinja2_filters.sha512_hash
-services = list()
-for d in snippets_dir.rglob('./*'):
-    if os.path.isfile(d):
+def find_template_variables(template):
+    """
+    Find the variables a template expects, in the order they first appear
+    :param template: template string
+    :return: list of variable names
+    """
+    # get the jinja environment to use it's parse function
+    env = jinja2.Environment()
+    # parse returns an AST that can be send to the meta module
+    ast = env.parse(template)
+    # return a set of all variable defined in the template
+    template_variables = meta.find_undeclared_variables(ast)
+
+    ordered = list()
+    for name_node in ast.find_all(nodes.Name):
+        if name_node.name in template_variables and name_node.name not in ordered:
+            ordered.append(name_node.name)
+
+    return ordered
+
+
+def parse_template_file(path):
+    """
+    Process pool worker
+    :param path: path of a template file
+    :return: tuple of (path, content hash, list of variables) or (path, None, None) if the file can not be read
+    """
+    try:
+        with open(path, 'rb') as sc:
+            content = sc.read()
+
+        digest = hashlib.sha256(content).hexdigest()
+        return path, digest, find_template_variables(content.decode('utf-8'))
+    except (IOError, UnicodeDecodeError, jinja2.TemplateSyntaxError) as e:
+        print('Could not parse snippet file %s' % path)
+        print(e)
+        return path, None, None
+
+
+def load_cache(cache_file):
+    if cache_file is None or not os.path.isfile(cache_file):
+        return dict()
+
+    try:
+        with open(cache_file, 'r') as cf:
+            cache = json.load(cf)
+
+        if cache.get('version', None) != cache_version:
+            return dict()
+
+        return cache.get('variables', dict())
+    except (IOError, ValueError) as e:
+        print('Ignoring unreadable cache %s' % cache_file)
+        print(e)
+        return dict()
+
+
+def save_cache(cache_file, cache):
+    with open(cache_file, 'w') as cf:
+        json.dump({'version': cache_version, 'variables': cache}, cf, sort_keys=True)
+
+
+def get_template_files(snippet_dir, nested_snippet_dirs=()):
+    """
+    :param snippet_dir: snippet directory
+    :param nested_snippet_dirs: snippet directories below this one, their files belong to them
+    :return: sorted list of template file paths, hidden files such as .meta-cnc.yaml and files without a template
+    extension are skipped
+    """
+    template_files = list()
+    for d in sorted(Path(snippet_dir).rglob('./*')):
+        if not os.path.isfile(d) or d.name.startswith('.'):
+            continue
+
+        if d.suffix.lower() not in template_extensions:
+            continue
+
+        if any(nested in d.parents for nested in nested_snippet_dirs):
+            continue
+
+        template_files.append(d)
+
+    return template_files
+
+
+def get_referenced_files(snippet_dir, metadata):
+    """
+    :param snippet_dir: snippet directory
+    :param metadata: existing metadata of the snippet directory
+    :return: list of the template file paths its snippets reference and that exist
+    """
+    template_files = list()
+    for snippet in metadata.get('snippets', None) or list():
+        if not isinstance(snippet, dict) or not snippet.get('file', ''):
+            continue
+
+        path = Path(snippet_dir) / str(snippet['file'])
+        if os.path.isfile(path) and path not in template_files:
+            template_files.append(path)
+
+    return template_files
+
+
+def parse_files(paths, cache, workers=None):
+    """
+    Find the variables of many template files. Files whose content hash is in the cache are not parsed again,
+    the others are parsed in a process pool
+    :param paths: list of template file paths
+    :param cache: dict of content hash -> list of variables, updated in place
+    :param workers: number of processes, defaults to the number of cpus
+    :return: dict of path -> list of variables
+    """
+    results = dict()
+    to_parse = list()
+    for path in paths:
         try:
-            with open(d, 'r') as sc:
-                template = sc.read()
-                snippet_file_name = os.path.basename(d)
-                metadata['snippets'].append({'name': snippet_file_name, 'file': snippet_file_name})
-                # parse returns an AST that can be send to the meta module
-                ast = env.parse(template)
-                # return a set of all variable defined in the template
-                template_variables = meta.find_undeclared_variables(ast)
-                all_variables.extend(template_variables)
+            with open(path, 'rb') as sc:
+                digest = hashlib.sha256(sc.read()).hexdigest()
         except IOError as ioe:
-            print('Could not open snippet file in dir %s' % d)
+            print('Could not open snippet file %s' % path)
             print(ioe)
             continue
 
-print('This is all the vars I found!')
-print(all_variables)
-for v in all_variables:
-    var_dict = dict()
-    var_dict['name'] = v
-    var_dict['description'] = string.capwords(v.replace('_', ' '))
-    var_dict['default'] = v
-    var_dict['type_hint'] = 'text'
-    metadata['variables'].append(var_dict)
+        if digest in cache:
+            results[path] = cache[digest]
+        else:
+            to_parse.append(path)
+
+    if len(to_parse) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed = list(executor.map(parse_template_file, to_parse, chunksize=16))
+    else:
+        parsed = [parse_template_file(p) for p in to_parse]
+
+    for path, digest, variables in parsed:
+        if digest is None:
+            continue
+
+        cache[digest] = variables
+        results[path] = variables
+
+    print('Parsed %s template files, %s unchanged' % (len(to_parse), len(paths) - len(to_parse)))
+    return results
+
+
+def build_metadata(snippet_dir, template_files, file_variables, metadata=None):
+    """
+    Build or update the metadata of a snippet directory. A new metadata gets a snippet for every template file.
+    Existing metadata keeps its snippets as they are and only gains the variables of the files they reference,
+    variables are de-duplicated and new ones are appended in the order they are first used
+    :param snippet_dir: snippet directory
+    :param template_files: list of template file paths, for existing metadata only the files its snippets reference
+    :param file_variables: dict of path -> list of variables
+    :param metadata: existing metadata or None
+    :return: metadata dict
+    """
+    if metadata is None:
+        metadata = dict()
+        metadata['name'] = os.path.basename(snippet_dir)
+        metadata['snippets'] = list()
+        for d in template_files:
+            snippet_file_name = os.path.relpath(str(d), str(snippet_dir))
+            metadata['snippets'].append({'name': os.path.basename(d), 'file': snippet_file_name})
+
+    variables = list(metadata.get('variables', None) or list())
+    known_variables = set(v['name'] for v in variables)
+    for d in template_files:
+        for v in file_variables.get(d, list()):
+            if v in known_variables:
+                continue
+
+            var_dict = dict()
+            var_dict['name'] = v
+            var_dict['description'] = string.capwords(v.replace('_', ' '))
+            var_dict['default'] = v
+            var_dict['type_hint'] = 'text'
+            variables.append(var_dict)
+            known_variables.add(v)
+
+    # keep empty keys as they are so snippets without templates are left untouched
+    if variables or 'variables' not in metadata:
+        metadata['variables'] = variables
+
+    return metadata
+
+
+def bulk_update(roots, cache_file, workers=None, dry_run=False):
+    """
+    Add the variables of the files referenced by the snippets of every .meta-cnc.yaml file found below the roots,
+    snippet entries are never added or changed
+    :param roots: list of directories to walk, such as the cloned iron_skillet_v81 and mssp_templates_v81 repos
+    :param cache_file: json file holding the variables of already parsed templates by content hash
+    :param workers: number of processes used for parsing
+    :param dry_run: only report which files would change
+    :return: list of metadata files that changed
+    """
+    snippet_dirs = list()
+    for root in roots:
+        snippet_dirs.extend(sorted(m.parent for m in Path(root).rglob('.meta-cnc.yaml')))
+
+    current_by_dir = dict()
+    metadata_by_dir = dict()
+    for snippet_dir in snippet_dirs:
+        meta_file = snippet_dir / '.meta-cnc.yaml'
+        with meta_file.open('r') as mf:
+            current = mf.read()
+
+        try:
+            metadata = oyaml.safe_load(current)
+        except oyaml.YAMLError as ye:
+            print('Skipping invalid metadata file %s' % meta_file)
+            print(ye)
+            continue
+
+        if not isinstance(metadata, dict):
+            print('Skipping invalid metadata file %s' % meta_file)
+            continue
+
+        current_by_dir[snippet_dir] = current
+        metadata_by_dir[snippet_dir] = metadata
+
+    # only the files the existing snippets reference, never READMEs or other files next to them
+    files_by_dir = dict()
+    for snippet_dir, metadata in metadata_by_dir.items():
+        files_by_dir[snippet_dir] = get_referenced_files(snippet_dir, metadata)
+
+    cache = load_cache(cache_file)
+    all_files = [f for files in files_by_dir.values() for f in files]
+    file_variables = parse_files(all_files, cache, workers)
+
+    changed = list()
+    for snippet_dir, metadata in metadata_by_dir.items():
+        meta_file = snippet_dir / '.meta-cnc.yaml'
+        current = current_by_dir[snippet_dir]
+        metadata = build_metadata(snippet_dir, files_by_dir[snippet_dir], file_variables, metadata)
+        updated = oyaml.dump(metadata, default_flow_style=False)
+        # compare the parsed documents so files are not rewritten only because of formatting
+        if oyaml.safe_load(updated) == oyaml.safe_load(current):
+            continue
+
+        changed.append(meta_file)
+        if not dry_run:
+            with meta_file.open('w') as mf:
+                mf.write(updated)
+
+    if cache_file is not None and not dry_run:
+        save_cache(cache_file, cache)
+
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create or update .meta-cnc.yaml files from jinja templates')
+    parser.add_argument('paths', nargs='+', help='snippet directory, or repository roots with --bulk')
+    parser.add_argument('--bulk', action='store_true',
+                        help='add missing variables to every .meta-cnc.yaml file below the given roots')
+    parser.add_argument('--cache', default='.metadata_cache.json',
+                        help='cache of parsed variables by content hash, used with --bulk')
+    parser.add_argument('--workers', type=int, default=None, help='number of parsing processes')
+    parser.add_argument('--dry-run', action='store_true', help='only list the metadata files that would change')
+    args = parser.parse_args()
+
+    if args.bulk:
+        changed = bulk_update(args.paths, args.cache, args.workers, args.dry_run)
+        for meta_file in changed:
+            print('%s %s' % ('Would update' if args.dry_run else 'Updated', meta_file))
+
+        print('%s metadata files changed' % len(changed))
+        return
+
+    snippets_dir = Path(args.paths[0])
+    template_files = get_template_files(snippets_dir)
+    file_variables = parse_files(template_files, dict(), workers=1)
+    metadata = build_metadata(snippets_dir, template_files, file_variables)
+
+    print('This is all the vars I found!')
+    print([v['name'] for v in metadata['variables']])
+    print(oyaml.dump(metadata, default_flow_style=False))
 
-print(oyaml.dump(metadata, default_flow_style=False))
 
+if __name__ == '__main__':
+    sys.exit(main())
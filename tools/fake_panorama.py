@@ -0,0 +1,295 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Stub of the Panorama XML API for vistoq development and benchmarks.
+
+Supports the calls made through pan_utils and pan.xapi: keygen, generating a VM auth key, getting, setting and
+deleting device groups, commit, commit-all and show jobs. pan.xapi talks https, so pass a certificate and key to
+serve TLS and point PANORAMA_IP at this server:
+
+    openssl req -x509 -newkey rsa:2048 -nodes -keyout panorama.key -out panorama.crt -subj /CN=localhost
+    python tools/fake_panorama.py --port 8443 --certfile panorama.crt --keyfile panorama.key --device-groups 500
+"""
+
+import argparse
+import random
+import re
+import ssl
+import threading
+import time
+import uuid
+from datetime import datetime
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+from xml.sax.saxutils import escape
+from xml.sax.saxutils import quoteattr
+
+device_group_xpath = "/config/devices/entry[@name='localhost.localdomain']/device-group"
+entry_name_pattern = re.compile(r"@name='([^']+)'")
+
+
+class FakePanorama():
+    """
+    In memory Panorama configuration and job queue
+    """
+
+    def __init__(self, device_groups=100, commit_time=2.0):
+        self.commit_time = commit_time
+        self.device_groups = dict()
+        for i in range(device_groups):
+            name = 'customer-%04d' % (i + 1)
+            self.device_groups[name] = 'Customer %04d' % (i + 1)
+
+        self.jobs = dict()
+        self.next_job = 1
+        self._lock = threading.Lock()
+
+    def get_device_groups(self, xpath):
+        """
+        :param xpath: device group xpath, optionally filtered by name or selecting only the name attributes
+        :return: xml fragment of the matching device group entries
+        """
+        with self._lock:
+            device_groups = dict(self.device_groups)
+
+        rest = xpath[len(device_group_xpath):]
+        names = entry_name_pattern.findall(rest)
+        if names:
+            device_groups = {n: d for n, d in device_groups.items() if n in names}
+
+        if rest.endswith('@name'):
+            entries = ''.join('<entry name=%s/>' % quoteattr(n) for n in sorted(device_groups))
+            return entries
+
+        entries = list()
+        for name in sorted(device_groups):
+            entries.append('<entry name=%s><description>%s</description><devices/></entry>'
+                           % (quoteattr(name), escape(device_groups[name])))
+
+        if rest == '':
+            return '<device-group>%s</device-group>' % ''.join(entries)
+
+        return ''.join(entries)
+
+    def set_device_group(self, xpath, element):
+        names = entry_name_pattern.findall(xpath[len(device_group_xpath):])
+        description_match = re.search(r'<description>([^<]*)</description>', element or '')
+        with self._lock:
+            if names:
+                name = names[0]
+                self.device_groups[name] = description_match.group(1) if description_match else \
+                    self.device_groups.get(name, '')
+            else:
+                for name in re.findall(r'<entry name="([^"]+)"', element or ''):
+                    self.device_groups.setdefault(name, '')
+
+    def delete_device_group(self, xpath):
+        with self._lock:
+            for name in entry_name_pattern.findall(xpath[len(device_group_xpath):]):
+                self.device_groups.pop(name, None)
+
+    def start_job(self, job_type):
+        with self._lock:
+            job_id = self.next_job
+            self.next_job += 1
+            self.jobs[job_id] = {'id': job_id, 'type': job_type, 'start': time.time()}
+
+        return job_id
+
+    def job_status(self, job_id):
+        job = self.jobs.get(job_id, None)
+        if job is None:
+            return None
+
+        progress = min(100, int((time.time() - job['start']) / max(self.commit_time, 0.001) * 100))
+        status = 'FIN' if progress >= 100 else 'ACT'
+        result = 'OK' if status == 'FIN' else 'PEND'
+        return ('<job><id>%s</id><type>%s</type><status>%s</status><result>%s</result><progress>%s</progress>'
+                '<details/></job>' % (job_id, job['type'], status, result, progress))
+
+
+class FakePanoramaHandler(BaseHTTPRequestHandler):
+    server_version = 'Apache'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_xml(self, body, status='success', code=None, http_status=200):
+        code_attr = ' code="%s"' % code if code is not None else ''
+        data = ('<response status="%s"%s>%s</response>' % (status, code_attr, body)).encode('utf-8')
+        self.send_response(http_status)
+        self.send_header('Content-Type', 'application/xml; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_result(self, result, code=None):
+        self.send_xml('<result>%s</result>' % result, code=code)
+
+    def send_failure(self, message, code=None):
+        self.send_xml('<msg><line>%s</line></msg>' % escape(message), status='error', code=code)
+
+    def do_GET(self):
+        self.handle_api(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        params = parse_qs(self.rfile.read(length).decode('utf-8')) if length else dict()
+        params.update(parse_qs(urlparse(self.path).query))
+        self.handle_api(params)
+
+    def handle_api(self, params):
+        params = {k: v[0] for k, v in params.items()}
+        if urlparse(self.path).path.rstrip('/') != '/api':
+            self.send_failure('Not found', code=404)
+            return
+
+        if self.server.latency > 0:
+            time.sleep(random.uniform(0.5, 1.5) * self.server.latency)
+
+        if random.random() < self.server.failure_rate:
+            self.send_failure('Simulated failure', code=400)
+            return
+
+        api_type = params.get('type', '')
+        if api_type == 'keygen':
+            if params.get('user') != self.server.username or params.get('password') != self.server.password:
+                self.send_failure('Invalid credentials.', code=403)
+                return
+
+            self.send_result('<key>%s</key>' % self.server.api_key)
+            return
+
+        if params.get('key', '') != self.server.api_key and 'Authorization' not in self.headers:
+            self.send_failure('Invalid Credential', code=403)
+            return
+
+        panorama = self.server.panorama
+        cmd = params.get('cmd', '')
+        if api_type == 'op':
+            if 'vm-auth-key' in cmd:
+                lifetime = re.search(r'<lifetime>(\d+)</lifetime>', cmd)
+                hours = int(lifetime.group(1)) if lifetime else 24
+                expires = (datetime.now() + timedelta(hours=hours)).strftime('%Y/%m/%d %H:%M:%S')
+                key = ''.join(random.choice('0123456789') for _ in range(16))
+                self.send_result('VM auth key %s generated. Expires at: %s' % (key, expires))
+            elif '<jobs>' in cmd:
+                job_id = re.search(r'<id>(\d+)</id>', cmd)
+                status = panorama.job_status(int(job_id.group(1))) if job_id else None
+                if status is None:
+                    self.send_failure('job not found')
+                else:
+                    self.send_result(status)
+            elif '<system><info>' in cmd:
+                self.send_result('<system><hostname>fake-panorama</hostname><sw-version>8.1.0</sw-version>'
+                                 '<model>Panorama</model></system>')
+            else:
+                self.send_result('')
+        elif api_type == 'config':
+            action = params.get('action', '')
+            xpath = params.get('xpath', '')
+            if not xpath.startswith(device_group_xpath):
+                if action in ('get', 'show'):
+                    self.send_result('', code=7)
+                else:
+                    self.send_xml('<msg>command succeeded</msg>', code=20)
+
+                return
+
+            if action in ('get', 'show'):
+                self.send_result(panorama.get_device_groups(xpath), code=19)
+            elif action in ('set', 'edit'):
+                panorama.set_device_group(xpath, params.get('element', ''))
+                self.send_xml('<msg>command succeeded</msg>', code=20)
+            elif action == 'delete':
+                panorama.delete_device_group(xpath)
+                self.send_xml('<msg>command succeeded</msg>', code=20)
+            else:
+                self.send_failure('Unsupported action %s' % action)
+        elif api_type == 'commit':
+            job_type = 'CommitAll' if params.get('action', '') == 'all' else 'Commit'
+            job_id = panorama.start_job(job_type)
+            self.send_result('<msg><line>Commit job enqueued with jobid %s</line></msg><job>%s</job>'
+                             % (job_id, job_id), code=19)
+        else:
+            self.send_failure('Unsupported type %s' % api_type)
+
+
+class FakePanoramaServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, panorama, latency=0.0, failure_rate=0.0, username='admin', password='admin',
+                 verbose=False):
+        super().__init__(address, FakePanoramaHandler)
+        self.panorama = panorama
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.username = username
+        self.password = password
+        self.api_key = uuid.uuid4().hex
+        self.verbose = verbose
+
+
+def start_server(host='127.0.0.1', port=8443, certfile=None, keyfile=None, device_groups=100, commit_time=2.0,
+                 **kwargs):
+    """
+    Start a Panorama stub in a background thread, for use from benchmarks
+    :return: FakePanoramaServer
+    """
+    server = FakePanoramaServer((host, port), FakePanorama(device_groups, commit_time), **kwargs)
+    if certfile is not None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+
+    threading.Thread(target=server.serve_forever, name='fake-panorama', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Panorama XML API stub for vistoq development and benchmarks')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--certfile', help='serve https with this certificate, required by pan.xapi')
+    parser.add_argument('--keyfile')
+    parser.add_argument('--device-groups', type=int, default=100, help='number of device groups to create')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds added to each request')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of requests returning an error')
+    parser.add_argument('--commit-time', type=float, default=2.0, help='seconds a commit job takes')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server = start_server(args.host, args.port, args.certfile, args.keyfile, args.device_groups, args.commit_time,
+                          latency=args.latency, failure_rate=args.failure_rate, username=args.username,
+                          password=args.password, verbose=args.verbose)
+    scheme = 'https' if args.certfile else 'http'
+    print('Fake Panorama with %s device groups listening on %s://%s:%s/api/' % (args.device_groups, scheme, args.host,
+                                                                                args.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
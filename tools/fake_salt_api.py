@@ -0,0 +1,448 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Stand in for salt-api (rest_cherrypy) so vistoq can be developed and benchmarked without a provisioner.
+
+Implements /login, /minions, / (local and local_async clients), /jobs/<jid> and the /events stream against an in
+memory fleet of compute nodes. The functions used by the vistoq snippets are supported: virt.vm_state,
+virt.freemem, virt.freecpu, test.ping, grains.items and state.apply of create_ngfw, delete_all_ngfw and
+delete_all_vms.
+
+    python tools/fake_salt_api.py --port 9000 --minions 4 --vms 10 --latency 0.05 --failure-rate 0.01
+
+then point vistoq at it with SALT_API_URL=http://localhost:9000
+"""
+
+import argparse
+import fnmatch
+import json
+import queue
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+
+class FakeFleet():
+    """
+    In memory compute nodes, the VMs running on them and the salt jobs run against them
+    """
+
+    def __init__(self, minions=4, vms=10, deploy_time=5.0, delete_time=1.0):
+        self.deploy_time = deploy_time
+        self.delete_time = delete_time
+        self.nodes = dict()
+        for m in range(minions):
+            minion = 'compute-%02d.c.vistoq-demo.internal' % (m + 1)
+            self.nodes[minion] = dict()
+            for v in range(vms):
+                self.nodes[minion]['panos-%02d-%02d' % (m + 1, v + 1)] = random.choice(['running', 'running',
+                                                                                          'shutdown'])
+
+        self.jobs = dict()
+        self.subscribers = list()
+        self._lock = threading.Lock()
+
+    def match(self, tgt, tgt_type='glob'):
+        if tgt_type == 'list':
+            targets = tgt if isinstance(tgt, list) else str(tgt).split(',')
+            return [t.strip() for t in targets if t.strip() in self.nodes]
+
+        return sorted(m for m in self.nodes if fnmatch.fnmatch(m, str(tgt)))
+
+    def publish(self, tag, data):
+        event = {'tag': tag, 'data': data}
+        with self._lock:
+            subscribers = list(self.subscribers)
+
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+    def subscribe(self):
+        subscriber = queue.Queue()
+        with self._lock:
+            self.subscribers.append(subscriber)
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    @staticmethod
+    def state_return(steps, failed_step=None):
+        state_return = dict()
+        now = datetime.now()
+        for run_num, step in enumerate(steps):
+            result = step != failed_step
+            state_return['cmd_|-%s_|-%s_|-run' % (step, step)] = {
+                '__id__': step,
+                '__run_num__': run_num,
+                'result': result,
+                'comment': 'Command "%s" run' % step if result else 'Command "%s" failed' % step,
+                'duration': round(random.uniform(5, 1500), 3),
+                'start_time': now.strftime('%H:%M:%S.%f'),
+                'changes': dict()
+            }
+
+        return state_return
+
+    def run(self, minion, fun, arg, kwarg, failure_rate=0.0):
+        """
+        Run a salt function against a single minion
+        :return: tuple of (seconds the function takes on the minion, return value)
+        """
+        if isinstance(fun, list):
+            # compound command, arg holds one argument list per function and the return is keyed by function
+            args = arg if isinstance(arg, list) and len(arg) == len(fun) else [list() for _ in fun]
+            total = 0
+            ret = dict()
+            for f, a in zip(fun, args):
+                duration, ret[f] = self.run(minion, f, a, kwarg, failure_rate)
+                total += duration
+
+            return total, ret
+
+        vms = self.nodes[minion]
+        pillar = (kwarg or dict()).get('pillar', dict())
+        if fun == 'virt.vm_state':
+            with self._lock:
+                return 0.05, dict(vms)
+        elif fun == 'virt.freemem':
+            with self._lock:
+                return 0.05, max(0, 262144 - 9216 * len(vms))
+        elif fun == 'virt.freecpu':
+            with self._lock:
+                return 0.05, max(0, 64 - 4 * len(vms))
+        elif fun == 'test.ping':
+            return 0.01, True
+        elif fun == 'grains.items':
+            return 0.05, {'id': minion, 'host': minion.split('.')[0], 'os': 'Ubuntu', 'num_cpus': 64,
+                          'mem_total': 262144}
+        elif fun == 'state.apply' and arg:
+            state = arg[0]
+            if state == 'create_ngfw':
+                steps = ['create_disk', 'create_bootstrap_iso', 'define_vm', 'start_vm']
+                failed = random.choice(steps) if random.random() < failure_rate else None
+                if failed is None:
+                    with self._lock:
+                        vms[pillar.get('vm_name', 'panos-%s' % uuid.uuid4().hex[:6])] = 'running'
+
+                return self.deploy_time, self.state_return(steps, failed)
+            elif state == 'delete_all_ngfw':
+                hostnames = pillar.get('hostnames', None) or [pillar.get('hostname', '')]
+                with self._lock:
+                    for hostname in hostnames:
+                        vms.pop(hostname, None)
+
+                return self.delete_time, self.state_return(['destroy_vm', 'undefine_vm', 'remove_disk'])
+            elif state == 'delete_all_vms':
+                with self._lock:
+                    count = len(vms)
+                    vms.clear()
+
+                return self.delete_time * max(1, count), self.state_return(['destroy_all_vms', 'remove_disks'])
+
+            return 0.1, ['No matching sls found for \'%s\' in env \'base\'' % state]
+
+        return 0.01, '\'%s\' is not available.' % fun
+
+    def submit(self, lowstate, failure_rate):
+        """
+        Start a job for a lowstate chunk. Each minion returns after the time its function takes
+        :return: job dict
+        """
+        minions = self.match(lowstate.get('tgt', '*'), lowstate.get('tgt_type', 'glob'))
+        job = {'fun': lowstate.get('fun', ''), 'arg': lowstate.get('arg', list()), 'minions': minions,
+               'start': time.time(), 'return': dict(), 'done': threading.Event()}
+        with self._lock:
+            jid = datetime.now().strftime('%Y%m%d%H%M%S%f')
+            while jid in self.jobs:
+                jid = str(int(jid) + 1)
+
+            job['jid'] = jid
+            self.jobs[jid] = job
+
+        self.publish('salt/job/%s/new' % jid, {'jid': jid, 'minions': minions, 'fun': job['fun'],
+                                                'arg': job['arg'], '_stamp': datetime.utcnow().isoformat()})
+
+        def run_minion(minion):
+            duration, ret = self.run(minion, job['fun'], job['arg'], lowstate.get('kwarg', None), failure_rate)
+            time.sleep(duration)
+            with self._lock:
+                job['return'][minion] = ret
+                done = len(job['return']) == len(minions)
+
+            self.publish('salt/job/%s/ret/%s' % (jid, minion), {
+                'jid': jid, 'id': minion, 'fun': job['fun'], 'fun_args': job['arg'], 'return': ret,
+                'success': True, '_stamp': datetime.utcnow().isoformat()})
+            if job['fun'] == 'state.apply':
+                self.publish_vm_states(minion)
+
+            if done:
+                job['done'].set()
+
+        for minion in minions:
+            threading.Thread(target=run_minion, args=(minion,), daemon=True).start()
+
+        if not minions:
+            job['done'].set()
+
+        return job
+
+    def publish_vm_states(self, minion):
+        with self._lock:
+            vms = dict(self.nodes[minion])
+
+        self.publish('salt/beacon/%s/virt/' % minion, {'id': minion, 'vms': vms,
+                                                       '_stamp': datetime.utcnow().isoformat()})
+
+
+class FakeSaltApiHandler(BaseHTTPRequestHandler):
+    server_version = 'CherryPy/18.1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, {'status': status, 'return': message})
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        if length == 0:
+            return None
+
+        raw = self.rfile.read(length).decode('utf-8')
+        if 'json' in self.headers.get('Content-Type', ''):
+            return json.loads(raw)
+
+        return {k: v[0] for k, v in parse_qs(raw).items()}
+
+    def simulate(self):
+        """
+        Add the configured latency and fail the request at the configured rate
+        :return: True if the request should continue
+        """
+        latency = self.server.latency
+        if latency > 0:
+            time.sleep(random.uniform(0.5, 1.5) * latency)
+
+        if random.random() < self.server.failure_rate:
+            self.send_error_json(random.choice([500, 502, 503]), 'Simulated failure')
+            return False
+
+        return True
+
+    def authorized(self, query):
+        token = self.headers.get('X-Auth-Token', '') or query.get('token', [''])[0]
+        expire = self.server.tokens.get(token, 0)
+        if expire < time.time():
+            self.send_error_json(401, 'Please log in')
+            return False
+
+        return True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path.rstrip('/')
+        if path == '/events':
+            if self.authorized(query):
+                self.stream_events()
+
+            return
+
+        if not self.simulate() or not self.authorized(query):
+            return
+
+        fleet = self.server.fleet
+        if path == '/minions':
+            self.send_json(200, {'return': [{m: {'id': m} for m in fleet.nodes}]})
+        elif path.startswith('/jobs/'):
+            jid = path.split('/')[2]
+            job = fleet.jobs.get(jid, None)
+            if job is None:
+                self.send_json(200, {'info': [{'jid': jid, 'Minions': [], 'Result': dict()}], 'return': [dict()]})
+                return
+
+            returns = dict(job['return'])
+            info = {'jid': jid, 'Function': job['fun'], 'Arguments': job['arg'], 'Minions': job['minions'],
+                    'Result': {m: {'return': r} for m, r in returns.items()}}
+            self.send_json(200, {'info': [info], 'return': [returns]})
+        elif path == '/jobs':
+            self.send_json(200, {'return': [{jid: {'Function': j['fun'], 'Arguments': j['arg']}
+                                             for jid, j in fleet.jobs.items()}]})
+        else:
+            self.send_error_json(404, 'Not found')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path.rstrip('/')
+        try:
+            body = self.read_body()
+        except ValueError:
+            self.send_error_json(400, 'Could not parse request body')
+            return
+
+        if not self.simulate():
+            return
+
+        if path == '/login':
+            body = body or dict()
+            if body.get('username') != self.server.username or body.get('password') != self.server.password:
+                self.send_error_json(401, 'Could not authenticate using provided credentials')
+                return
+
+            token = uuid.uuid4().hex
+            now = time.time()
+            self.server.tokens[token] = now + self.server.token_ttl
+            self.send_json(200, {'return': [{'token': token, 'start': now, 'expire': now + self.server.token_ttl,
+                                             'user': self.server.username, 'eauth': 'pam', 'perms': ['.*']}]})
+            return
+
+        if path != '' or not self.authorized(query):
+            if path != '':
+                self.send_error_json(404, 'Not found')
+
+            return
+
+        if isinstance(body, dict):
+            body = [body]
+
+        results = list()
+        for lowstate in body or list():
+            job = self.server.fleet.submit(lowstate, self.server.deploy_failure_rate)
+            if lowstate.get('client', 'local') == 'local_async':
+                results.append({'jid': job['jid'], 'minions': job['minions']})
+            else:
+                job['done'].wait(self.server.sync_timeout)
+                results.append(dict(job['return']))
+
+        self.send_json(200, {'return': results})
+
+    def stream_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        fleet = self.server.fleet
+        subscriber = fleet.subscribe()
+        try:
+            self.wfile.write(b'retry: 400\n\n')
+            self.wfile.flush()
+            while True:
+                try:
+                    event = subscriber.get(timeout=15)
+                    data = 'tag: %s\ndata: %s\n\n' % (event['tag'], json.dumps(event))
+                except queue.Empty:
+                    # keep the connection open through proxies
+                    data = ': keepalive\n\n'
+
+                self.wfile.write(data.encode('utf-8'))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            fleet.unsubscribe(subscriber)
+
+
+class FakeSaltApiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, fleet, latency=0.0, failure_rate=0.0, deploy_failure_rate=0.0,
+                 username='saltuser', password='saltuser', token_ttl=43200, sync_timeout=3600, verbose=False):
+        super().__init__(address, FakeSaltApiHandler)
+        self.fleet = fleet
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.deploy_failure_rate = deploy_failure_rate
+        self.username = username
+        self.password = password
+        self.token_ttl = token_ttl
+        self.sync_timeout = sync_timeout
+        self.verbose = verbose
+        self.tokens = dict()
+
+
+def start_server(host='127.0.0.1', port=9000, **kwargs):
+    """
+    Start a fake salt-api server in a background thread, for use from benchmarks
+    :param host: address to listen on
+    :param port: port to listen on, 0 picks a free port
+    :param kwargs: FakeFleet and FakeSaltApiServer options
+    :return: FakeSaltApiServer, its url is http://host:server.server_port
+    """
+    fleet_options = dict()
+    for option in ('minions', 'vms', 'deploy_time', 'delete_time'):
+        if option in kwargs:
+            fleet_options[option] = kwargs.pop(option)
+
+    server = FakeSaltApiServer((host, port), FakeFleet(**fleet_options), **kwargs)
+    threading.Thread(target=server.serve_forever, name='fake-salt-api', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake salt-api server for vistoq development and benchmarks')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--minions', type=int, default=4, help='number of compute nodes')
+    parser.add_argument('--vms', type=int, default=10, help='VMs initially running on each compute node')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds added to each request')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of requests failing with a 5xx')
+    parser.add_argument('--deploy-failure-rate', type=float, default=0.0,
+                        help='fraction of create_ngfw states that report a failed step')
+    parser.add_argument('--deploy-time', type=float, default=5.0, help='seconds a create_ngfw state takes')
+    parser.add_argument('--delete-time', type=float, default=1.0, help='seconds a delete state takes')
+    parser.add_argument('--username', default='saltuser')
+    parser.add_argument('--password', default='saltuser')
+    parser.add_argument('--token-ttl', type=int, default=43200)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    fleet = FakeFleet(args.minions, args.vms, args.deploy_time, args.delete_time)
+    server = FakeSaltApiServer((args.host, args.port), fleet, latency=args.latency, failure_rate=args.failure_rate,
+                               deploy_failure_rate=args.deploy_failure_rate, username=args.username,
+                               password=args.password, token_ttl=args.token_ttl, verbose=args.verbose)
+    print('Fake salt-api with %s minions listening on http://%s:%s' % (args.minions, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Load benchmark of the vistoq views.
+
+Drives ViewMinionsView, ViewDeployedVmsView, DeployServiceView and DeleteVMView of a running vistoq instance at a
+configurable concurrency and reports throughput and latency percentiles. Run vistoq against the fake backends so
+results only depend on vistoq itself:
+
+    python tools/fake_salt_api.py --port 9000 --latency 0.02 --deploy-time 0.5 &
+    SALT_API_URL=http://localhost:9000 python app/cnc/manage.py runserver 8080 &
+    python tools/vistoq_bench.py --url http://localhost:8080 --concurrency 8 --requests 200 --save before.json
+
+Compare against an earlier run with --baseline, the exit code is 1 when a scenario got slower than
+--max-regression percent
+"""
+
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+csrf_pattern = re.compile(r'name=["\']csrfmiddlewaretoken["\']\s+value=["\']([^"\']+)["\']')
+
+
+def percentile(sorted_values, pct):
+    """
+    Nearest rank percentile
+    :param sorted_values: list of numbers sorted in ascending order
+    :param pct: percentile between 0 and 100
+    :return: value at the percentile or None for an empty list
+    """
+    if not sorted_values:
+        return None
+
+    rank = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+class VistoqClient():
+    """
+    Logged in session against a vistoq instance, one per benchmark thread
+    """
+
+    def __init__(self, base_url, username, password, login_path='/login', timeout=600):
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.login_path = login_path
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def csrf_token(self, path):
+        res = self.session.get(self.base_url + path, timeout=self.timeout)
+        match = csrf_pattern.search(res.text)
+        if match is not None:
+            return match.group(1)
+
+        return self.session.cookies.get('csrftoken', '')
+
+    def login(self):
+        token = self.csrf_token(self.login_path)
+        data = {'username': self.username, 'password': self.password, 'csrfmiddlewaretoken': token, 'next': '/'}
+        res = self.session.post(self.base_url + self.login_path, data=data, timeout=self.timeout,
+                                headers={'Referer': self.base_url + self.login_path})
+        if res.status_code >= 400 or self.login_path in res.url:
+            raise RuntimeError('Could not login to %s as %s' % (self.base_url, self.username))
+
+    def get(self, path):
+        return self.session.get(self.base_url + path, timeout=self.timeout)
+
+    def post_form(self, path, data):
+        """
+        Load a form to get a fresh csrf token and submit it, only the submit is returned for timing by the caller
+        """
+        data = dict(data)
+        data['csrfmiddlewaretoken'] = self.csrf_token(path)
+        return lambda: self.session.post(self.base_url + path, data=data, timeout=self.timeout,
+                                         headers={'Referer': self.base_url + path})
+
+
+class Scenario():
+    """
+    A benchmarked interaction. prepare returns the timed request as a callable so form loads and other setup are
+    not included in the latency
+    """
+    name = ''
+    # response text that marks a failed request even though the status code is 200
+    error_markers = ('Could not', 'Error')
+
+    def __init__(self, options):
+        self.options = options
+
+    def prepare(self, client, i):
+        raise NotImplementedError
+
+    def is_error(self, res):
+        if res.status_code >= 400:
+            return True
+
+        return any(marker in res.text for marker in self.error_markers)
+
+
+class MinionsScenario(Scenario):
+    name = 'minions'
+
+    def prepare(self, client, i):
+        return lambda: client.get('/vistoq/minions')
+
+
+class ViewDeployedVmsScenario(Scenario):
+    name = 'view_deployed_vms'
+
+    def prepare(self, client, i):
+        return client.post_form('/vistoq/view_deployed_vms', {'minion': self.options.minion})
+
+
+class DeployScenario(Scenario):
+    name = 'deployfw'
+    error_markers = ('Error deploying VM', 'Could not')
+
+    def prepare(self, client, i):
+        data = dict()
+        data['minion'] = self.options.minion
+        data['vm_name'] = '%s-%05d' % (self.options.vm_prefix, i)
+        data['left_bridge'] = 'ingress'
+        data['right_bridge'] = 'egress'
+        data['admin_username'] = 'admin'
+        data['admin_password'] = 'admin'
+        data['vm_auth_key'] = '0'
+        data['panorama_ip'] = '0.0.0.0'
+        data['auth_key'] = '000000'
+        return client.post_form('/vistoq/deployfw', data)
+
+
+class DeleteScenario(Scenario):
+    name = 'delete_vm'
+    error_markers = ('Error during deploy', 'Could not login')
+
+    def prepare(self, client, i):
+        # removes the VMs created by the deploy scenario, the GET only shows the confirmation form
+        return client.post_form('/vistoq/delete_vm/%s/%s-%05d' % (self.options.minion, self.options.vm_prefix, i),
+                                dict())
+
+
+scenarios = dict()
+for scenario_class in (MinionsScenario, ViewDeployedVmsScenario, DeployScenario, DeleteScenario):
+    scenarios[scenario_class.name] = scenario_class
+
+
+def run_scenario(scenario, options):
+    """
+    Run a scenario with options.concurrency threads until options.requests requests completed
+    :return: dict of results
+    """
+    local = threading.local()
+    latencies = list()
+    errors = list()
+    lock = threading.Lock()
+
+    def get_client():
+        if not hasattr(local, 'client'):
+            local.client = VistoqClient(options.url, options.username, options.password, options.login_path)
+            local.client.login()
+
+        return local.client
+
+    def one_request(i):
+        try:
+            timed_request = scenario.prepare(get_client(), i)
+            start = time.perf_counter()
+            res = timed_request()
+            elapsed = time.perf_counter() - start
+            failed = scenario.is_error(res)
+            error = 'status %s' % res.status_code if failed else None
+        except (requests.RequestException, RuntimeError) as e:
+            elapsed = None
+            error = str(e)
+
+        with lock:
+            if elapsed is not None:
+                latencies.append(elapsed)
+
+            if error is not None:
+                errors.append(error)
+
+    for i in range(options.warmup):
+        one_request(options.requests + i)
+
+    with lock:
+        latencies.clear()
+        errors.clear()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        list(executor.map(one_request, range(options.requests)))
+
+    wall_time = time.perf_counter() - start
+
+    latencies.sort()
+    results = dict()
+    results['scenario'] = scenario.name
+    results['requests'] = options.requests
+    results['concurrency'] = options.concurrency
+    results['errors'] = len(errors)
+    results['wall_time'] = wall_time
+    results['throughput'] = len(latencies) / wall_time if wall_time > 0 else 0.0
+    for pct in (50, 90, 95, 99):
+        value = percentile(latencies, pct)
+        results['p%s' % pct] = value * 1000 if value is not None else None
+
+    results['mean'] = sum(latencies) / len(latencies) * 1000 if latencies else None
+    results['max'] = latencies[-1] * 1000 if latencies else None
+    results['sample_errors'] = sorted(set(errors))[:5]
+    return results
+
+
+def format_ms(value):
+    return '%9.1f' % value if value is not None else '%9s' % '-'
+
+
+def print_report(all_results):
+    print('%-20s %8s %7s %10s %9s %9s %9s %9s %9s' % ('scenario', 'requests', 'errors', 'req/s', 'p50 ms',
+                                                     'p90 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for r in all_results:
+        print('%-20s %8s %7s %10.2f %s %s %s %s %s' % (r['scenario'], r['requests'], r['errors'], r['throughput'],
+                                                       format_ms(r['p50']), format_ms(r['p90']),
+                                                       format_ms(r['p95']), format_ms(r['p99']),
+                                                       format_ms(r['max'])))
+        for error in r['sample_errors']:
+            print('    error: %s' % error)
+
+
+def compare(all_results, baseline, max_regression):
+    """
+    :return: list of regression descriptions against the baseline results
+    """
+    regressions = list()
+    baseline_by_name = {r['scenario']: r for r in baseline}
+    for r in all_results:
+        before = baseline_by_name.get(r['scenario'], None)
+        if before is None:
+            continue
+
+        if before['p95'] and r['p95'] and r['p95'] > before['p95'] * (1 + max_regression / 100.0):
+            regressions.append('%s p95 %.1f ms -> %.1f ms' % (r['scenario'], before['p95'], r['p95']))
+
+        if before['throughput'] and r['throughput'] < before['throughput'] * (1 - max_regression / 100.0):
+            regressions.append('%s throughput %.2f -> %.2f req/s' % (r['scenario'], before['throughput'],
+                                                                     r['throughput']))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the vistoq views')
+    parser.add_argument('--url', default='http://localhost:8080', help='base url of the vistoq instance')
+    parser.add_argument('--username', default='vistoq')
+    parser.add_argument('--password', default='Vistoq123')
+    parser.add_argument('--login-path', default='/login')
+    parser.add_argument('--scenario', action='append', choices=sorted(scenarios.keys()),
+                        help='scenario to run, may be repeated. Defaults to all in order: minions, '
+                             'view_deployed_vms, deployfw, delete_vm')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=100, help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed requests before each scenario')
+    parser.add_argument('--minion', default='compute-01.c.vistoq-demo.internal')
+    parser.add_argument('--vm-prefix', default='bench')
+    parser.add_argument('--save', help='write the results as json to this file')
+    parser.add_argument('--baseline', help='compare against results saved with --save')
+    parser.add_argument('--max-regression', type=float, default=10.0,
+                        help='percent p95 latency or throughput may regress against the baseline')
+    options = parser.parse_args()
+
+    names = options.scenario or ['minions', 'view_deployed_vms', 'deployfw', 'delete_vm']
+    all_results = list()
+    for name in names:
+        print('Running %s: %s requests at concurrency %s' % (name, options.requests, options.concurrency))
+        all_results.append(run_scenario(scenarios[name](options), options))
+
+    print_report(all_results)
+
+    if options.save:
+        with open(options.save, 'w') as save_file:
+            json.dump(all_results, save_file, indent=2)
+
+    if options.baseline:
+        with open(options.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = compare(all_results, baseline, options.max_regression)
+        for regression in regressions:
+            print('REGRESSION: %s' % regression)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()